@@ -1,5 +1,6 @@
 # === Часть 1: Импорты и вспомогательные функции ===
 import os
+import struct
 import sys
 import time
 import traceback
@@ -8,8 +9,12 @@ import subprocess
 import concurrent.futures
 import locale
 import json
+import importlib
+import importlib.util
 import datetime # Добавляем импорт datetime
-import gc
+import threading
+import queue
+from collections import OrderedDict
 
 # === Новая функция логирования ===
 def log_message(message):
@@ -100,6 +105,8 @@ translations["ru"] = {
     "importing_pyqt5": "Импорт компонентов PyQt5...",
     "pyqt5_components_imported": "PyQt5 компоненты успешно импортированы.",
     "failed_import_pyqt5_components": "Не удалось импортировать компоненты PyQt5: {0}",
+    "dependencies_cached": "Окружение не изменилось с прошлой проверки, установка пакетов пропущена (OpenCV: {0}, GUI: {1}).",
+    "dependency_stamp_error": "Не удалось сохранить отметку проверки окружения: {0}",
     "script_continue_console": "Скрипт продолжит работу в консольном режиме.",
     "script_first_part_loaded": "Первая часть скрипта успешно загружена.",
     "critical_error": "КРИТИЧЕСКАЯ ОШИБКА",
@@ -178,6 +185,7 @@ translations["ru"] = {
     "select_threads": "Количество потоков для граней (рекомендуется {0}):", # Renamed
     "invalid_threads": "Некорректный ввод. Используется {0} потоков для граней.", # Updated message
     "select_camera_threads": "Количество потоков для камер (рекомендуется {0}):", # New
+    "select_memory_budget": "Бюджет памяти для конвертации в МБ (рекомендуется {0}):",
     "invalid_camera_threads": "Некорректный ввод. Используется {0} потоков для камер.", # New
 }
 
@@ -233,6 +241,8 @@ translations["en"] = {
     "importing_pyqt5": "Importing PyQt5 components...",
     "pyqt5_components_imported": "PyQt5 components successfully imported.",
     "failed_import_pyqt5_components": "Failed to import PyQt5 components: {0}",
+    "dependencies_cached": "Environment unchanged since the last check, package installation skipped (OpenCV: {0}, GUI: {1}).",
+    "dependency_stamp_error": "Failed to save the environment check stamp: {0}",
     "script_continue_console": "Script will continue in console mode.",
     "script_first_part_loaded": "First part of the script successfully loaded.",
     "critical_error": "CRITICAL ERROR",
@@ -311,6 +321,7 @@ translations["en"] = {
     "select_threads": "Number of face threads (recommended {0}):", # Renamed
     "invalid_threads": "Invalid input. Using {0} face threads.", # Updated message
     "select_camera_threads": "Number of camera threads (recommended {0}):", # New
+    "select_memory_budget": "Memory budget for conversion in MB (recommended {0}):",
     "invalid_camera_threads": "Invalid input. Using {0} camera threads.", # New
 }
 # Функция для настройки системной локали и кодировок
@@ -466,10 +477,10 @@ def check_and_install_packages():
     
     missing_packages = []
     for module_name, pip_name in required_packages.items():
-        try:
-            __import__(module_name)
+        # Наличие модуля без импорта; сам импорт проверяется после установки
+        if importlib.util.find_spec(module_name) is not None:
             print(_("library_installed").format(module_name))
-        except ImportError:
+        else:
             missing_packages.append(pip_name)
             print(_("library_not_found").format(module_name))
     
@@ -584,6 +595,96 @@ def check_and_install_packages():
     
     return True
 
+# === Кэш проверки окружения и отложенные импорты ===
+# Отметка проверенного окружения: при совпадении отпечатка пакеты не импортируются и не устанавливаются
+DEPENDENCY_STAMP_PATH = os.path.join(os.path.expanduser("~"), ".metashape_cubemap", "dependencies.json")
+# Модули окружения и дистрибутивы pip, из которых они могут быть установлены
+DEPENDENCY_DISTRIBUTIONS = {
+    "cv2": ("opencv-python", "opencv-contrib-python", "opencv-python-headless", "opencv-contrib-python-headless"),
+    "PyQt5": ("PyQt5",)
+}
+
+def get_dependency_fingerprint():
+    """
+    Отпечаток окружения без импорта пакетов.
+    
+    Returns:
+    --------
+    dict
+        Интерпретатор, версия Python и для каждого модуля - версия дистрибутива,
+        путь и время изменения файла модуля (None, если модуль не найден)
+    """
+    try:
+        import importlib.metadata as importlib_metadata
+    except ImportError:
+        importlib_metadata = None
+
+    modules = {}
+    for module_name, distributions in DEPENDENCY_DISTRIBUTIONS.items():
+        try:
+            spec = importlib.util.find_spec(module_name)
+        except (ImportError, ValueError):
+            spec = None
+        if spec is None or not spec.origin or not os.path.exists(spec.origin):
+            modules[module_name] = None
+            continue
+        version = None
+        for distribution in distributions if importlib_metadata else ():
+            try:
+                version = importlib_metadata.version(distribution)
+                break
+            except Exception:
+                continue
+        modules[module_name] = [version, spec.origin, os.path.getmtime(spec.origin)]
+
+    return {"executable": sys.executable, "python": sys.version, "modules": modules}
+
+def read_dependency_stamp(fingerprint):
+    """Возвращает запись отметки окружения, если отпечаток совпадает, иначе None."""
+    try:
+        with open(DEPENDENCY_STAMP_PATH, encoding='utf-8') as f:
+            entry = json.load(f).get(fingerprint["executable"])
+    except (OSError, ValueError, AttributeError):
+        return None
+    if not entry or entry.get("fingerprint") != fingerprint:
+        return None
+    return entry
+
+def write_dependency_stamp(fingerprint, gui_available):
+    """Сохраняет отметку проверенного окружения (отдельная запись на интерпретатор)."""
+    try:
+        try:
+            with open(DEPENDENCY_STAMP_PATH, encoding='utf-8') as f:
+                stamps = json.load(f)
+            if not isinstance(stamps, dict):
+                stamps = {}
+        except (OSError, ValueError):
+            stamps = {}
+        stamps[fingerprint["executable"]] = {"fingerprint": fingerprint, "gui": gui_available}
+        os.makedirs(os.path.dirname(DEPENDENCY_STAMP_PATH), exist_ok=True)
+        tmp_path = DEPENDENCY_STAMP_PATH + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(stamps, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, DEPENDENCY_STAMP_PATH)
+    except OSError as e:
+        print(_("dependency_stamp_error").format(str(e)))
+
+class LazyModule:
+    """
+    Модуль, импортируемый при первом обращении к атрибуту.
+    
+    OpenCV не нужен, пока не началась конвертация: окно открывается без его загрузки.
+    """
+
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, name):
+        if self._module is None:
+            self._module = importlib.import_module(self._module_name)
+        return getattr(self._module, name)
+
 # === Вспомогательные функции ===
 def console_progress_bar(iteration, total, prefix='', suffix='', length=50, fill='█', print_end="\r"):
     """
@@ -707,6 +808,117 @@ def read_image_with_cyrillic(image_path):
         print(f"Ошибка при чтении изображения '{image_path}': {str(e)}")
         return None
 
+# --- Разбор заголовков изображений ---
+# Копия блока из unified_fixed_v002.py слово в слово: исправления вносятся в оба файла,
+# tests/test_image_header.py сверяет копии
+# Маркеры SOF (начало кадра) JPEG: содержат размеры изображения
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Сигнатура PNG и число каналов по типу цвета из IHDR (палитра декодируется в BGR)
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_COLOR_TYPE_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+# Порядок байт TIFF по сигнатуре и теги IFD: ширина, высота, каналы (BigTIFF не поддерживается)
+TIFF_BYTE_ORDERS = {b'II*\x00': '<', b'MM\x00*': '>'}
+TIFF_SIZE_TAGS = (256, 257, 277)
+
+def _read_jpeg_header_FIXED(f):
+    """(ширина, высота, каналы) из маркера SOF; файл открыт после сигнатуры SOI"""
+    while True:
+        prefix = f.read(1)
+        if prefix != b'\xff':
+            return None
+        marker = f.read(1)
+        while marker == b'\xff':  # Байты заполнения перед маркером
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue  # Маркеры без длины
+        segment_length = struct.unpack('>H', f.read(2))[0]
+        if marker in JPEG_SOF_MARKERS:
+            height, width, channels = struct.unpack('>xHHB', f.read(6))
+            return width, height, channels
+        if marker == 0xDA:  # Начало сжатых данных, SOF не найден
+            return None
+        f.seek(segment_length - 2, os.SEEK_CUR)
+
+def _read_png_header_FIXED(f):
+    """(ширина, высота, каналы) из блока IHDR; файл открыт после сигнатуры PNG"""
+    length, chunk_type = struct.unpack('>I4s', f.read(8))
+    if chunk_type != b'IHDR' or length < 13:
+        return None
+    width, height, _, color_type = struct.unpack('>IIBB', f.read(10))
+    channels = PNG_COLOR_TYPE_CHANNELS.get(color_type)
+    return (width, height, channels) if channels else None
+
+def _read_tiff_header_FIXED(f, byte_order):
+    """(ширина, высота, каналы) из первого IFD; файл открыт после сигнатуры TIFF"""
+    f.seek(struct.unpack(byte_order + 'I', f.read(4))[0])
+    entry_count = struct.unpack(byte_order + 'H', f.read(2))[0]
+    entries = f.read(entry_count * 12)
+    tags = {}
+    for offset in range(0, len(entries) - 11, 12):
+        tag, value_type, count = struct.unpack_from(byte_order + 'HHI', entries, offset)
+        if tag in TIFF_SIZE_TAGS and count == 1 and value_type in (3, 4):
+            # SHORT или LONG помещается в поле значения записи
+            tags[tag] = struct.unpack_from(byte_order + ('H' if value_type == 3 else 'I'), entries, offset + 8)[0]
+    if 256 not in tags or 257 not in tags:
+        return None
+    return tags[256], tags[257], tags.get(277, 1)
+
+def probe_image_header_FIXED(path):
+    """
+    Читает формат, размеры и число каналов изображения по заголовку, без декодирования
+    
+    Разбирает маркер SOF JPEG, блок IHDR PNG или первый IFD TIFF - обычно
+    несколько сотен байт вместо десятков мегабайт декодированной панорамы.
+    
+    Returns:
+        (format, width, height, channels) - format: 'jpeg', 'png' или 'tiff';
+        None, если формат не распознан или заголовок поврежден
+    """
+    try:
+        with open(path, 'rb') as f:
+            signature = f.read(8)
+            if signature[:2] == b'\xff\xd8':
+                f.seek(2)
+                image_format, header = 'jpeg', _read_jpeg_header_FIXED(f)
+            elif signature == PNG_SIGNATURE:
+                image_format, header = 'png', _read_png_header_FIXED(f)
+            elif signature[:4] in TIFF_BYTE_ORDERS:
+                f.seek(4)
+                image_format, header = 'tiff', _read_tiff_header_FIXED(f, TIFF_BYTE_ORDERS[signature[:4]])
+            else:
+                return None
+    except (OSError, struct.error):
+        return None
+    if header is None or not header[0] or not header[1]:
+        return None
+    return (image_format,) + header
+
+def read_image_header(image_path):
+    """
+    Читает размеры изображения по заголовку файла, без декодирования.
+    
+    Returns:
+    --------
+    tuple или None
+        (ширина, высота, каналы) или None, если формат не распознан
+    """
+    header = probe_image_header_FIXED(normalize_path(image_path))
+    return header[1:] if header is not None else None
+
+def read_face_size(image_path):
+    """
+    Размер (высота) записанной грани: по заголовку файла, декодирование - только
+    для форматов без разбираемого заголовка. None, если файл не читается.
+    """
+    header = read_image_header(image_path)
+    if header is not None:
+        return header[1]
+    image = read_image_with_cyrillic(image_path)
+    return image.shape[0] if image is not None else None
+
 def save_image_with_cyrillic(image, output_path, params=None):
     """
     Сохраняет изображение с поддержкой кириллических путей.
@@ -764,34 +976,48 @@ try:
     # Модификация методов Metashape для поддержки кириллицы
     fix_metashape_file_paths()
     
-    # Пытаемся установить необходимые пакеты
-    print(_("checking_installing"))
-    packages_installed = check_and_install_packages()
-    print(_("package_install_result").format(packages_installed))
+    import numpy as np
+
+    # Окружение уже проверено с теми же интерпретатором и версиями пакетов - без импорта и pip
+    dependency_stamp = read_dependency_stamp(get_dependency_fingerprint())
+    if dependency_stamp is not None:
+        use_gui = dependency_stamp["gui"]
+        print(_("dependencies_cached").format(
+            dependency_stamp["fingerprint"]["modules"]["cv2"][0] or "?", use_gui))
+        # OpenCV импортируется при первом использовании (начало конвертации)
+        cv2 = LazyModule("cv2")
+    else:
+        # Пытаемся установить необходимые пакеты
+        print(_("checking_installing"))
+        packages_installed = check_and_install_packages()
+        print(_("package_install_result").format(packages_installed))
 
-    # Теперь импортируем cv2 после установки
-    try:
-        print(_("trying_import_opencv"))
-        import cv2
-        import numpy as np
-        print(_("opencv_imported").format(cv2.__version__))
-    except ImportError as e:
-        print(_("failed_import_opencv").format(str(e)))
-        print(_("script_cant_work"))
-        # Ждем ввода перед завершением, чтобы увидеть сообщение об ошибке
-        input(_("press_enter"))
-        sys.exit(1)
+        # Теперь импортируем cv2 после установки
+        try:
+            print(_("trying_import_opencv"))
+            import cv2
+            print(_("opencv_imported").format(cv2.__version__))
+        except ImportError as e:
+            print(_("failed_import_opencv").format(str(e)))
+            print(_("script_cant_work"))
+            # Ждем ввода перед завершением, чтобы увидеть сообщение об ошибке
+            input(_("press_enter"))
+            sys.exit(1)
 
-    # Проверяем, можно ли использовать PyQt5
-    try:
-        print(_("checking_pyqt5_availability"))
-        import PyQt5
-        from PyQt5 import QtCore, QtWidgets
-        use_gui = True
-        print(_("pyqt5_available"))
-    except ImportError as e:
-        use_gui = False
-        print(_("pyqt5_unavailable").format(str(e)))
+        # Проверяем, можно ли использовать PyQt5
+        try:
+            print(_("checking_pyqt5_availability"))
+            import PyQt5
+            from PyQt5 import QtCore, QtWidgets
+            use_gui = True
+            print(_("pyqt5_available"))
+        except ImportError as e:
+            use_gui = False
+            print(_("pyqt5_unavailable").format(str(e)))
+
+        # Отпечаток - после установки: следующий запуск пропустит проверку
+        importlib.invalidate_caches()
+        write_dependency_stamp(get_dependency_fingerprint(), use_gui)
 
     # Импортируем PyQt5, если он доступен
     if use_gui:
@@ -823,7 +1049,6 @@ except Exception as global_error:
 # Добавляем словари переводов для этой части
 translations["ru"].update({
     "equirect_to_persp_map": "Создание карты проекции из эквиректангулярной в перспективную...",
-    "fixing_back_face": "Исправление артефакта задней грани...",
     "determining_coordinate_system": "Определение типа координатной системы...",
     "coordinate_system_determined": "Определена координатная система: {0}",
     "unknown_coordinate_system": "Предупреждение: неизвестная координатная система '{0}'. Используем Y_UP.",
@@ -842,7 +1067,6 @@ translations["ru"].update({
 
 translations["en"].update({
     "equirect_to_persp_map": "Creating projection map from equirectangular to perspective...",
-    "fixing_back_face": "Fixing back face artifact...",
     "determining_coordinate_system": "Determining coordinate system type...",
     "coordinate_system_determined": "Coordinate system determined: {0}",
     "unknown_coordinate_system": "Warning: unknown coordinate system '{0}'. Using Y_UP.",
@@ -859,9 +1083,27 @@ translations["en"].update({
     "save_image_error": "Error saving image '{0}': {1}"
 })
 
+# Временные буферы построения карт: свои у каждого рабочего потока,
+# переиспользуются между гранями одного размера и освобождаются вместе с потоком пула
+_persp_map_buffers = threading.local()
+
+def _get_persp_map_buffers(Hd, Wd):
+    """Возвращает два буфера float32 (Hd, Wd) текущего потока."""
+    buffers = getattr(_persp_map_buffers, "arrays", None)
+    if buffers is None or buffers[0].shape != (Hd, Wd):
+        buffers = (np.empty((Hd, Wd), np.float32), np.empty((Hd, Wd), np.float32))
+        _persp_map_buffers.arrays = buffers
+    return buffers
+
 def eqruirect2persp_map(img_shape, FOV, THETA, PHI, Hd, Wd, overlap=10, messages=None):
     """
     Создает карты отображения для преобразования эквиректангулярной проекции в перспективную.
+    
+    Вычисления во float32 без промежуточного массива xyz: луч пикселя (1, y, z)
+    поворачивается комбинацией строки и столбца с коэффициентами матрицы,
+    долгота и широта считаются arctan2 без нормировки луча (arctan2 для широты
+    точен и у полюсов, в отличие от arcsin). Кроме двух выходных карт
+    используются только два буфера потока (_get_persp_map_buffers).
     """
     # Если messages передан, используем его, иначе используем функцию _
     if messages:
@@ -870,8 +1112,6 @@ def eqruirect2persp_map(img_shape, FOV, THETA, PHI, Hd, Wd, overlap=10, messages
         print(_("equirect_to_persp_map"))
         
     equ_h, equ_w = img_shape
-    equ_cx = (equ_w) / 2.0
-    equ_cy = (equ_h) / 2.0
 
     wFOV = FOV + overlap
     hFOV = float(Hd) / Wd * wFOV
@@ -885,97 +1125,131 @@ def eqruirect2persp_map(img_shape, FOV, THETA, PHI, Hd, Wd, overlap=10, messages
     h_len = 2 * np.tan(np.radians(hFOV / 2.0))
     h_interval = h_len / (Hd)
 
-    x_map = np.zeros([Hd, Wd], np.float32) + 1
-    y_map = np.tile((np.arange(0, Wd) - c_x) * w_interval, [Hd, 1])
-    z_map = -np.tile((np.arange(0, Hd) - c_y) * h_interval, [Wd, 1]).T
-    D = np.sqrt(x_map ** 2 + y_map ** 2 + z_map ** 2)
-
-    xyz = np.zeros([Hd, Wd, 3], np.float64)
-    xyz[:, :, 0] = (x_map / D)[:, :]
-    xyz[:, :, 1] = (y_map / D)[:, :]
-    xyz[:, :, 2] = (z_map / D)[:, :]
+    # Луч пикселя: x = 1, y зависит только от столбца, z - только от строки
+    y_row = ((np.arange(Wd, dtype=np.float32) - c_x) * w_interval).astype(np.float32)[np.newaxis, :]
+    z_col = (-(np.arange(Hd, dtype=np.float32) - c_y) * h_interval).astype(np.float32)[:, np.newaxis]
 
     y_axis = np.array([0.0, 1.0, 0.0], np.float32)
     z_axis = np.array([0.0, 0.0, 1.0], np.float32)
     [R1, jacobian] = cv2.Rodrigues(z_axis * np.radians(THETA))
     [R2, jacobian] = cv2.Rodrigues(np.dot(R1, y_axis) * np.radians(-PHI))
+    R = np.dot(R2, R1).astype(np.float64)
 
-    xyz = xyz.reshape([Hd * Wd, 3]).T
-    xyz = np.dot(R1, xyz)
-    xyz = np.dot(R2, xyz).T
-    lat = np.arcsin(xyz[:, 2] / 1)
-    lon = np.zeros([Hd * Wd], np.float64)
-    theta = np.arctan(xyz[:, 1] / xyz[:, 0])
-    idx1 = xyz[:, 0] > 0
-    idx2 = xyz[:, 1] > 0
+    rotated, scratch = _get_persp_map_buffers(Hd, Wd)
+    lon = np.empty((Hd, Wd), np.float32)
+    lat = np.empty((Hd, Wd), np.float32)
 
-    idx3 = ((1 - idx1) * idx2).astype(np.bool)
-    idx4 = ((1 - idx1) * (1 - idx2)).astype(np.bool)
+    # Долгота: arctan2 повернутых y и x (длина луча на угол не влияет)
+    np.add(z_col * np.float32(R[0, 2]) + np.float32(R[0, 0]), y_row * np.float32(R[0, 1]), out=scratch)
+    np.add(z_col * np.float32(R[1, 2]) + np.float32(R[1, 0]), y_row * np.float32(R[1, 1]), out=rotated)
+    np.arctan2(rotated, scratch, out=lon)
 
-    lon[idx1] = theta[idx1]
-    lon[idx3] = theta[idx3] + np.pi
-    lon[idx4] = theta[idx4] - np.pi
+    # Широта: arctan2 повернутой z и горизонтальной длины луча
+    np.hypot(scratch, rotated, out=scratch)
+    np.add(z_col * np.float32(R[2, 2]) + np.float32(R[2, 0]), y_row * np.float32(R[2, 1]), out=rotated)
+    np.arctan2(rotated, scratch, out=lat)
 
-    lon = lon.reshape([Hd, Wd]) / np.pi * 180
-    lat = -lat.reshape([Hd, Wd]) / np.pi * 180
-    lon = lon / 180 * equ_cx + equ_cx
-    lat = lat / 90 * equ_cy + equ_cy
+    # Радианы → пиксели панорамы
+    lon *= np.float32(equ_w / (2 * np.pi))
+    lon += np.float32(equ_w / 2.0)
+    lat *= np.float32(-equ_h / np.pi)
+    lat += np.float32(equ_h / 2.0)
 
-    return lon.astype(np.float32), lat.astype(np.float32)
+    # Долгота циклична: значения у шва (lon == equ_w) переносим в начало панорамы,
+    # а remap с BORDER_WRAP интерполирует между последним и первым столбцом.
+    # Без этого в центре задней грани появлялась черная вертикальная полоса.
+    np.mod(lon, np.float32(equ_w), out=lon)
+    np.clip(lat, 0, equ_h - 1, out=lat)
 
-def fix_back_face_artifact(image, messages=None):
+    return lon, lat
+
+def shift_persp_map_longitude(maps, equ_w, theta):
     """
-    Исправляет артефакт в виде черной вертикальной полосы в центре изображения.
+    Карта грани экватора из карты front (THETA=0, PHI=0) сдвигом по долготе.
+    
+    При PHI=0 поворот на THETA вокруг вертикальной оси не меняет широту, а долготу
+    сдвигает на THETA/360 ширины панорамы (с переносом через шов).
+    
+    Parameters:
+    -----------
+    maps : tuple
+        Карты front: float32 (map_x, map_y) или CV_16SC2 (map_xy, map_interp)
+    equ_w : int
+        Ширина панорамы
+    theta : float
+        Поворот грани вокруг вертикальной оси в градусах
+    
+    Returns:
+    --------
+    tuple or None
+        Карты грани в том же формате; None, если сдвиг для CV_16SC2 не целый
+        (тогда карту нужно строить напрямую)
     """
-    # Если messages передан, используем его, иначе используем функцию _
-    if messages:
-        # Тут не выводим сообщение, чтобы не засорять лог
-        pass
-    else:
-        # Не используем _() внутри функции, так как она может вызываться из потоков
-        pass
+    offset = theta / 360.0 * equ_w
+    map_a, map_b = maps
         
-    height, width = image.shape[:2]
-    center_x = width // 2
+    if map_a.dtype == np.int16:
+        # CV_16SC2: целая часть координат в map_a, дробная - в таблице map_b (не меняется)
+        if offset != int(offset):
+            return None
+        shifted = map_a.copy()
+        shifted[..., 0] = np.mod(map_a[..., 0].astype(np.int32) + int(offset), equ_w)
+        return shifted, map_b
     
-    # Ширина полосы, которую нужно обработать
-    strip_width = 3
+    shifted = np.add(map_a, offset, dtype=np.float64)
+    np.mod(shifted, equ_w, out=shifted)
+    return shifted.astype(np.float32), map_b
     
-    # Создаем копию изображения для обработки
-    fixed_image = image.copy()
+# Кэш готовых карт проекции: все камеры чанка обычно имеют одинаковое разрешение,
+# поэтому карты для каждой грани достаточно построить один раз
+PERSP_MAP_CACHE_LIMIT_MB = 1024
+_persp_map_cache = OrderedDict()
+_persp_map_cache_bytes = 0
+_persp_map_cache_lock = threading.Lock()
     
-    # Определяем диапазон пикселей для обработки
-    left_x = max(0, center_x - strip_width)
-    right_x = min(width - 1, center_x + strip_width)
+def get_persp_remap_maps(img_shape, FOV, THETA, PHI, Hd, Wd, overlap=10, messages=None, fixed_point=True):
+    """
+    Возвращает карты отображения для cv2.remap, используя кэш.
     
-    # Для каждой строки изображения
-    for y in range(height):
-        # Проверяем, есть ли черные пиксели в центральной полосе
-        strip = image[y, left_x:right_x+1]
+    В режиме fixed_point карты один раз переводятся через cv2.convertMaps в формат
+    CV_16SC2 + таблица интерполяции: remap работает быстрее, а карта занимает
+    на четверть меньше памяти (6 байт на пиксель вместо 8). Обе пары карт передаются в cv2.remap одинаково.
         
-        # Если есть слишком темные пиксели (возможно артефакт)
-        if np.any(np.mean(strip, axis=1) < 30):  # Порог может требовать настройки
-            # Используем значения с левой и правой стороны от полосы для интерполяции
-            left_value = image[y, left_x-1] if left_x > 0 else image[y, right_x+1]
-            right_value = image[y, right_x+1] if right_x < width-1 else image[y, left_x-1]
-            
-            # Линейная интерполяция между левым и правым значением
-            for i, x in enumerate(range(left_x, right_x+1)):
-                alpha = i / (right_x - left_x + 1)
-                fixed_image[y, x] = (1 - alpha) * left_value + alpha * right_value
-    
-    # Применяем сглаживание только к исправленной полосе для лучшего смешивания
-    temp_mask = np.zeros_like(image)
-    temp_mask[:, left_x:right_x+1] = 255
-    
-    # Применяем размытие по Гауссу к исправленной области
-    blur_region = cv2.GaussianBlur(fixed_image, (5, 5), 0)
+    Карты right/back/left (PHI=0) получаются из карты front сдвигом по долготе
+    (shift_persp_map_longitude), тригонометрия считается только для front/top/down.
+    """
+    global _persp_map_cache_bytes
+    key = (tuple(img_shape), FOV, THETA, PHI, Hd, Wd, overlap, fixed_point)
+            
+    with _persp_map_cache_lock:
+        maps = _persp_map_cache.get(key)
+        if maps is not None:
+            _persp_map_cache.move_to_end(key)
+            return maps
     
-    # Используем маску для объединения исходного изображения и размытой области
-    mask = temp_mask.astype(np.float32) / 255.0
-    blended = (mask * blur_region + (1.0 - mask) * fixed_image).astype(np.uint8)
+    # Карта строится вне блокировки, чтобы не останавливать другие потоки
+    maps = None
+    if PHI == 0 and THETA % 360 != 0:
+        front_maps = get_persp_remap_maps(img_shape, FOV, 0, 0, Hd, Wd, overlap=overlap,
+                                          messages=messages, fixed_point=fixed_point)
+        maps = shift_persp_map_longitude(front_maps, img_shape[1], THETA)
+    if maps is None:
+        map_x, map_y = eqruirect2persp_map(img_shape, FOV, THETA, PHI, Hd, Wd, overlap=overlap, messages=messages)
+        if fixed_point:
+            maps = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        else:
+            maps = (map_x, map_y)
     
-    return blended
+    with _persp_map_cache_lock:
+        if key not in _persp_map_cache:
+            _persp_map_cache[key] = maps
+            _persp_map_cache_bytes += sum(m.nbytes for m in maps)
+        _persp_map_cache.move_to_end(key)
+        # Вытесняем самые старые карты, но всегда оставляем текущую
+        while _persp_map_cache_bytes > PERSP_MAP_CACHE_LIMIT_MB * 1024 * 1024 and len(_persp_map_cache) > 1:
+            unused_key, evicted = _persp_map_cache.popitem(last=False)
+            _persp_map_cache_bytes -= sum(m.nbytes for m in evicted)
+        return _persp_map_cache[key]
 
 def determine_coordinate_system():
     """
@@ -1135,43 +1409,31 @@ def remove_spherical_cameras():
         print(f"Ошибка при удалении сферических камер: {str(e)}")
         return False
 
-# Модифицируем функцию convert_spherical_to_cubemap для поддержки выборочной генерации граней
-def convert_spherical_to_cubemap(spherical_image_path, output_folder, camera_label, persp_size=None, overlap=10, 
-                                file_format="jpg", quality=95, interpolation=cv2.INTER_CUBIC, max_workers=None,
-                                selected_faces=None):
+# Методы интерполяции по ключу настроек: флаг cv2 берется только при конвертации,
+# поэтому построение окна и диалогов не импортирует OpenCV
+INTERPOLATION_FLAG_NAMES = {
+    "nearest": "INTER_NEAREST",
+    "linear": "INTER_LINEAR",
+    "cubic": "INTER_CUBIC"
+}
+
+# Подготовка задания конвертации: загрузка панорамы и параметры граней
+def prepare_cubemap_job(spherical_image_path, output_folder, camera_label, persp_size=None, overlap=10,
+                        file_format="jpg", quality=95, interpolation=None, selected_faces=None,
+                        fixed_point_maps=True):
     """
-    Конвертирует сферическое изображение в кубическую проекцию.
-    Использует многопоточность для ускорения обработки.
-    
-    Parameters:
-    -----------
-    spherical_image_path : str
-        Путь к сферическому изображению
-    output_folder : str
-        Путь к папке для сохранения результатов
-    camera_label : str
-        Метка камеры для именования файлов
-    persp_size : int, optional
-        Размер грани куба (ширина и высота), None для автоматического расчета
-    overlap : float, optional
-        Перекрытие в градусах (по умолчанию 10)
-    file_format : str, optional
-        Формат выходного файла (jpg, png, tiff)
-    quality : int, optional
-        Качество сжатия (75-100 для JPEG)
-    interpolation : int, optional
-        Метод интерполяции (cv2.INTER_NEAREST, cv2.INTER_LINEAR, cv2.INTER_CUBIC)
-    max_workers : int, optional
-        Максимальное количество потоков для параллельной обработки
-    selected_faces : list, optional
-        Список выбранных граней для генерации (front, right, left, top, down, back)
-        Если None, будут сгенерированы все грани
+    Загружает сферическое изображение и готовит все параметры для конвертации граней.
     
     Returns:
     --------
     dict
-        Словарь с путями к созданным изображениям для каждой грани
+        Задание для convert_cubemap_face: изображение, размер грани, параметры граней и сохранения
     """
+    if interpolation is None:
+        interpolation = "cubic"
+    if isinstance(interpolation, str):
+        interpolation = getattr(cv2, INTERPOLATION_FLAG_NAMES[interpolation])
+
     # Сначала локализуем все необходимые строки перед созданием потоков
     # и сохраняем в локальный словарь
     messages = {
@@ -1185,19 +1447,12 @@ def convert_spherical_to_cubemap(spherical_image_path, output_folder, camera_lab
         "save_error": _("save_error"),
         "face_processing_error": _("face_processing_error"),
         "created_no_faces": _("created_no_faces"),
-        "fixing_back_face": _("fixing_back_face"),
         "equirect_to_persp_map": _("equirect_to_persp_map"),
         "selected_faces": _("selected_faces"),
         "no_faces_selected": _("no_faces_selected")
     }
     
     print(messages["converting_spherical"])
-    
-    # Используем версию с поддержкой кириллицы
-    if max_workers is None:
-        max_workers = min(6, os.cpu_count() or 1)
-    
-    print(messages["threading_info"].format(max_workers))
         
     # Нормализуем пути для корректной работы с кириллицей
     normalized_image_path = normalize_path(spherical_image_path)
@@ -1249,8 +1504,6 @@ def convert_spherical_to_cubemap(spherical_image_path, output_folder, camera_lab
     # Отфильтровываем только выбранные грани
     faces_params = {face: params for face, params in faces_params.items() if face in faces_to_process}
 
-    image_paths = {}
-    
     # Настройки сохранения в зависимости от формата
     save_params = []
     file_ext = file_format.lower()
@@ -1269,63 +1522,130 @@ def convert_spherical_to_cubemap(spherical_image_path, output_folder, camera_lab
         save_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
         file_ext = "jpg"
 
-    # Создаем замыкание для функции обработки грани с доступом к локализованным сообщениям
-    def process_face(face_name, params):
-        try:
-            print(messages["converting_face"].format(face_name))
-            
-            # Вызываем модифицированные функции с передачей словаря messages
-            map_x, map_y = eqruirect2persp_map(
-                img_shape=(equirect_height, equirect_width),
-                FOV=params["fov"],
-                THETA=params["theta"],
-                PHI=params["phi"],
-                Hd=persp_size,
-                Wd=persp_size,
-                overlap=overlap,
-                messages=messages
-            )
+    return {
+        "image": spherical_image,
+        "camera_label": camera_label,
+        "output_folder": normalized_output_folder,
+        "persp_size": persp_size,
+        "overlap": overlap,
+        "interpolation": interpolation,
+        "fixed_point_maps": fixed_point_maps,
+        "faces_params": faces_params,
+        "selected_faces": selected_faces,
+        "save_params": save_params,
+        "file_ext": file_ext,
+        "messages": messages
+    }
+            
+def convert_cubemap_face(job, face_name):
+    """
+    Конвертирует и сохраняет одну грань из задания prepare_cubemap_job.
+    Возвращает (face_name, путь) или (face_name, None) при ошибке.
+    """
+    messages = job["messages"]
+    params = job["faces_params"][face_name]
+    try:
+        print(messages["converting_face"].format(face_name))
+        spherical_image = job["image"]
     
-            perspective_image = cv2.remap(spherical_image, map_x, map_y, interpolation=interpolation)
+        # Карты берутся из кэша и строятся только для первой камеры с таким разрешением
+        map_x, map_y = get_persp_remap_maps(
+            img_shape=spherical_image.shape[:2],
+            FOV=params["fov"],
+            THETA=params["theta"],
+            PHI=params["phi"],
+            Hd=job["persp_size"],
+            Wd=job["persp_size"],
+            overlap=job["overlap"],
+            messages=messages,
+            fixed_point=job["fixed_point_maps"]
+        )
         
-            # Постобработка для грани "back" для устранения черной вертикальной полосы
-            if face_name == "back":
-                perspective_image = fix_back_face_artifact(perspective_image, messages=messages)
+        # BORDER_WRAP + циклические карты убирают шов долготы в центре задней грани
+        perspective_image = cv2.remap(spherical_image, map_x, map_y, interpolation=job["interpolation"],
+                                      borderMode=cv2.BORDER_WRAP)
             
-            output_filename = f"{camera_label}_{face_name}.{file_ext}"
-            output_path = os.path.join(normalized_output_folder, output_filename)
+        output_filename = f"{job['camera_label']}_{face_name}.{job['file_ext']}"
+        output_path = os.path.join(job["output_folder"], output_filename)
             
-            # Используем функцию с поддержкой кириллицы для сохранения изображения
-            success = save_image_with_cyrillic(perspective_image, output_path, save_params)
+        # Используем функцию с поддержкой кириллицы для сохранения изображения
+        success = save_image_with_cyrillic(perspective_image, output_path, job["save_params"])
             
-            if not success:
-                raise ValueError(messages["save_error"].format(output_path))
+        if not success:
+            raise ValueError(messages["save_error"].format(output_path))
             
-            print(messages["face_converted"].format(face_name))
+        print(messages["face_converted"].format(face_name))
+        return face_name, output_path
+    except Exception as e:
+        print(messages["face_processing_error"].format(face_name, str(e)))
+        return face_name, None
 
-            # --- Явная очистка больших переменных ---
-            del map_x, map_y, perspective_image
-            # ----------------------------------------
+# Модифицируем функцию convert_spherical_to_cubemap для поддержки выборочной генерации граней
+def convert_spherical_to_cubemap(spherical_image_path, output_folder, camera_label, persp_size=None, overlap=10, 
+                                file_format="jpg", quality=95, interpolation=None, max_workers=None,
+                                selected_faces=None, fixed_point_maps=True):
+    """
+    Конвертирует сферическое изображение в кубическую проекцию.
+    Использует многопоточность для ускорения обработки.
 
-            return face_name, output_path
-        except Exception as e:
-            print(messages["face_processing_error"].format(face_name, str(e)))
-            # --- Очистка в случае ошибки (если переменные были созданы) ---
-            if 'map_x' in locals(): del map_x
-            if 'map_y' in locals(): del map_y
-            if 'perspective_image' in locals(): del perspective_image
-            # -------------------------------------------------------------
-            return face_name, None
+    Для обработки множества камер используйте MemoryBudgetScheduler - он
+    распределяет грани всех камер по одному пулу потоков с учетом бюджета памяти.
+    
+    Parameters:
+    -----------
+    spherical_image_path : str
+        Путь к сферическому изображению
+    output_folder : str
+        Путь к папке для сохранения результатов
+    camera_label : str
+        Метка камеры для именования файлов
+    persp_size : int, optional
+        Размер грани куба (ширина и высота), None для автоматического расчета
+    overlap : float, optional
+        Перекрытие в градусах (по умолчанию 10)
+    file_format : str, optional
+        Формат выходного файла (jpg, png, tiff)
+    quality : int, optional
+        Качество сжатия (75-100 для JPEG)
+    interpolation : str или int, optional
+        Метод интерполяции: ключ INTERPOLATION_FLAG_NAMES ("nearest", "linear", "cubic")
+        или флаг cv2.INTER_*, None = "cubic"
+    max_workers : int, optional
+        Максимальное количество потоков для параллельной обработки
+    selected_faces : list, optional
+        Список выбранных граней для генерации (front, right, left, top, down, back)
+        Если None, будут сгенерированы все грани
+    fixed_point_maps : bool, optional
+        Использовать кэшированные карты в формате CV_16SC2 (быстрее и меньше памяти)
+    
+    Returns:
+    --------
+    dict
+        Словарь с путями к созданным изображениям для каждой грани
+    """
+    # Используем версию с поддержкой кириллицы
+    if max_workers is None:
+        max_workers = min(6, os.cpu_count() or 1)
+    
+    print(_("threading_info").format(max_workers))
+    
+    job = prepare_cubemap_job(
+        spherical_image_path, output_folder, camera_label, persp_size=persp_size, overlap=overlap,
+        file_format=file_format, quality=quality, interpolation=interpolation,
+        selected_faces=selected_faces, fixed_point_maps=fixed_point_maps
+    )
+
+    image_paths = {}
     
     # Если нет граней для обработки, сразу возвращаем пустой словарь
-    if not faces_params:
+    if not job["faces_params"]:
         return image_paths
     
     # Используем ThreadPoolExecutor для параллельной обработки граней
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
         # Запускаем задачи на обработку граней
-        future_to_face = {executor.submit(process_face, face_name, params): face_name 
-                          for face_name, params in faces_params.items()}
+        future_to_face = {executor.submit(convert_cubemap_face, job, face_name): face_name 
+                          for face_name in job["faces_params"]}
         
         # Собираем результаты
         for future in concurrent.futures.as_completed(future_to_face):
@@ -1335,15 +1655,216 @@ def convert_spherical_to_cubemap(spherical_image_path, output_folder, camera_lab
                 if path:
                     image_paths[face_name] = path
             except Exception as e:
-                print(messages["face_processing_error"].format(face_name, str(e)))
+                print(job["messages"]["face_processing_error"].format(face_name, str(e)))
     
     # Теперь мы проверяем, были ли сгенерированы какие-либо грани
     # Если не было выбрано никаких граней, это не ошибка
     if not image_paths and selected_faces:
-        raise ValueError(messages["created_no_faces"])
+        raise ValueError(job["messages"]["created_no_faces"])
         
     return image_paths
 
+# === Планировщик с бюджетом памяти ===
+
+# Бюджет памяти по умолчанию, если объем ОЗУ определить не удалось
+DEFAULT_MEMORY_BUDGET_MB = 4096
+# Память построения карты на пиксель грани (при промахе кэша карт): две карты float32,
+# два буфера потока eqruirect2persp_map и карты CV_16SC2
+MAP_BUILD_BYTES_PER_PIXEL = 24
+
+def get_default_memory_budget_mb():
+    """Возвращает половину физической памяти в МБ (или DEFAULT_MEMORY_BUDGET_MB)."""
+    total_bytes = None
+    try:
+        if os.name == 'nt':
+            import ctypes
+
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                            ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                            ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                            ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                            ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+                total_bytes = status.ullTotalPhys
+        else:
+            total_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except Exception:
+        total_bytes = None
+
+    if not total_bytes:
+        return DEFAULT_MEMORY_BUDGET_MB
+    return max(1024, int(total_bytes / (1024 * 1024) / 2))
+
+class MemoryBudgetScheduler:
+    """
+    Единый планировщик конвертации вместо вложенных пулов камер и граней.
+    
+    Грани всех камер выполняются в одном пуле потоков, а новая камера
+    (загрузка панорамы) допускается только если ее оценка памяти помещается
+    в бюджет. Оценка резервируется по заголовку панорамы до ее загрузки; камера
+    с нераспознанным заголовком резервирует оценку прошлой камеры (первая - весь
+    бюджет), после загрузки резерв уточняется до реальной оценки. Память панорамы
+    освобождается сразу после записи последней грани.
+    """
+
+    def __init__(self, budget_mb=None, max_workers=None, max_cameras=None):
+        self.budget_bytes = int((budget_mb or get_default_memory_budget_mb()) * 1024 * 1024)
+        self.max_workers = max_workers or (os.cpu_count() or 1)
+        self.max_cameras = max_cameras
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        self._condition = threading.Condition()
+        self._used_bytes = 0
+        self._active_cameras = 0
+        self._last_estimate = None
+
+    @staticmethod
+    def estimate_camera_bytes(equirect_shape, persp_size, faces_count):
+        """Оценка памяти одной камеры: панорама, грани с буферами кодирования и построение карты."""
+        equirect_height, equirect_width = equirect_shape[:2]
+        panorama_bytes = equirect_height * equirect_width * 3
+        faces_bytes = faces_count * persp_size * persp_size * 3 * 2
+        map_build_bytes = persp_size * persp_size * MAP_BUILD_BYTES_PER_PIXEL
+        return panorama_bytes + faces_bytes + map_build_bytes
+
+    @classmethod
+    def estimate_camera_bytes_from_header(cls, convert_kwargs):
+        """Оценка памяти камеры по заголовку панорамы, до ее загрузки (None - заголовок не распознан)."""
+        header = read_image_header(convert_kwargs["spherical_image_path"])
+        if header is None:
+            return None
+        equirect_width, equirect_height = header[:2]
+        # Размер грани - как при автоматическом выборе в prepare_cubemap_job
+        persp_size = convert_kwargs.get("persp_size") or min(max(equirect_width // 4, 512), 4096)
+        faces_count = len(convert_kwargs.get("selected_faces") or ()) or 6
+        return cls.estimate_camera_bytes((equirect_height, equirect_width), persp_size, faces_count)
+
+    def _admit(self, nbytes, should_stop):
+        # Всегда допускаем хотя бы одну камеру, даже если она больше бюджета
+        with self._condition:
+            while self._active_cameras > 0 and not should_stop() and (
+                    self._used_bytes + nbytes > self.budget_bytes or
+                    (self.max_cameras and self._active_cameras >= self.max_cameras)):
+                self._condition.wait(timeout=0.5)
+            if should_stop():
+                return False
+            self._used_bytes += nbytes
+            self._active_cameras += 1
+            return True
+
+    def _resize(self, old_bytes, new_bytes):
+        with self._condition:
+            self._used_bytes += new_bytes - old_bytes
+            self._condition.notify_all()
+
+    def _release(self, nbytes):
+        with self._condition:
+            self._used_bytes -= nbytes
+            self._active_cameras -= 1
+            self._condition.notify_all()
+
+    def _start_camera(self, key, convert_kwargs, reserved_bytes, done_queue):
+        """Загружает панораму и отправляет ее грани в общий пул (без ожидания)."""
+        try:
+            job = prepare_cubemap_job(**convert_kwargs)
+        except Exception as e:
+            self._release(reserved_bytes)
+            done_queue.put((key, None, e))
+            return
+
+        estimate = self.estimate_camera_bytes(job["image"].shape, job["persp_size"], len(job["faces_params"]))
+        self._last_estimate = estimate
+        self._resize(reserved_bytes, estimate)
+
+        face_names = list(job["faces_params"])
+        if not face_names:
+            job.clear()
+            self._release(estimate)
+            done_queue.put((key, {}, None))
+            return
+
+        state = {"remaining": len(face_names), "paths": {}}
+        state_lock = threading.Lock()
+
+        def face_done(future):
+            try:
+                face_name, path = future.result()
+            except Exception as e:
+                face_name, path = None, None
+                print(f"Ошибка обработки грани: {e}")
+            with state_lock:
+                if path:
+                    state["paths"][face_name] = path
+                state["remaining"] -= 1
+                finished = state["remaining"] == 0
+            if finished:
+                selected_faces = job["selected_faces"]
+                no_faces_message = job["messages"]["created_no_faces"]
+                # Освобождаем панораму до выдачи результата
+                job.clear()
+                self._release(estimate)
+                if not state["paths"] and selected_faces:
+                    done_queue.put((key, None, ValueError(no_faces_message)))
+                else:
+                    done_queue.put((key, state["paths"], None))
+
+        for face_name in face_names:
+            self._executor.submit(convert_cubemap_face, job, face_name).add_done_callback(face_done)
+
+    def run(self, camera_jobs, should_stop=None):
+        """
+        Выполняет конвертацию камер.
+        
+        Parameters:
+        -----------
+        camera_jobs : list
+            Список (ключ, kwargs для prepare_cubemap_job)
+        should_stop : callable, optional
+            Возвращает True, если новые камеры запускать не нужно
+        
+        Yields:
+        -------
+        (ключ, словарь путей граней или None, исключение или None) по мере готовности камер
+        """
+        if should_stop is None:
+            should_stop = lambda: False
+        done_queue = queue.Queue()
+        submitted = []
+
+        def feeder():
+            try:
+                for key, convert_kwargs in camera_jobs:
+                    # Заголовок дает точную оценку до загрузки; иначе - оценка прошлой камеры или весь бюджет
+                    reserved = (self.estimate_camera_bytes_from_header(convert_kwargs)
+                                or self._last_estimate or self.budget_bytes)
+                    if not self._admit(reserved, should_stop):
+                        break
+                    submitted.append(key)
+                    self._executor.submit(self._start_camera, key, convert_kwargs, reserved, done_queue)
+            finally:
+                done_queue.put(None)
+
+        feeder_thread = threading.Thread(target=feeder, name="cubemap-scheduler-feeder", daemon=True)
+        feeder_thread.start()
+
+        received = 0
+        feeding_finished = False
+        while not feeding_finished or received < len(submitted):
+            item = done_queue.get()
+            if item is None:
+                feeding_finished = True
+                continue
+            received += 1
+            yield item
+
+        feeder_thread.join()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
 # === Часть 4: Функция добавления камер ===
 
 # Добавляем переводы для этой части
@@ -1357,7 +1878,8 @@ translations["ru"].update({
     "camera_photo_set": "Установлено изображение для камеры {0}",
     "file_not_found": "Ошибка: файл изображения не найден: {0}",
     "camera_metadata_set": "Установлены метаданные для камеры {0}",
-    "rotation_matrix_created": "Создана матрица вращения для грани {0}"
+    "rotation_matrix_created": "Создана матрица вращения для грани {0}",
+    "cubemap_cameras_added": "Добавлено камер граней: {0} ({1})"
 })
 
 translations["en"].update({
@@ -1370,11 +1892,154 @@ translations["en"].update({
     "camera_photo_set": "Set image for camera {0}",
     "file_not_found": "Error: image file not found: {0}",
     "camera_metadata_set": "Set metadata for camera {0}",
-    "rotation_matrix_created": "Created rotation matrix for face {0}"
+    "rotation_matrix_created": "Created rotation matrix for face {0}",
+    "cubemap_cameras_added": "Added face cameras: {0} ({1})"
 })
 
+# Направления граней куба для разных координатных систем
+CUBEMAP_FACE_DIRECTIONS = {
+    # Y_UP (Y - вверх, Z - вперед, X - вправо)
+    "Y_UP": {
+        "front": {"forward": [0, 0, 1], "up": [0, 1, 0]},
+        "right": {"forward": [1, 0, 0], "up": [0, 1, 0]},
+        "left": {"forward": [-1, 0, 0], "up": [0, 1, 0]},
+        "top": {"forward": [0, 1, 0], "up": [0, 0, -1]},
+        "down": {"forward": [0, -1, 0], "up": [0, 0, 1]},
+        "back": {"forward": [0, 0, -1], "up": [0, 1, 0]},
+    },
+    # Z_UP (Z - вверх, X - вперед, Y - вправо)
+    "Z_UP": {
+        "front": {"forward": [1, 0, 0], "up": [0, 0, 1]},
+        "right": {"forward": [0, 1, 0], "up": [0, 0, 1]},
+        "left": {"forward": [0, -1, 0], "up": [0, 0, 1]},
+        "top": {"forward": [0, 0, 1], "up": [-1, 0, 0]},
+        "down": {"forward": [0, 0, -1], "up": [1, 0, 0]},
+        "back": {"forward": [-1, 0, 0], "up": [0, 0, 1]},
+    },
+    # X_UP (X - вверх, Y - вперед, Z - вправо)
+    "X_UP": {
+        "front": {"forward": [0, 1, 0], "up": [1, 0, 0]},
+        "right": {"forward": [0, 0, 1], "up": [1, 0, 0]},
+        "left": {"forward": [0, 0, -1], "up": [1, 0, 0]},
+        "top": {"forward": [1, 0, 0], "up": [0, -1, 0]},
+        "down": {"forward": [-1, 0, 0], "up": [0, 1, 0]},
+        "back": {"forward": [0, -1, 0], "up": [1, 0, 0]},
+    },
+}
+
+# Кэш матриц вращения граней: coord_system -> {грань: матрица 3x3}
+_face_rotations_cache = {}
+
+def get_cubemap_face_rotations(coord_system="Y_UP"):
+    """
+    Возвращает матрицы вращения граней куба (строки right, up, forward) для координатной системы.
+    Матрицы рассчитываются один раз и кэшируются.
+    
+    Parameters:
+    -----------
+    coord_system : str
+        Тип координатной системы ("Y_UP", "Z_UP", "X_UP")
+    
+    Returns:
+    --------
+    dict
+        Словарь {грань: numpy.ndarray 3x3}
+    """
+    if coord_system not in CUBEMAP_FACE_DIRECTIONS:
+        print(_("unknown_coordinate_system").format(coord_system))
+        coord_system = "Y_UP"
+    
+    face_rotations = _face_rotations_cache.get(coord_system)
+    if face_rotations is None:
+        print(_("cubemap_directions").format(coord_system))
+        face_rotations = {}
+        for face_name, directions in CUBEMAP_FACE_DIRECTIONS[coord_system].items():
+            forward = np.asarray(directions["forward"], dtype=np.float64)
+            forward /= np.linalg.norm(forward)
+            # right перпендикулярен forward и up, up пересчитывается по right и forward
+            right = np.cross(forward, directions["up"])
+            right /= np.linalg.norm(right)
+            up = np.cross(right, forward)
+            up /= np.linalg.norm(up)
+            face_rotations[face_name] = np.stack([right, up, forward])
+        _face_rotations_cache[coord_system] = face_rotations
+    return face_rotations
+
+def build_sensor_index(chunk):
+    """
+    Строит индекс Frame-сенсоров чанка по (ширина, высота, округленное фокусное расстояние).
+    
+    Parameters:
+    -----------
+    chunk : Metashape.Chunk
+        Активный чанк Metashape
+    
+    Returns:
+    --------
+    dict
+        Словарь {(width, height, int(round(f))): [Metashape.Sensor, ...]}
+    """
+    sensor_index = {}
+    for sensor in chunk.sensors:
+        if sensor.type == Metashape.Sensor.Type.Frame:
+            key = (sensor.width, sensor.height, int(round(sensor.calibration.f)))
+            sensor_index.setdefault(key, []).append(sensor)
+    return sensor_index
+
+def get_cubemap_sensor(chunk, persp_size, sensor_index):
+    """
+    Находит в индексе сенсор для граней куба (поле зрения 90°, |Δf| < 1 пикселя) или создает новый.
+    
+    Parameters:
+    -----------
+    chunk : Metashape.Chunk
+        Активный чанк Metashape
+    persp_size : int
+        Размер перспективного изображения (ширина и высота)
+    sensor_index : dict
+        Индекс сенсоров из build_sensor_index (дополняется новым сенсором)
+    
+    Returns:
+    --------
+    Metashape.Sensor
+        Сенсор для граней куба
+    """
+    # Фокусное расстояние для поля зрения 90 градусов
+    focal_length = persp_size / (2 * np.tan(np.radians(90 / 2)))
+    rounded_focal = int(round(focal_length))
+    for focal_key in (rounded_focal, rounded_focal - 1, rounded_focal + 1):
+        for existing_sensor in sensor_index.get((persp_size, persp_size, focal_key), []):
+            if abs(existing_sensor.calibration.f - focal_length) < 1.0:
+                return existing_sensor
+    
+    sensor = chunk.addSensor()
+    if sensor is None:
+        raise RuntimeError(f"chunk.addSensor() returned None for size {persp_size}")
+    sensor.label = f"Perspective_{persp_size}px"
+    sensor.type = Metashape.Sensor.Type.Frame
+    sensor.width = persp_size
+    sensor.height = persp_size
+    sensor.focal_length = focal_length
+    sensor.pixel_width = 1
+    sensor.pixel_height = 1
+    
+    # Устанавливаем матрицу внутренних параметров камеры
+    calibration = sensor.calibration
+    calibration.f = focal_length
+    calibration.cx = persp_size / 2
+    calibration.cy = persp_size / 2
+    calibration.k1 = 0
+    calibration.k2 = 0
+    calibration.k3 = 0
+    calibration.p1 = 0
+    calibration.p2 = 0
+    
+    sensor_index.setdefault((persp_size, persp_size, rounded_focal), []).append(sensor)
+    print(_("camera_sensor_created").format(sensor.label))
+    return sensor
+
 # Модифицируем функцию add_cubemap_cameras для поддержки выборочных граней
-def add_cubemap_cameras(chunk, spherical_camera, image_paths, persp_size, coord_system="Y_UP"):
+def add_cubemap_cameras(chunk, spherical_camera, image_paths, persp_size, coord_system="Y_UP", sensor_index=None):
     """
     Добавляет камеры для граней куба на основе позиции сферической камеры.
     
@@ -1390,224 +2055,69 @@ def add_cubemap_cameras(chunk, spherical_camera, image_paths, persp_size, coord_
         Размер перспективного изображения (ширина и высота)
     coord_system : str
         Тип координатной системы ("Y_UP", "Z_UP", "X_UP")
+    sensor_index : dict
+        Индекс сенсоров из build_sensor_index (None - построить по чанку).
+        При пакетном добавлении передается один индекс на все камеры.
     
     Returns:
     --------
     list
         Список созданных камер
     """
-    print(_("adding_cameras"))
+    if sensor_index is None:
+        sensor_index = build_sensor_index(chunk)
+    
+    face_rotations = get_cubemap_face_rotations(coord_system)
+    sensor = get_cubemap_sensor(chunk, persp_size, sensor_index)
     
-    # Позиция исходной сферической камеры
+    # Позиция и ориентация исходной сферической камеры
     position = spherical_camera.transform.translation()
-
-    # Ориентация исходной сферической камеры
     base_rotation = spherical_camera.transform.rotation()
-
-    # Преобразуем base_rotation (3x3) в матрицу 4x4
-    def convert_to_4x4(matrix_3x3):
-        return Metashape.Matrix([
-            [matrix_3x3[0, 0], matrix_3x3[0, 1], matrix_3x3[0, 2], 0],
-            [matrix_3x3[1, 0], matrix_3x3[1, 1], matrix_3x3[1, 2], 0],
-            [matrix_3x3[2, 0], matrix_3x3[2, 1], matrix_3x3[2, 2], 0],
-            [0, 0, 0, 1]
-        ])
-
-    base_rotation_4x4 = convert_to_4x4(base_rotation)
-
-    # Словарь с направлениями для граней куба для разных координатных систем
-    cubemap_directions = {}
-    
-    # Для системы Y_UP (Y - вверх, Z - вперед, X - вправо)
-    if coord_system == "Y_UP":
-        print(_("cubemap_directions").format("Y_UP"))
-        cubemap_directions = {
-            "front": {"forward": [0, 0, 1], "up": [0, 1, 0]},
-            "right": {"forward": [1, 0, 0], "up": [0, 1, 0]},
-            "left": {"forward": [-1, 0, 0], "up": [0, 1, 0]},
-            "top": {"forward": [0, 1, 0], "up": [0, 0, -1]},
-            "down": {"forward": [0, -1, 0], "up": [0, 0, 1]},
-            "back": {"forward": [0, 0, -1], "up": [0, 1, 0]},
-        }
-    # Для системы Z_UP (Z - вверх, X - вперед, Y - вправо)
-    elif coord_system == "Z_UP":
-        print(_("cubemap_directions").format("Z_UP"))
-        cubemap_directions = {
-            "front": {"forward": [1, 0, 0], "up": [0, 0, 1]},
-            "right": {"forward": [0, 1, 0], "up": [0, 0, 1]},
-            "left": {"forward": [0, -1, 0], "up": [0, 0, 1]},
-            "top": {"forward": [0, 0, 1], "up": [-1, 0, 0]},
-            "down": {"forward": [0, 0, -1], "up": [1, 0, 0]},
-            "back": {"forward": [-1, 0, 0], "up": [0, 0, 1]},
-        }
-    # Для системы X_UP (X - вверх, Y - вперед, Z - вправо)
-    elif coord_system == "X_UP":
-        print(_("cubemap_directions").format("X_UP"))
-        cubemap_directions = {
-            "front": {"forward": [0, 1, 0], "up": [1, 0, 0]},
-            "right": {"forward": [0, 0, 1], "up": [1, 0, 0]},
-            "left": {"forward": [0, 0, -1], "up": [1, 0, 0]},
-            "top": {"forward": [1, 0, 0], "up": [0, -1, 0]},
-            "down": {"forward": [-1, 0, 0], "up": [0, 1, 0]},
-            "back": {"forward": [0, -1, 0], "up": [1, 0, 0]},
-        }
-    else:
-        print(_("unknown_coordinate_system").format(coord_system))
-        cubemap_directions = {
-            "front": {"forward": [0, 0, 1], "up": [0, 1, 0]},
-            "right": {"forward": [1, 0, 0], "up": [0, 1, 0]},
-            "left": {"forward": [-1, 0, 0], "up": [0, 1, 0]},
-            "top": {"forward": [0, 1, 0], "up": [0, 0, -1]},
-            "down": {"forward": [0, -1, 0], "up": [0, 0, 1]},
-            "back": {"forward": [0, 0, -1], "up": [0, 1, 0]},
-        }
-
-    # Функция для создания матрицы вращения
-    def create_rotation_matrix(forward, up, base_rotation_4x4):
-        # Нормализуем вектор forward
-        forward = Metashape.Vector(forward).normalized()
-
-        # Рассчитываем вектор right как перпендикулярный forward и up
-        up = Metashape.Vector(up)
-        right = Metashape.Vector.cross(forward, up).normalized()
-
-        # Пересчитываем up, чтобы он был перпендикулярен forward и right
-        up = Metashape.Vector.cross(right, forward).normalized()
-
-        # Создаем матрицу вращения
-        rotation_matrix = Metashape.Matrix([
-            [right.x, right.y, right.z, 0],
-            [up.x, up.y, up.z, 0],
-            [forward.x, forward.y, forward.z, 0],
-            [0, 0, 0, 1]
-        ])
-
-        # Применяем базовую ориентацию сферической камеры
-        return base_rotation_4x4 * rotation_matrix
+    base_rotation = np.array([[base_rotation[i, j] for j in range(3)] for i in range(3)])
+    position_matrix = Metashape.Matrix.Translation(position)
 
     # Создаем камеры только для выбранных граней куба
     cameras_created = []
-    print(f"DEBUG: Adding cameras for faces: {list(image_paths.keys())}") # DEBUG
-    for face_name in image_paths.keys():
-        if face_name not in cubemap_directions:
-            print(f"DEBUG: Skipping face {face_name}, no directions found.") # DEBUG
+    for face_name, image_path in image_paths.items():
+        face_rotation = face_rotations.get(face_name)
+        if face_rotation is None:
             continue
 
-        print(f"DEBUG: Processing face: {face_name}") # DEBUG
-        directions = cubemap_directions[face_name]
-
-        # Создаем новую камеру
-        print(f"DEBUG: Calling chunk.addCamera() for {face_name}...") # DEBUG
-        camera = None # Инициализируем camera как None
         try:
-            # === Убираем паузу и обновление перед вызовом ===
-            # time.sleep(0.5) # Увеличиваем паузу до 0.5с
-            # if Metashape.app is not None: # Проверка, что Metashape запущен с GUI
-            #      Metashape.app.update()
-            # ===================================================
-            print(f"DEBUG: --- BEFORE chunk.addCamera() for {face_name} ---") # DEBUG
-            camera = chunk.addCamera() # <--- Потенциальное место зависания
-            print(f"DEBUG: --- AFTER chunk.addCamera() for {face_name} (Result: {'Success' if camera else 'None'}) ---") # DEBUG
-
-            if camera is None:
-                print(f"ERROR: chunk.addCamera() returned None for face {face_name}") # DEBUG
-                continue
+            camera = chunk.addCamera()
         except Exception as e:
-            print(f"ERROR: Exception during chunk.addCamera() for face {face_name}: {e}") # DEBUG
-            traceback.print_exc() # Печатаем полный трейсбек ошибки
+            print(f"ERROR: Exception during chunk.addCamera() for face {face_name}: {e}")
+            traceback.print_exc()
+            continue
+        if camera is None:
+            print(f"ERROR: chunk.addCamera() returned None for face {face_name}")
             continue
 
         camera.label = f"{spherical_camera.label}_{face_name}"
-        print(_("camera_added").format(camera.label))
-
-        # Копируем или создаем новый сенсор
-        print(f"DEBUG: Finding/creating sensor for {face_name}...") # DEBUG
-        # Ищем сенсор с нужным размером
-        persp_sensors = [s for s in chunk.sensors if s.type == Metashape.Sensor.Type.Frame and s.width == persp_size and s.height == persp_size]
-        if persp_sensors:
-            camera.sensor = persp_sensors[0]
-            print(f"DEBUG: Reusing existing sensor '{persp_sensors[0].label}'") # DEBUG
-        else:
-            # Если нет подходящего сенсора, создаем новый
-            print(f"DEBUG: Creating new sensor for {face_name}...") # DEBUG
-            sensor = chunk.addSensor()
-            if sensor is None:
-                print(f"ERROR: chunk.addSensor() returned None for face {face_name}") # DEBUG
-                continue
-            sensor.label = f"Perspective_{persp_size}px"
-            sensor.type = Metashape.Sensor.Type.Frame
-            sensor.width = persp_size
-            sensor.height = persp_size
-            camera.sensor = sensor
-            print(_("camera_sensor_created").format(sensor.label))
-
+        camera.sensor = sensor
         cameras_created.append(camera)
 
-        # Настройка параметров камеры
-        print(f"DEBUG: Setting sensor parameters for {face_name}...") # DEBUG
-        sensor = camera.sensor
-        sensor.type = Metashape.Sensor.Type.Frame
-        sensor.width = persp_size
-        sensor.height = persp_size
-        # print(_("camera_parameter_set").format(camera.label)) # Less verbose logging
-
-        # Устанавливаем фокусное расстояние для поля зрения 90 градусов
-        focal_length = persp_size / (2 * np.tan(np.radians(90 / 2)))
-        sensor.focal_length = focal_length
-        sensor.pixel_width = 1
-        sensor.pixel_height = 1
-
-        # Устанавливаем матрицу внутренних параметров камеры
-        print(f"DEBUG: Setting calibration for {face_name}...") # DEBUG
-        calibration = sensor.calibration
-        calibration.f = focal_length
-        calibration.cx = persp_size / 2
-        calibration.cy = persp_size / 2
-        calibration.k1 = 0
-        calibration.k2 = 0
-        calibration.k3 = 0
-        calibration.p1 = 0
-        calibration.p2 = 0
-
-        # Устанавливаем позицию камеры
-        print(f"DEBUG: Setting transform (translation) for {face_name}...") # DEBUG
-        camera.transform = Metashape.Matrix.Translation(position)
-        # print(_("camera_transform_set").format(camera.label)) # Less verbose logging
-
-        # Устанавливаем ориентацию камеры
-        print(f"DEBUG: Calculating rotation matrix for {face_name}...") # DEBUG
-        forward = directions["forward"]
-        up = directions["up"]
-        rotation_matrix = create_rotation_matrix(forward, up, base_rotation_4x4)
-        print(_("rotation_matrix_created").format(face_name))
-        print(f"DEBUG: Setting transform (rotation) for {face_name}...") # DEBUG
-        camera.transform = camera.transform * rotation_matrix
-
-        # Создаем объект Photo для камеры
-        print(f"DEBUG: Creating Photo object for {face_name}...") # DEBUG
-        camera.photo = Metashape.Photo()
+        # Ориентация грани с учетом базовой ориентации сферической камеры
+        rotation = np.eye(4)
+        rotation[:3, :3] = base_rotation @ face_rotation
+        camera.transform = position_matrix * Metashape.Matrix(rotation.tolist())
 
         # Загружаем изображение - используем нормализацию путей для кириллицы
-        normalized_path = normalize_path(image_paths[face_name])
-        print(f"DEBUG: Setting photo path '{normalized_path}' for {face_name}...") # DEBUG
+        normalized_path = normalize_path(image_path)
+        camera.photo = Metashape.Photo()
         camera.photo.path = normalized_path
-        # print(_("camera_photo_set").format(camera.label)) # Less verbose logging
 
         # Проверяем, существует ли файл изображения
-        print(f"DEBUG: Checking if file exists for {face_name}...") # DEBUG
         if not os.path.exists(normalized_path):
             print(_("file_not_found").format(normalized_path))
             continue
 
         # Обновляем метаданные
-        print(f"DEBUG: Setting metadata for {face_name}...") # DEBUG
         camera.meta['Image/Width'] = str(persp_size)
         camera.meta['Image/Height'] = str(persp_size)
         camera.meta['Image/Orientation'] = "1"
-        print(_("camera_metadata_set").format(camera.label))
-        print(f"DEBUG: Finished processing face {face_name}") # DEBUG
 
-    print("DEBUG: Finished add_cubemap_cameras function.") # DEBUG
+    print(_("cubemap_cameras_added").format(len(cameras_created), spherical_camera.label))
     return cameras_created
 
 # === Часть 5: Многопоточная обработка камер для GUI ===
@@ -1663,41 +2173,38 @@ if 'PyQt5' in sys.modules:
             # Используем значение из options, с fallback на половину CPU или 1
             default_camera_threads = max(1, (os.cpu_count() // 2) if os.cpu_count() else 1) # Более надежный fallback
             self.camera_threads = self.options.get("camera_threads", default_camera_threads) 
+            # Бюджет памяти для одновременно загруженных панорам и их граней
+            self.memory_budget_mb = self.options.get("memory_budget_mb", get_default_memory_budget_mb())
         
-        def _process_single_camera(self, camera):
-            """Выполняет конвертацию для одной камеры."""
-            if self.stop_requested:
-                return None # Возвращаем None, если обработка остановлена
-
+        def _camera_convert_kwargs(self, camera):
+            """Параметры prepare_cubemap_job для одной камеры."""
+            return {
+                "spherical_image_path": normalize_path(camera.photo.path),
+                "output_folder": self.output_folder,
+                "camera_label": camera.label,
+                "persp_size": self.options.get("persp_size"),
+                "overlap": self.options.get("overlap", 10),
+                "file_format": self.options.get("file_format", "jpg"),
+                "quality": self.options.get("quality", 95),
+                "interpolation": self.options.get("interpolation", "cubic"),
+                "selected_faces": self.options.get("selected_faces", None)
+            }
+
+        def _conversion_result(self, camera, image_paths, error):
+            """Формирует результат конвертации одной камеры."""
             camera_label = camera.label
-            spherical_image_path = camera.photo.path
-            normalized_path = normalize_path(spherical_image_path)
 
             try:
-                selected_faces = self.options.get("selected_faces", None)
-                image_paths = convert_spherical_to_cubemap(
-                    spherical_image_path=normalized_path,
-                    output_folder=self.output_folder,
-                    camera_label=camera_label,
-                    persp_size=self.options.get("persp_size"),
-                    overlap=self.options.get("overlap", 10),
-                    file_format=self.options.get("file_format", "jpg"),
-                    quality=self.options.get("quality", 95),
-                    interpolation=self.options.get("interpolation", cv2.INTER_CUBIC),
-                    max_workers=self.faces_threads, # Потоки для граней этой камеры
-                    selected_faces=selected_faces
-                )
+                if error is not None:
+                    raise error
 
                 if image_paths:
-                    # Получаем фактический размер изображения для добавления камер
+                    # Получаем фактический размер изображения для добавления камер (по заголовку файла)
                     first_image = list(image_paths.values())[0]
-                    image = read_image_with_cyrillic(first_image)
-                    if image is None:
+                    actual_size = read_face_size(first_image)
+                    if actual_size is None:
                          # Используем None как индикатор ошибки чтения для дальнейшей обработки
                         print(f"Предупреждение: Не удалось прочитать изображение {first_image} для камеры {camera_label} после конвертации.")
-                        actual_size = None
-                    else:
-                        actual_size = image.shape[0]
 
                     return {
                         "camera": camera,
@@ -1738,75 +2245,64 @@ if 'PyQt5' in sys.modules:
                 add_camera_errors = [] # Ошибки добавления камер
 
                 # --- Этап 1: Параллельная конвертация изображений ---
-                # Используем self.camera_threads, значение по умолчанию пока os.cpu_count()
-                print(f"--- Этап 1: Конвертация изображений ({self.camera_threads} потоков) ---")
+                # Грани всех камер выполняются в одном пуле, число одновременно
+                # загруженных панорам ограничено бюджетом памяти и camera_threads
+                print(f"--- Этап 1: Конвертация изображений ({self.camera_threads} камер / {self.faces_threads} потоков, бюджет {self.memory_budget_mb} МБ) ---")
                 conversion_results = [] # Список для хранения результатов конвертации
-                futures = []
 
-                # Используем ThreadPoolExecutor для параллельной КОНВЕРТАЦИИ камер
-                with concurrent.futures.ThreadPoolExecutor(max_workers=self.camera_threads) as executor:
+                scheduler = MemoryBudgetScheduler(
+                    budget_mb=self.memory_budget_mb,
+                    max_workers=self.faces_threads,
+                    max_cameras=self.camera_threads
+                )
+                try:
                     # Обновляем статус перед отправкой задач
                     self.update_progress.emit(0, total_cameras, "", _("submitting_conversion_tasks"), 0)
-
-                    # Отправляем задачи на конвертацию
-                    for i, camera in enumerate(self.cameras):
-                        if self.stop_requested:
-                            print("Остановка запрошена перед отправкой всех задач конвертации.")
-                            break
-                        # Передаем self.options в задачу
-                        future = executor.submit(self._process_single_camera, camera)
-                        futures.append(future)
+                    camera_jobs = ((camera, self._camera_convert_kwargs(camera)) for camera in self.cameras)
 
                     # Собираем результаты по мере готовности
                     self.update_progress.emit(0, total_cameras, "", _("collecting_conversion_results"), 5) # Небольшой прогресс
                     conversion_completed_count = 0
-                    for future in concurrent.futures.as_completed(futures):
+                    for camera, image_paths, error in scheduler.run(camera_jobs, should_stop=lambda: self.stop_requested):
                         if self.stop_requested:
-                            print("Остановка запрошена во время сбора результатов конвертации.")
-                            # Попытка отменить оставшиеся задачи (может не сработать, если они уже выполняются)
-                            for f in futures:
-                                if not f.done():
-                                    f.cancel()
-                            break
-
-                        result = future.result()
+                            # Новые камеры не запускаются, уже начатые дописывают грани
+                            continue
+
+                        result = self._conversion_result(camera, image_paths, error)
                         conversion_completed_count += 1
                         progress_percent_conv = 5 + int((conversion_completed_count / total_cameras) * 45) # Конвертация - от 5% до 50%
 
-                        if result: # Если не None (не было остановки внутри _process_single_camera)
-                             camera_label = result["camera"].label
-                             if result["error"]:
-                                 skipped_count += 1
-                                 if result["error"] != "skipped_no_faces": # Не считаем пропуск без граней за ошибку
-                                     conversion_errors.append(result["error"])
-                                 # Обновляем прогресс при ошибке/пропуске конвертации
-                                 status_msg = _("conversion_error_status").format(camera_label) if result["error"] != "skipped_no_faces" else _("skipped_no_faces").format(camera_label)
-                                 self.update_progress.emit(
-                                     conversion_completed_count, total_cameras, camera_label,
-                                     status_msg,
-                                     progress_percent_conv
-                                 )
-                             elif result["actual_size"] is None: # Ошибка чтения после конвертации
-                                 skipped_count += 1
-                                 error_msg = f"Ошибка чтения изображения после конвертации для {camera_label}"
-                                 conversion_errors.append(error_msg)
-                                 self.update_progress.emit(
-                                     conversion_completed_count, total_cameras, camera_label,
-                                     _("conversion_error_status").format(camera_label),
-                                     progress_percent_conv
-                                 )
-                             else:
-                                 conversion_results.append(result)
-                                 # Обновляем прогресс после успешной конвертации
-                                 self.update_progress.emit(
-                                     conversion_completed_count, total_cameras, camera_label,
-                                     _("conversion_stage") + f" {_('face_converted').format(camera_label)}", # Уточненный статус
-                                     progress_percent_conv
-                                 )
+                        camera_label = result["camera"].label
+                        if result["error"]:
+                            skipped_count += 1
+                            if result["error"] != "skipped_no_faces": # Не считаем пропуск без граней за ошибку
+                                conversion_errors.append(result["error"])
+                            # Обновляем прогресс при ошибке/пропуске конвертации
+                            status_msg = _("conversion_error_status").format(camera_label) if result["error"] != "skipped_no_faces" else _("skipped_no_faces").format(camera_label)
+                            self.update_progress.emit(
+                                conversion_completed_count, total_cameras, camera_label,
+                                status_msg,
+                                progress_percent_conv
+                            )
+                        elif result["actual_size"] is None: # Ошибка чтения после конвертации
+                            skipped_count += 1
+                            error_msg = f"Ошибка чтения изображения после конвертации для {camera_label}"
+                            conversion_errors.append(error_msg)
+                            self.update_progress.emit(
+                                conversion_completed_count, total_cameras, camera_label,
+                                _("conversion_error_status").format(camera_label),
+                                progress_percent_conv
+                            )
                         else:
-                            # Обработка была остановлена внутри _process_single_camera
-                            print(f"Обработка камеры прервана (результат None).")
-                            # Не увеличиваем счетчики, так как это следствие остановки
+                            conversion_results.append(result)
+                            # Обновляем прогресс после успешной конвертации
+                            self.update_progress.emit(
+                                conversion_completed_count, total_cameras, camera_label,
+                                _("conversion_stage") + f" {_('face_converted').format(camera_label)}", # Уточненный статус
+                                progress_percent_conv
+                            )
+                finally:
+                    scheduler.shutdown()
 
                 # Если была запрошена остановка во время конвертации
                 if self.stop_requested:
@@ -1825,6 +2321,7 @@ if 'PyQt5' in sys.modules:
                 if total_to_add > 0:
                     chunk = Metashape.app.document.chunk # Получаем чанк один раз
                     coord_system = self.options.get("coord_system", "Y_UP")
+                    sensor_index = build_sensor_index(chunk) # Индекс сенсоров один раз на все камеры
 
                     for result in conversion_results: # Итерируем по успешно сконвертированным
                         if self.stop_requested:
@@ -1854,7 +2351,8 @@ if 'PyQt5' in sys.modules:
                                 spherical_camera=camera,
                                 image_paths=image_paths,
                                 persp_size=actual_size,
-                                coord_system=coord_system # Используем ранее полученную систему координат
+                                coord_system=coord_system, # Используем ранее полученную систему координат
+                                sensor_index=sensor_index
                             )
                             processed_count += 1 # Счетчик успешно ДОБАВЛЕННЫХ камер
                             # Обновляем прогресс после успешного добавления
@@ -1882,9 +2380,6 @@ if 'PyQt5' in sys.modules:
                             )
                         finally:
                              added_count += 1 # Увеличиваем счетчик обработанных на этом этапе
-                             # --- Принудительный сбор мусора после обработки камеры ---
-                             gc.collect()
-                             # -------------------------------------------------------
 
                 # Если была запрошена остановка во время добавления
                 if self.stop_requested:
@@ -1971,6 +2466,8 @@ translations["ru"].update({
     "threads_tooltip": "Количество параллельных потоков для обработки граней ОДНОЙ камеры", # Updated tooltip
     "camera_threads_label": "Потоки обработки камер:", # New label
     "camera_threads_tooltip": "Количество параллельных потоков для конвертации РАЗНЫХ камер", # New tooltip
+    "memory_budget_label": "Бюджет памяти (МБ):",
+    "memory_budget_tooltip": "Максимальный объем памяти для одновременно загруженных панорам и их граней",
     "image_group": "Параметры изображения",
     "format_label": "Формат файла:",
     "quality_label": "Качество:",
@@ -2039,6 +2536,8 @@ translations["en"].update({
     "threads_tooltip": "Number of parallel threads for processing faces of ONE camera", # Updated tooltip
     "camera_threads_label": "Camera processing threads:", # New label
     "camera_threads_tooltip": "Number of parallel threads for converting DIFFERENT cameras", # New tooltip
+    "memory_budget_label": "Memory budget (MB):",
+    "memory_budget_tooltip": "Maximum memory for simultaneously loaded panoramas and their faces",
     "image_group": "Image Parameters",
     "format_label": "File format:",
     "quality_label": "Quality:",
@@ -2198,6 +2697,19 @@ if 'PyQt5' in sys.modules:
             settings_layout.addLayout(camera_thread_layout)
             # -------------------------------------------
 
+            # Бюджет памяти планировщика конвертации
+            memory_budget_layout = QHBoxLayout()
+            memory_budget_label = QLabel(_("memory_budget_label"))
+            self.memory_budget_spinner = QSpinBox()
+            self.memory_budget_spinner.setRange(256, 1048576)
+            self.memory_budget_spinner.setSingleStep(256)
+            self.memory_budget_spinner.setValue(get_default_memory_budget_mb())
+            self.memory_budget_spinner.setToolTip(_("memory_budget_tooltip"))
+
+            memory_budget_layout.addWidget(memory_budget_label)
+            memory_budget_layout.addWidget(self.memory_budget_spinner)
+            settings_layout.addLayout(memory_budget_layout)
+
             settings_group.setLayout(settings_layout)
             main_layout.addWidget(settings_group)
             
@@ -2232,9 +2744,9 @@ if 'PyQt5' in sys.modules:
             interp_layout = QHBoxLayout()
             interp_label = QLabel(_("interp_label"))
             self.interp_combo = QComboBox()
-            self.interp_combo.addItem(_("nearest"), cv2.INTER_NEAREST)
-            self.interp_combo.addItem(_("linear"), cv2.INTER_LINEAR)
-            self.interp_combo.addItem(_("cubic"), cv2.INTER_CUBIC)
+            self.interp_combo.addItem(_("nearest"), "nearest")
+            self.interp_combo.addItem(_("linear"), "linear")
+            self.interp_combo.addItem(_("cubic"), "cubic")
             self.interp_combo.setCurrentIndex(2)  # Кубическая по умолчанию
             
             interp_layout.addWidget(interp_label)
@@ -2497,6 +3009,7 @@ if 'PyQt5' in sys.modules:
                     "interpolation": interpolation,
                     "faces_threads": faces_threads,
                     "camera_threads": self.camera_thread_spinner.value(), # Добавляем значение из нового спиннера
+                    "memory_budget_mb": self.memory_budget_spinner.value(),
                     "selected_faces": selected_faces,
                     "realign_cameras_after": realign_cameras_after,
                     "remove_spherical_cameras_after": remove_spherical_cameras_after
@@ -2651,6 +3164,7 @@ translations["ru"].update({
     "select_threads": "Количество потоков для граней (рекомендуется {0}):", # Renamed
     "invalid_threads": "Некорректный ввод. Используется {0} потоков для граней.", # Updated message
     "select_camera_threads": "Количество потоков для камер (рекомендуется {0}):", # New
+    "select_memory_budget": "Бюджет памяти для конвертации в МБ (рекомендуется {0}):",
     "invalid_camera_threads": "Некорректный ввод. Используется {0} потоков для камер.", # New
     "processing_start": "Начало обработки {0} камер используя {1} потоков...",
     "processing_settings": "Настройки: перекрытие={0}, размер грани={1}, система={2}",
@@ -2698,6 +3212,7 @@ translations["en"].update({
     "select_threads": "Number of face threads (recommended {0}):", # Renamed
     "invalid_threads": "Invalid input. Using {0} face threads.", # Updated message
     "select_camera_threads": "Number of camera threads (recommended {0}):", # New
+    "select_memory_budget": "Memory budget for conversion in MB (recommended {0}):",
     "invalid_camera_threads": "Invalid input. Using {0} camera threads.", # New
     "processing_start": "Starting processing {0} cameras using {1} threads...",
     "processing_settings": "Settings: overlap={0}, face size={1}, system={2}",
@@ -2785,11 +3300,11 @@ def process_images_console():
         interp_options = [_("nearest_option"), _("linear_option"), _("cubic_option")]
         interp_option = get_string_option(_("select_interpolation"), interp_options)
         
-        interpolation = cv2.INTER_CUBIC  # По умолчанию
+        interpolation = "cubic"  # По умолчанию
         if interp_option == _("nearest_option"):
-            interpolation = cv2.INTER_NEAREST
+            interpolation = "nearest"
         elif interp_option == _("linear_option"):
-            interpolation = cv2.INTER_LINEAR
+            interpolation = "linear"
         
         # Добавляем запрос выбранных граней куба
         face_options = ["front", "right", "left", "top", "down", "back"]
@@ -2824,6 +3339,11 @@ def process_images_console():
         camera_threads = Metashape.app.getInt(_("select_camera_threads").format(recommended_camera_threads), # New translation key
                                             recommended_camera_threads, 1, cpu_count_local)
 
+        # Запрос бюджета памяти для одновременно загруженных панорам
+        recommended_memory_budget = get_default_memory_budget_mb()
+        memory_budget_mb = Metashape.app.getInt(_("select_memory_budget").format(recommended_memory_budget),
+                                                recommended_memory_budget, 256, 1048576)
+
         # --- Начало обработки --- 
         print("\n" + _("processing_console_start").format(f'{len(spherical_cameras)} ({camera_threads} {_("camera_threads_label")[:-1]} / {face_threads} {_("threads_label")[:-1]})')) # Updated info
         print(_("processing_settings").format(overlap, selected_size, coord_system))
@@ -2835,7 +3355,6 @@ def process_images_console():
         skipped_count = 0   # Пропущено/ошибки КОНВЕРТАЦИИ
         add_camera_errors_console = [] # Ошибки добавления
         conversion_results_console = []
-        futures_console = []
 
         # Показываем информационное сообщение
         info_message = _("processing_info_message").format(
@@ -2852,49 +3371,46 @@ def process_images_console():
         show_message(_("info_message_title"), info_message)
 
         # --- Этап 1: Параллельная Конвертация --- 
-        print(f"--- Этап 1: Конвертация изображений ({camera_threads} потоков) ---")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=camera_threads) as executor:
-            # Вспомогательная функция для консольного режима
-            def _process_single_camera_console(camera_idx, cam):
-                try:
-                    # Вызываем основную функцию конвертации
-                    image_paths_c = convert_spherical_to_cubemap(
-                        spherical_image_path=cam.photo.path,
-                        output_folder=output_folder,
-                        camera_label=cam.label,
-                        persp_size=persp_size,
-                        overlap=overlap,
-                        file_format=file_format,
-                        quality=quality,
-                        interpolation=interpolation,
-                        max_workers=face_threads, # Потоки для граней
-                        selected_faces=selected_faces
-                    )
-                    if image_paths_c:
-                        first_img = list(image_paths_c.values())[0]
-                        img = read_image_with_cyrillic(first_img)
-                        # Обработка ошибки чтения изображения
-                        actual_size_c = img.shape[0] if img is not None else None
-                        if actual_size_c is None:
-                             print(f"\nПредупреждение: Не удалось прочитать {first_img} для камеры {cam.label}")
-                             # Возвращаем ошибку, если не удалось прочитать
-                             return {"camera": cam, "image_paths": image_paths_c, "actual_size": None, "error": f"Read error for {first_img}"}
-                        else:
-                             return {"camera": cam, "image_paths": image_paths_c, "actual_size": actual_size_c, "error": None}
-                    else:
-                        return {"camera": cam, "image_paths": None, "actual_size": None, "error": "skipped_no_faces"}
-                except Exception as e:
-                    return {"camera": cam, "image_paths": None, "actual_size": None, "error": str(e)}
-
-            # Отправляем задачи
-            for i, camera in enumerate(spherical_cameras):
-                 future = executor.submit(_process_single_camera_console, i, camera)
-                 futures_console.append(future)
+        # Один пул потоков для граней всех камер, число загруженных панорам ограничено бюджетом памяти
+        print(f"--- Этап 1: Конвертация изображений ({camera_threads} камер / {face_threads} потоков, бюджет {memory_budget_mb} МБ) ---")
+        scheduler = MemoryBudgetScheduler(budget_mb=memory_budget_mb, max_workers=face_threads, max_cameras=camera_threads)
+        camera_jobs_console = [
+            (cam, {
+                "spherical_image_path": cam.photo.path,
+                "output_folder": output_folder,
+                "camera_label": cam.label,
+                "persp_size": persp_size,
+                "overlap": overlap,
+                "file_format": file_format,
+                "quality": quality,
+                "interpolation": interpolation,
+                "selected_faces": selected_faces
+            })
+            for cam in spherical_cameras
+        ]
+
+        # Вспомогательная функция для консольного режима
+        def _conversion_result_console(cam, image_paths_c, error):
+            if error is not None:
+                return {"camera": cam, "image_paths": None, "actual_size": None, "error": str(error)}
+            if image_paths_c:
+                first_img = list(image_paths_c.values())[0]
+                # Обработка ошибки чтения изображения
+                actual_size_c = read_face_size(first_img)
+                if actual_size_c is None:
+                     print(f"\nПредупреждение: Не удалось прочитать {first_img} для камеры {cam.label}")
+                     # Возвращаем ошибку, если не удалось прочитать
+                     return {"camera": cam, "image_paths": image_paths_c, "actual_size": None, "error": f"Read error for {first_img}"}
+                else:
+                     return {"camera": cam, "image_paths": image_paths_c, "actual_size": actual_size_c, "error": None}
+            else:
+                return {"camera": cam, "image_paths": None, "actual_size": None, "error": "skipped_no_faces"}
 
-            # Собираем результаты
-            conversion_completed_count_console = 0
-            for future in concurrent.futures.as_completed(futures_console):
-                result = future.result()
+        # Собираем результаты
+        conversion_completed_count_console = 0
+        try:
+            for cam, image_paths_c, error in scheduler.run(camera_jobs_console):
+                result = _conversion_result_console(cam, image_paths_c, error)
                 conversion_completed_count_console += 1
                 camera_label_c = result["camera"].label
                 if result["error"]:
@@ -2909,6 +3425,8 @@ def process_images_console():
 
                 # Обновляем прогресс бар консоли
                 console_progress_bar(conversion_completed_count_console, len(spherical_cameras), prefix=f"[{_('conversion_stage')}] ", suffix=f"{conversion_completed_count_console}/{len(spherical_cameras)}", length=40)
+        finally:
+            scheduler.shutdown()
 
         # Завершаем прогресс бар для этапа конвертации
         console_progress_bar(len(spherical_cameras), len(spherical_cameras), prefix=f"[{_('conversion_stage')}] ", suffix=f" {_('processing_complete')}", length=40)
@@ -2920,6 +3438,7 @@ def process_images_console():
         added_count_console = 0
         if total_to_add_console > 0:
             chunk_c = Metashape.app.document.chunk # Получаем чанк
+            sensor_index_c = build_sensor_index(chunk_c) # Индекс сенсоров один раз на все камеры
             for result in conversion_results_console:
                 added_count_console += 1
                 console_progress_bar(added_count_console, total_to_add_console, prefix=f"[{_('adding_cube_cameras_stage').format('', added_count_console, total_to_add_console)}] ", suffix=f"{result['camera'].label}", length=40)
@@ -2932,7 +3451,8 @@ def process_images_console():
                         spherical_camera=result["camera"],
                         image_paths=result["image_paths"],
                         persp_size=result["actual_size"],
-                        coord_system=coord_system
+                        coord_system=coord_system,
+                        sensor_index=sensor_index_c
                     )
                     processed_count += 1
                 except Exception as e:
@@ -0,0 +1,148 @@
+"""
+Карты граней right/back/left, полученные сдвигом карты front по долготе,
+совпадают с картами, построенными напрямую (unified_fixed_v002 и convert_to_cubemap_v012)
+"""
+import ast
+import importlib.util
+import os
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Допуск для float32 карт в пикселях панорамы и шаг таблицы интерполяции CV_16SC2
+FLOAT_TOLERANCE = 1e-3
+FIXED_POINT_STEP = 1.0 / cv2.INTER_TAB_SIZE
+
+# Ширина 1022 не делится на 4: сдвиг right/left на W/4 дробный
+PANORAMA_SHAPES = [(512, 1024), (511, 1022)]
+FACE_SIZE = 96
+OVERLAP = 10
+
+
+def load_unified():
+    spec = importlib.util.spec_from_file_location("unified_fixed_v002", os.path.join(REPO_DIR, "unified_fixed_v002.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_v012_map_functions():
+    """Функции карт v012 без выполнения скрипта (он импортирует Metashape и проверяет пакеты)"""
+    names = {
+        "_persp_map_buffers", "_get_persp_map_buffers", "eqruirect2persp_map", "shift_persp_map_longitude",
+        "PERSP_MAP_CACHE_LIMIT_MB", "_persp_map_cache", "_persp_map_cache_bytes", "_persp_map_cache_lock",
+        "get_persp_remap_maps",
+    }
+    path = os.path.join(REPO_DIR, "convert_to_cubemap_v012.py")
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    body = [node for node in tree.body
+            if (isinstance(node, ast.FunctionDef) and node.name in names)
+            or (isinstance(node, ast.Assign) and any(getattr(target, "id", None) in names for target in node.targets))]
+    namespace = {"np": np, "cv2": cv2, "threading": threading, "OrderedDict": OrderedDict, "_": lambda key: key}
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, "exec"), namespace)
+    return namespace
+
+
+@pytest.fixture(scope="module")
+def unified():
+    return load_unified()
+
+
+@pytest.fixture(scope="module")
+def v012():
+    return load_v012_map_functions()
+
+
+def longitude_error(map_x, reference_x, eq_width):
+    """Расхождение по долготе с учетом переноса через шов панорамы"""
+    diff = np.abs(map_x.astype(np.float64) - reference_x.astype(np.float64)) % eq_width
+    return np.minimum(diff, eq_width - diff)
+
+
+def decode_fixed_point(maps):
+    """Координаты (x, y) из карты CV_16SC2 и таблицы интерполяции"""
+    map_xy, map_interp = maps
+    interp = map_interp.astype(np.int32)
+    x = map_xy[..., 0] + (interp % cv2.INTER_TAB_SIZE) * FIXED_POINT_STEP
+    y = map_xy[..., 1] + (interp // cv2.INTER_TAB_SIZE) * FIXED_POINT_STEP
+    return x, y
+
+
+def assert_float_maps_match(maps, reference, eq_width):
+    map_x, map_y = maps
+    reference_x, reference_y = reference
+    assert map_x.dtype == np.float32
+    assert np.all((map_x >= 0) & (map_x < eq_width))
+    assert longitude_error(map_x, reference_x, eq_width).max() < FLOAT_TOLERANCE
+    assert np.abs(map_y - reference_y).max() < FLOAT_TOLERANCE
+
+
+def assert_fixed_maps_match(maps, reference, eq_width):
+    # Округление до 1/32 пикселя у производной и прямой карты может разойтись на один шаг
+    x, y = decode_fixed_point(maps)
+    reference_x, reference_y = decode_fixed_point(reference)
+    assert maps[0].dtype == np.int16
+    assert longitude_error(x, reference_x, eq_width).max() <= FIXED_POINT_STEP + FLOAT_TOLERANCE
+    assert np.abs(y - reference_y).max() <= FIXED_POINT_STEP + FLOAT_TOLERANCE
+
+
+@pytest.mark.parametrize("eq_shape", PANORAMA_SHAPES)
+def test_unified_derived_float_maps_match_direct(unified, eq_shape):
+    eq_height, eq_width = eq_shape
+    face_names = ["front", "right", "left", "top", "down", "back"]
+    derived = unified.build_cubemap_face_maps_FIXED(eq_height, eq_width, face_names, FACE_SIZE, overlap=OVERLAP)
+    for face_name in face_names:
+        direct = unified.build_cubemap_face_map_FIXED(eq_height, eq_width, face_name, FACE_SIZE, overlap=OVERLAP)
+        assert_float_maps_match(derived[face_name], direct, eq_width)
+
+
+@pytest.mark.parametrize("eq_shape", PANORAMA_SHAPES)
+@pytest.mark.parametrize("face_name", ["right", "back", "left"])
+def test_unified_derived_fixed_point_maps_match_direct(unified, eq_shape, face_name):
+    eq_height, eq_width = eq_shape
+    cache = unified.FaceMapCache(fixed_point=True)
+    maps = cache.get(eq_shape, face_name, FACE_SIZE, overlap=OVERLAP)
+    direct = unified.build_cubemap_face_map_FIXED(eq_height, eq_width, face_name, FACE_SIZE, overlap=OVERLAP)
+    assert_fixed_maps_match(maps, cv2.convertMaps(direct[0], direct[1], cv2.CV_16SC2), eq_width)
+
+
+@pytest.mark.parametrize("eq_shape", PANORAMA_SHAPES)
+@pytest.mark.parametrize("theta", [90, 180, -90])
+def test_v012_derived_float_maps_match_direct(v012, eq_shape, theta):
+    eq_width = eq_shape[1]
+    front = v012["eqruirect2persp_map"](eq_shape, 90, 0, 0, FACE_SIZE, FACE_SIZE, overlap=OVERLAP)
+    derived = v012["shift_persp_map_longitude"](front, eq_width, theta)
+    direct = v012["eqruirect2persp_map"](eq_shape, 90, theta, 0, FACE_SIZE, FACE_SIZE, overlap=OVERLAP)
+    assert_float_maps_match(derived, direct, eq_width)
+
+    cached = v012["get_persp_remap_maps"](eq_shape, 90, theta, 0, FACE_SIZE, FACE_SIZE,
+                                          overlap=OVERLAP, fixed_point=False)
+    assert_float_maps_match(cached, direct, eq_width)
+
+
+@pytest.mark.parametrize("eq_shape", PANORAMA_SHAPES)
+@pytest.mark.parametrize("theta", [90, 180, -90])
+def test_v012_derived_fixed_point_maps_match_direct(v012, eq_shape, theta):
+    eq_width = eq_shape[1]
+    front = v012["eqruirect2persp_map"](eq_shape, 90, 0, 0, FACE_SIZE, FACE_SIZE, overlap=OVERLAP)
+    front_fixed = cv2.convertMaps(front[0], front[1], cv2.CV_16SC2)
+    direct = v012["eqruirect2persp_map"](eq_shape, 90, theta, 0, FACE_SIZE, FACE_SIZE, overlap=OVERLAP)
+    direct_fixed = cv2.convertMaps(direct[0], direct[1], cv2.CV_16SC2)
+
+    derived = v012["shift_persp_map_longitude"](front_fixed, eq_width, theta)
+    cached = v012["get_persp_remap_maps"](eq_shape, 90, theta, 0, FACE_SIZE, FACE_SIZE,
+                                          overlap=OVERLAP, fixed_point=True)
+    if (theta / 360.0 * eq_width) % 1:
+        # Дробный сдвиг не переносится на целые координаты CV_16SC2: карта строится напрямую
+        assert derived is None
+        assert np.array_equal(cached[0], direct_fixed[0])
+        assert np.array_equal(cached[1], direct_fixed[1])
+    else:
+        assert_fixed_maps_match(derived, direct_fixed, eq_width)
+        assert_fixed_maps_match(cached, direct_fixed, eq_width)
@@ -0,0 +1,90 @@
+"""
+Разбор заголовков изображений: копии в unified_fixed_v002 и convert_to_cubemap_v012
+совпадают слово в слово и читают размеры так же, как декодер OpenCV
+"""
+import ast
+import importlib.util
+import os
+import struct
+
+import cv2
+import numpy as np
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Первая строка общего блока и строка, следующая за ним в каждом из файлов
+BLOCK_START = "# Маркеры SOF (начало кадра) JPEG"
+BLOCK_END = {
+    "unified_fixed_v002.py": "def read_jpeg_size_FIXED(",
+    "convert_to_cubemap_v012.py": "def read_image_header(",
+}
+
+# (высота, ширина, каналы) тестовых изображений
+IMAGE_SHAPES = [(37, 75, 3), (40, 21, 1), (16, 33, 4)]
+
+
+def read_source(file_name):
+    with open(os.path.join(REPO_DIR, file_name), "rb") as f:
+        return f.read().decode("utf-8").replace("\r\n", "\n")
+
+
+def header_block(file_name):
+    source = read_source(file_name)
+    start = source.index(BLOCK_START)
+    return source[start:source.index(BLOCK_END[file_name], start)]
+
+
+def load_v012_header_functions():
+    """Функции разбора заголовков v012 без выполнения скрипта (он импортирует Metashape)"""
+    names = {"read_image_header"}
+    path = os.path.join(REPO_DIR, "convert_to_cubemap_v012.py")
+    tree = ast.parse(read_source("convert_to_cubemap_v012.py"))
+    body = [node for node in tree.body
+            if (isinstance(node, ast.FunctionDef) and node.name in names)]
+    namespace = {"os": os, "struct": struct, "normalize_path": lambda path: path}
+    exec(header_block("convert_to_cubemap_v012.py"), namespace)
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, "exec"), namespace)
+    return namespace
+
+
+@pytest.fixture(scope="module")
+def unified():
+    spec = importlib.util.spec_from_file_location("unified_fixed_v002", os.path.join(REPO_DIR, "unified_fixed_v002.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="module")
+def v012():
+    return load_v012_header_functions()
+
+
+def test_header_parsers_are_identical():
+    assert header_block("unified_fixed_v002.py") == header_block("convert_to_cubemap_v012.py")
+
+
+@pytest.mark.parametrize("extension,image_format", [(".jpg", "jpeg"), (".png", "png"), (".tif", "tiff")])
+@pytest.mark.parametrize("shape", IMAGE_SHAPES)
+def test_header_matches_decoded_image(unified, v012, tmp_path, extension, image_format, shape):
+    height, width, channels = shape
+    if extension == ".jpg" and channels == 4:
+        pytest.skip("JPEG не хранит альфа-канал")
+    image = np.random.default_rng(0).integers(0, 255, shape, dtype=np.uint8)
+    path = str(tmp_path / ("image" + extension))
+    assert cv2.imwrite(path, image[..., 0] if channels == 1 else image)
+
+    assert unified.probe_image_header_FIXED(path) == (image_format, width, height, channels)
+    assert v012["read_image_header"](path) == (width, height, channels)
+
+
+def test_unknown_or_truncated_header(unified, v012, tmp_path):
+    path = tmp_path / "image.jpg"
+    assert cv2.imwrite(str(path), np.zeros((8, 8, 3), dtype=np.uint8))
+    path.write_bytes(path.read_bytes()[:4])
+    (tmp_path / "image.bmp").write_bytes(b"BM" + bytes(64))
+
+    for name in ("image.jpg", "image.bmp", "missing.png"):
+        assert unified.probe_image_header_FIXED(str(tmp_path / name)) is None
+        assert v012["read_image_header"](str(tmp_path / name)) is None
@@ -0,0 +1,90 @@
+"""
+Потоковая запись облака (TiePointCloudStream) дает те же points3D.bin и images.bin,
+что и запись облака, извлеченного целиком (unified_fixed_v002)
+"""
+import contextlib
+import importlib.util
+import io
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+POINT_COUNT = 5000
+CAMERA_COUNT = 3
+PROJECTIONS_PER_CAMERA = 3000
+# Порция меньше облака: наблюдения собираются по нескольким порциям
+STREAM_CHUNK_SIZE = 700
+FACE_SIZE = 256
+OVERLAP = 10
+
+
+@pytest.fixture(scope="module")
+def unified():
+    spec = importlib.util.spec_from_file_location("unified_fixed_v002", os.path.join(REPO_DIR, "unified_fixed_v002.py"))
+    module = importlib.util.module_from_spec(spec)
+    with contextlib.redirect_stdout(io.StringIO()):
+        spec.loader.exec_module(module)
+    return module
+
+
+def make_scene(unified, projections_mode):
+    """Чанк с перемешанными track_id, серыми и цветными точками и сферические камеры"""
+    rng = np.random.default_rng(1)
+    track_ids = rng.permutation(POINT_COUNT)
+    points = [SimpleNamespace(valid=(idx % 7 != 0), track_id=int(track_ids[idx]), error=float(rng.random()),
+                              coord=SimpleNamespace(x=float(rng.normal() * 5), y=float(rng.normal() * 5),
+                                                    z=float(rng.normal() * 5)))
+              for idx in range(POINT_COUNT)]
+    tracks = [SimpleNamespace(color=(120 + idx % 16,) * 3 if idx % 3 == 0 else (idx % 256, 10, 20))
+              for idx in range(POINT_COUNT)]
+    cameras = [unified.ManifestCamera(f"pano{idx}", f"/pano{idx}.jpg",
+                                      np.r_[np.c_[np.eye(3), rng.normal(size=3) * 0.5], [[0, 0, 0, 1]]])
+               for idx in range(CAMERA_COUNT)]
+    if projections_mode == "tracks":
+        projections = {camera: [SimpleNamespace(track_id=int(track_id))
+                                for track_id in rng.choice(POINT_COUNT, PROJECTIONS_PER_CAMERA, replace=False)]
+                       for camera in cameras}
+    elif projections_mode == "empty":
+        projections = {camera: [] for camera in cameras}
+    else:
+        projections = {}
+    chunk = SimpleNamespace(tie_points=SimpleNamespace(points=points, tracks=tracks, projections=projections))
+    results = [{'camera': camera, 'face_size_actual': FACE_SIZE,
+                'face_images': {face: f"/faces/{camera.label}_{face}.jpg" for face in unified.COLMAP_FACE_NAMES}}
+               for camera in cameras]
+    return chunk, cameras, results
+
+
+@pytest.mark.parametrize("point_tracks", [True, False])
+@pytest.mark.parametrize("projections_mode", ["tracks", "empty", "missing"])
+def test_stream_matches_in_memory_export(unified, tmp_path, point_tracks, projections_mode):
+    chunk, cameras, results = make_scene(unified, projections_mode)
+    with contextlib.redirect_stdout(io.StringIO()):
+        cloud = unified.extract_colored_point_cloud_FIXED(chunk)
+        if point_tracks:
+            cloud.update(unified.extract_point_observations_FIXED(chunk, cloud, cameras))
+        _, images, face_image_ids = unified.build_colmap_model_FIXED(results, OVERLAP)
+        if point_tracks:
+            unified.attach_point_tracks_FIXED(cloud, images, results, face_image_ids, cameras, OVERLAP)
+        unified.write_points3D_binary(cloud, str(tmp_path / "points3D_memory.bin"))
+        unified.write_images_binary(images, str(tmp_path / "images_memory.bin"))
+
+        _, images, face_image_ids = unified.build_colmap_model_FIXED(results, OVERLAP)
+        stream = unified.TiePointCloudStream(chunk, cameras, point_tracks=point_tracks, chunk_size=STREAM_CHUNK_SIZE)
+        point_count, colored_points = unified.write_points3D_stream_FIXED(
+            stream, str(tmp_path / "points3D_stream.bin"), images, results, face_image_ids, cameras, OVERLAP,
+            point_tracks=point_tracks
+        )
+        unified.write_images_binary(images, str(tmp_path / "images_stream.bin"))
+
+    assert point_count == len(cloud['ids'])
+    assert colored_points == unified.count_colored_points_FIXED(cloud['rgb'])
+    assert colored_points < point_count
+    for name in ("points3D", "images"):
+        memory = (tmp_path / f"{name}_memory.bin").read_bytes()
+        streamed = (tmp_path / f"{name}_stream.bin").read_bytes()
+        assert memory == streamed
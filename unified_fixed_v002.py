@@ -4,15 +4,30 @@
 # ВЕРСИЯ: 2.0 - ВСЕ БАГИ ИСПРАВЛЕНЫ!
 
 import os
+import argparse
+import csv
+import json
 import shutil
 import struct
 import math
+import sys
 import numpy as np
 import cv2
-import Metashape
 import concurrent.futures
+import multiprocessing
+from multiprocessing import shared_memory
 import time
 import gc
+import itertools
+import threading
+import queue
+from collections import OrderedDict
+
+try:
+    import Metashape
+except ImportError:
+    # Дочерним процессам пула remap Metashape не нужен
+    Metashape = None
 
 print("=== 🎯 ИСПРАВЛЕННЫЙ Unified Spherical to 3DGS Converter ===")
 print("Версия: 2.0 - ВСЕ ПРОБЛЕМЫ ГЕОМЕТРИИ И ЦВЕТОВ ИСПРАВЛЕНЫ!")
@@ -77,22 +92,212 @@ def rotation_matrix_to_quaternion(R):
     quat = quat / np.linalg.norm(quat)
     return quat.tolist()
 
+def rotation_matrices_to_quaternions(R):
+    """Пакетная версия rotation_matrix_to_quaternion: (M,3,3) → (M,4) quaternions (qw, qx, qy, qz)"""
+    R = np.asarray(R, dtype=float).reshape(-1, 3, 3)
+    m00, m01, m02 = R[:, 0, 0], R[:, 0, 1], R[:, 0, 2]
+    m10, m11, m12 = R[:, 1, 0], R[:, 1, 1], R[:, 1, 2]
+    m20, m21, m22 = R[:, 2, 0], R[:, 2, 1], R[:, 2, 2]
+    trace = m00 + m11 + m22
+    
+    # Те же ветви, что и в скалярной версии
+    branch_w = trace > 0
+    branch_x = ~branch_w & (m00 > m11) & (m00 > m22)
+    branch_y = ~branch_w & ~branch_x & (m11 > m22)
+    branch_z = ~(branch_w | branch_x | branch_y)
+    
+    quat = np.empty((len(R), 4), dtype=float)
+    
+    b = branch_w
+    s = 0.5 / np.sqrt(trace[b] + 1.0)
+    quat[b] = np.stack([0.25 / s, (m21[b] - m12[b]) * s, (m02[b] - m20[b]) * s, (m10[b] - m01[b]) * s], axis=1)
+    
+    b = branch_x
+    s = 2.0 * np.sqrt(1.0 + m00[b] - m11[b] - m22[b])
+    quat[b] = np.stack([(m21[b] - m12[b]) / s, 0.25 * s, (m01[b] + m10[b]) / s, (m02[b] + m20[b]) / s], axis=1)
+    
+    b = branch_y
+    s = 2.0 * np.sqrt(1.0 + m11[b] - m00[b] - m22[b])
+    quat[b] = np.stack([(m02[b] - m20[b]) / s, (m01[b] + m10[b]) / s, 0.25 * s, (m12[b] + m21[b]) / s], axis=1)
+    
+    b = branch_z
+    s = 2.0 * np.sqrt(1.0 + m22[b] - m00[b] - m11[b])
+    quat[b] = np.stack([(m10[b] - m01[b]) / s, (m02[b] + m20[b]) / s, (m12[b] + m21[b]) / s, 0.25 * s], axis=1)
+    
+    return quat / np.linalg.norm(quat, axis=1, keepdims=True)
+
 # === ФУНКЦИИ РАБОТЫ С ИЗОБРАЖЕНИЯМИ ===
-def read_image_safe(path):
-    """Безопасное чтение изображения с поддержкой кириллицы"""
+# Флаги декодирования JPEG в 1/2, 1/4, 1/8 разрешения (масштабирование DCT в libjpeg)
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
+def read_image_safe(path, reduction=1):
+    """
+    Безопасное чтение изображения с поддержкой кириллицы
+    
+    Args:
+        path: путь к изображению
+        reduction: 1, 2, 4 или 8 - декодирование в уменьшенном разрешении (IMREAD_REDUCED_COLOR_*)
+    """
+    flags = REDUCED_DECODE_FLAGS[reduction]
     try:
         # Для Windows используем обходной путь через буфер
         if os.name == 'nt':
             with open(path, 'rb') as f:
                 img_content = bytearray(f.read())
             np_arr = np.asarray(img_content, dtype=np.uint8)
-            return cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
+            return cv2.imdecode(np_arr, flags)
         else:
-            return cv2.imread(path)
+            return cv2.imread(path, flags)
     except Exception as e:
         print(f"❌ Ошибка чтения изображения {path}: {e}")
         return None
 
+# --- Разбор заголовков изображений ---
+# Блок до read_jpeg_size_FIXED продублирован в convert_to_cubemap_v012.py слово в слово
+# (скрипт для Metashape самодостаточен); tests/test_image_header.py сверяет копии
+# Маркеры SOF (начало кадра) JPEG: содержат размеры изображения
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Сигнатура PNG и число каналов по типу цвета из IHDR (палитра декодируется в BGR)
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_COLOR_TYPE_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+# Порядок байт TIFF по сигнатуре и теги IFD: ширина, высота, каналы (BigTIFF не поддерживается)
+TIFF_BYTE_ORDERS = {b'II*\x00': '<', b'MM\x00*': '>'}
+TIFF_SIZE_TAGS = (256, 257, 277)
+
+def _read_jpeg_header_FIXED(f):
+    """(ширина, высота, каналы) из маркера SOF; файл открыт после сигнатуры SOI"""
+    while True:
+        prefix = f.read(1)
+        if prefix != b'\xff':
+            return None
+        marker = f.read(1)
+        while marker == b'\xff':  # Байты заполнения перед маркером
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker = marker[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue  # Маркеры без длины
+        segment_length = struct.unpack('>H', f.read(2))[0]
+        if marker in JPEG_SOF_MARKERS:
+            height, width, channels = struct.unpack('>xHHB', f.read(6))
+            return width, height, channels
+        if marker == 0xDA:  # Начало сжатых данных, SOF не найден
+            return None
+        f.seek(segment_length - 2, os.SEEK_CUR)
+
+def _read_png_header_FIXED(f):
+    """(ширина, высота, каналы) из блока IHDR; файл открыт после сигнатуры PNG"""
+    length, chunk_type = struct.unpack('>I4s', f.read(8))
+    if chunk_type != b'IHDR' or length < 13:
+        return None
+    width, height, _, color_type = struct.unpack('>IIBB', f.read(10))
+    channels = PNG_COLOR_TYPE_CHANNELS.get(color_type)
+    return (width, height, channels) if channels else None
+
+def _read_tiff_header_FIXED(f, byte_order):
+    """(ширина, высота, каналы) из первого IFD; файл открыт после сигнатуры TIFF"""
+    f.seek(struct.unpack(byte_order + 'I', f.read(4))[0])
+    entry_count = struct.unpack(byte_order + 'H', f.read(2))[0]
+    entries = f.read(entry_count * 12)
+    tags = {}
+    for offset in range(0, len(entries) - 11, 12):
+        tag, value_type, count = struct.unpack_from(byte_order + 'HHI', entries, offset)
+        if tag in TIFF_SIZE_TAGS and count == 1 and value_type in (3, 4):
+            # SHORT или LONG помещается в поле значения записи
+            tags[tag] = struct.unpack_from(byte_order + ('H' if value_type == 3 else 'I'), entries, offset + 8)[0]
+    if 256 not in tags or 257 not in tags:
+        return None
+    return tags[256], tags[257], tags.get(277, 1)
+
+def probe_image_header_FIXED(path):
+    """
+    Читает формат, размеры и число каналов изображения по заголовку, без декодирования
+    
+    Разбирает маркер SOF JPEG, блок IHDR PNG или первый IFD TIFF - обычно
+    несколько сотен байт вместо десятков мегабайт декодированной панорамы.
+    
+    Returns:
+        (format, width, height, channels) - format: 'jpeg', 'png' или 'tiff';
+        None, если формат не распознан или заголовок поврежден
+    """
+    try:
+        with open(path, 'rb') as f:
+            signature = f.read(8)
+            if signature[:2] == b'\xff\xd8':
+                f.seek(2)
+                image_format, header = 'jpeg', _read_jpeg_header_FIXED(f)
+            elif signature == PNG_SIGNATURE:
+                image_format, header = 'png', _read_png_header_FIXED(f)
+            elif signature[:4] in TIFF_BYTE_ORDERS:
+                f.seek(4)
+                image_format, header = 'tiff', _read_tiff_header_FIXED(f, TIFF_BYTE_ORDERS[signature[:4]])
+            else:
+                return None
+    except (OSError, struct.error):
+        return None
+    if header is None or not header[0] or not header[1]:
+        return None
+    return (image_format,) + header
+
+def read_jpeg_size_FIXED(path):
+    """
+    Читает (ширина, высота) JPEG из маркера SOF без декодирования
+    
+    Returns:
+        (width, height) или None, если файл не JPEG или заголовок поврежден
+    """
+    header = probe_image_header_FIXED(path)
+    if header is None or header[0] != 'jpeg':
+        return None
+    return header[1], header[2]
+
+def select_decode_reduction_FIXED(eq_width, face_size, fov=90, overlap=10):
+    """
+    Наибольший делитель разрешения (8, 4, 2 или 1), при котором панорама не реже выборки грани
+    
+    Самая плотная выборка грани - у ее края: focal / cos²(FOV/2) пикселей на радиан.
+    Панорама шириной W дает W / 2π пикселей на радиан по вертикали (по горизонтали
+    не меньше), поэтому уменьшение выбирается так, чтобы этого хватало для края грани:
+    детализация граней не теряется, а DCT-масштабирование libjpeg сглаживает источник.
+    """
+    half_fov = np.radians((fov + overlap) / 2)
+    focal = face_size / (2 * np.tan(half_fov))
+    required_width = 2 * np.pi * focal / np.cos(half_fov) ** 2
+    for reduction in (8, 4, 2):
+        if eq_width / reduction >= required_width:
+            return reduction
+    return 1
+
+def read_spherical_image_FIXED(path, face_size=None, overlap=10, reduced_decode=True):
+    """
+    Читает панораму и определяет размер граней
+    
+    Для JPEG ширина берется из заголовка, и при грани намного меньше панорамы
+    файл декодируется сразу в уменьшенном разрешении (select_decode_reduction_FIXED).
+    Размер граней всегда считается по полной ширине панорамы.
+    
+    Returns:
+        (image, actual_face_size) или (None, None)
+    """
+    jpeg_size = read_jpeg_size_FIXED(path) if reduced_decode else None
+    if jpeg_size is None:
+        image = read_image_safe(path)
+        if image is None:
+            return None, None
+        return image, select_face_size_FIXED(image.shape[1], face_size)
+    
+    actual_face_size = select_face_size_FIXED(jpeg_size[0], face_size)
+    reduction = select_decode_reduction_FIXED(jpeg_size[0], actual_face_size, overlap=overlap)
+    image = read_image_safe(path, reduction)
+    if image is None:
+        return None, None
+    return image, actual_face_size
+
 def save_image_safe(image, path, params=None):
     """Безопасное сохранение изображения с поддержкой кириллицы"""
     try:
@@ -113,27 +318,56 @@ def save_image_safe(image, path, params=None):
         print(f"❌ Ошибка сохранения изображения {path}: {e}")
         return False
 
+# Уменьшенные копии граней для обучения 3DGS с -r 2/4/8 (папки images_2, images_4, images_8)
+DEFAULT_DOWNSCALE_FACTORS = (2, 4, 8)
+
+def downscaled_images_folder_FIXED(images_folder, factor):
+    """Папка уменьшенных граней рядом с images/: images_2, images_4, ..."""
+    return os.path.join(os.path.dirname(images_folder), f"{os.path.basename(images_folder)}_{factor}")
+
+def save_face_image_FIXED(face_image, images_folder, filename, save_params=None, downscales=()):
+    """
+    Сохраняет грань и ее уменьшенные копии из той же грани в памяти
+    
+    Каждая копия получается из предыдущей через cv2.INTER_AREA, поэтому
+    повторно читать записанные JPEG для images_2/4/8 не нужно.
+    
+    Returns:
+        str: путь к грани полного размера или None
+    """
+    output_path = os.path.join(images_folder, filename)
+    if not save_image_safe(face_image, output_path, save_params):
+        return None
+    
+    height, width = face_image.shape[:2]
+    scaled_image = face_image
+    for factor in sorted(downscales):
+        scaled_size = (max(1, int(round(width / factor))), max(1, int(round(height / factor))))
+        scaled_image = cv2.resize(scaled_image, scaled_size, interpolation=cv2.INTER_AREA)
+        scaled_path = os.path.join(downscaled_images_folder_FIXED(images_folder, factor), filename)
+        if not save_image_safe(scaled_image, scaled_path, save_params):
+            print(f"⚠️  Не удалось сохранить уменьшенную грань {scaled_path}")
+    return output_path
+
 # === ИСПРАВЛЕННАЯ КОНВЕРТАЦИЯ ЭКВИРЕКТАНГУЛЯРНОЙ ПРОЕКЦИИ ===
-def equirectangular_to_cubemap_face_FIXED(equirect_image, face_name, face_size, fov=90, overlap=10):
+def build_cubemap_face_map_FIXED(eq_height, eq_width, face_name, face_size, fov=90, overlap=10):
     """
-    ПОЛНОСТЬЮ ИСПРАВЛЕННАЯ конвертация эквиректангулярной проекции в грань куба
+    Строит карты отображения (map_x, map_y) для одной грани куба
+    
+    Карты зависят только от размера эквиректангулярного изображения и параметров
+    грани, поэтому их можно вычислить один раз и использовать для всех камер
     
     Args:
-        equirect_image: исходное сферическое изображение
+        eq_height, eq_width: размер исходного сферического изображения
         face_name: имя грани ('front', 'back', 'left', 'right', 'top', 'down')
         face_size: размер выходного изображения (квадратное)
         fov: базовое поле зрения в градусах
         overlap: дополнительное перекрытие в градусах
     
     Returns:
-        perspective_image: результирующее изображение грани
+        (map_x, map_y): карты float32 для cv2.remap или None для неизвестной грани
     """
     
-    if equirect_image is None:
-        return None
-    
-    eq_height, eq_width = equirect_image.shape[:2]
-    
     # Эффективное поле зрения с перекрытием
     effective_fov = fov + overlap
     half_fov_rad = np.radians(effective_fov / 2)
@@ -220,418 +454,2560 @@ def equirectangular_to_cubemap_face_FIXED(equirect_image, face_name, face_size,
     # Ограничиваем Y координаты границами изображения
     eq_y = np.clip(eq_y, 0, eq_height - 1)
     
+    return eq_x.astype(np.float32), eq_y.astype(np.float32)
+
+# Грани экватора повернуты вокруг вертикальной оси на 0°, 90°, 180° и 270°: широта
+# у них одна и та же, а долгота отличается от front на четверть оборота (W/4 пикселей)
+HORIZONTAL_FACE_QUARTER_TURNS = {'front': 0, 'right': 1, 'back': 2, 'left': 3}
+
+def shift_face_map_longitude_FIXED(maps, eq_width, quarter_turns):
+    """
+    Карта грани экватора из карты front: сдвиг по долготе на quarter_turns * W/4 с переносом
+    
+    Returns:
+        (map_x, map_y): map_y общая с исходной картой
+    """
+    map_x, map_y = maps
+    shifted = np.add(map_x, eq_width * quarter_turns / 4, dtype=np.float64)
+    np.mod(shifted, eq_width, out=shifted)
+    return shifted.astype(np.float32), map_y
+
+def build_cubemap_face_maps_FIXED(eq_height, eq_width, face_names, face_size, fov=90, overlap=10, front_maps=None):
+    """
+    Строит карты нескольких граней с учетом симметрии куба
+    
+    front, top и down считаются build_cubemap_face_map_FIXED, right, back и left
+    получаются из карты front сдвигом по долготе - тригонометрия считается
+    не больше трех раз вместо шести.
+    
+    Args:
+        front_maps: уже готовая карта front (например, из дискового кэша)
+    
+    Returns:
+        dict: {face_name: (map_x, map_y) или None для неизвестной грани}
+    """
+    face_maps = {}
+    for face_name in face_names:
+        quarter_turns = HORIZONTAL_FACE_QUARTER_TURNS.get(face_name)
+        if quarter_turns is None:
+            face_maps[face_name] = build_cubemap_face_map_FIXED(eq_height, eq_width, face_name, face_size, fov, overlap)
+            continue
+        if front_maps is None:
+            front_maps = build_cubemap_face_map_FIXED(eq_height, eq_width, 'front', face_size, fov, overlap)
+        face_maps[face_name] = (front_maps if quarter_turns == 0
+                                else shift_face_map_longitude_FIXED(front_maps, eq_width, quarter_turns))
+    return face_maps
+
+class FaceMapCache:
+    """
+    Кэш карт проекции граней: LRU в памяти + опциональное хранилище .npy на диске
+    
+    Ключ кэша: (высота и ширина эквиректангулярного изображения, грань,
+    размер грани, fov, перекрытие). Все камеры рига обычно имеют одинаковое
+    разрешение, поэтому карты строятся один раз на весь чанк.
+    
+    В режиме fixed_point карты один раз переводятся через cv2.convertMaps в
+    формат CV_16SC2 + таблица интерполяции: cv2.remap работает быстрее,
+    а карта занимает в памяти на четверть меньше (6 байт на пиксель вместо 8).
+    На диске всегда хранятся исходные float32 карты.
+    """
+    
+    def __init__(self, max_megabytes=1024, disk_folder=None, fixed_point=False):
+        self.max_bytes = int(max_megabytes * 1024 * 1024)
+        self.disk_folder = disk_folder
+        self.fixed_point = fixed_point
+        self._entries = OrderedDict()
+        self._size_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        
+        if disk_folder:
+            os.makedirs(disk_folder, exist_ok=True)
+    
+    @staticmethod
+    def make_key(eq_shape, face_name, face_size, fov=90, overlap=10):
+        """Формирует ключ кэша из параметров грани"""
+        return (int(eq_shape[0]), int(eq_shape[1]), face_name, int(face_size), float(fov), float(overlap))
+    
+    def _disk_path(self, key):
+        eq_height, eq_width, face_name, face_size, fov, overlap = key
+        filename = f"map_{eq_width}x{eq_height}_{face_name}_{face_size}px_fov{fov:g}_ov{overlap:g}.npy"
+        return os.path.join(self.disk_folder, filename)
+    
+    def _load_from_disk(self, key):
+        if not self.disk_folder:
+            return None
+        path = self._disk_path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            stacked = np.load(path)
+            return stacked[0], stacked[1]
+        except Exception as e:
+            print(f"⚠️  Не удалось прочитать карту из кэша {path}: {e}")
+            return None
+    
+    def _save_to_disk(self, key, maps):
+        if not self.disk_folder:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            # Пишем во временный файл и переименовываем - параллельные потоки не увидят половину файла
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.stack(maps))
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"⚠️  Не удалось сохранить карту в кэш {path}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def _lookup(self, key):
+        with self._lock:
+            maps = self._entries.get(key)
+            if maps is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return maps
+    
+    def _insert(self, key, maps):
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = maps
+                self._size_bytes += sum(m.nbytes for m in maps)
+            self._entries.move_to_end(key)
+            # Вытесняем самые старые карты, но всегда оставляем текущую
+            while self._size_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self._size_bytes -= sum(m.nbytes for m in evicted)
+            return self._entries[key]
+    
+    def _build_float_faces(self, eq_shape, face_names, face_size, fov=90, overlap=10):
+        """
+        Загружает float32 карты граней с диска или строит недостающие (build_cubemap_face_maps_FIXED)
+        
+        Returns:
+            list: карты в порядке face_names или None, если есть неизвестная грань
+        """
+        keys = {face_name: self.make_key(eq_shape, face_name, face_size, fov, overlap) for face_name in face_names}
+        face_maps = {}
+        missing = []
+        for face_name, key in keys.items():
+            maps = self._load_from_disk(key)
+            if maps is not None:
+                self.disk_hits += 1
+                face_maps[face_name] = maps
+            else:
+                missing.append(face_name)
+        
+        if missing:
+            built = build_cubemap_face_maps_FIXED(eq_shape[0], eq_shape[1], missing, face_size, fov, overlap,
+                                                  front_maps=face_maps.get('front'))
+            for face_name in missing:
+                maps = built[face_name]
+                if maps is None:
+                    return None
+                self.misses += 1
+                self._save_to_disk(keys[face_name], maps)
+                face_maps[face_name] = maps
+        
+        return [face_maps[face_name] for face_name in face_names]
+    
+    def _build_float(self, key):
+        """Загружает float32 карту с диска или строит заново"""
+        eq_height, eq_width, face_name, face_size, fov, overlap = key
+        face_maps = self._build_float_faces((eq_height, eq_width), [face_name], face_size, fov, overlap)
+        return face_maps[0] if face_maps else None
+    
+    def _build(self, key):
+        """Загружает карту с диска или строит заново (без помещения в память кэша)"""
+        maps = self._build_float(key)
+        if maps is not None and self.fixed_point:
+            maps = cv2.convertMaps(maps[0], maps[1], cv2.CV_16SC2)
+        return maps
+    
+    def get(self, eq_shape, face_name, face_size, fov=90, overlap=10):
+        """
+        Возвращает карты грани, строя их только при промахе кэша
+        
+        Returns:
+            (map_x, map_y) float32 или (map_xy, map_interp) в режиме fixed_point -
+            обе пары передаются в cv2.remap одинаково
+        """
+        key = self.make_key(eq_shape, face_name, face_size, fov, overlap)
+        
+        maps = self._lookup(key)
+        if maps is not None:
+            return maps
+        
+        # Построение карты идет вне блокировки, чтобы не останавливать другие потоки
+        maps = self._build(key)
+        if maps is None:
+            return None
+        return self._insert(key, maps)
+    
+    def get_atlas(self, eq_shape, face_names, face_size, fov=90, overlap=10):
+        """
+        Возвращает карты атласа: карты граней, уложенные друг под другом
+        в полосу (len(face_names) * face_size) x face_size
+        
+        В памяти хранится только атлас, отдельные карты граней не дублируются.
+        """
+        atlas_key = self.make_key(eq_shape, tuple(face_names), face_size, fov, overlap)
+        
+        maps = self._lookup(atlas_key)
+        if maps is not None:
+            return maps
+        
+        face_maps = {}
+        for face_name in face_names:
+            maps = self._lookup(self.make_key(eq_shape, face_name, face_size, fov, overlap))
+            if maps is not None:
+                face_maps[face_name] = maps
+        
+        # Недостающие грани строятся вместе: карта front считается один раз
+        missing = [face_name for face_name in face_names if face_name not in face_maps]
+        if missing:
+            built = self._build_float_faces(eq_shape, missing, face_size, fov, overlap)
+            if built is None:
+                return None
+            for face_name, maps in zip(missing, built):
+                face_maps[face_name] = cv2.convertMaps(maps[0], maps[1], cv2.CV_16SC2) if self.fixed_point else maps
+        
+        atlas_maps = tuple(np.concatenate([face_maps[face_name][i] for face_name in face_names], axis=0)
+                           for i in range(2))
+        return self._insert(atlas_key, atlas_maps)
+    
+    def get_mip_atlas(self, eq_shape, face_names, face_size, fov=90, overlap=10):
+        """
+        Возвращает план remap атласа из пирамиды панорамы (build_mip_plan_FIXED)
+        
+        Returns:
+            (order, bounds, row_bounds, codes, map_a, map_b) или None
+        """
+        plan_key = self.make_key(eq_shape, ('mip',) + tuple(face_names), face_size, fov, overlap)
+        
+        plan = self._lookup(plan_key)
+        if plan is not None:
+            return plan
+        
+        face_maps = self._build_float_faces(eq_shape, face_names, face_size, fov, overlap)
+        if face_maps is None:
+            return None
+        
+        plan = build_mip_plan_FIXED(
+            np.concatenate([maps[0] for maps in face_maps], axis=0),
+            np.concatenate([maps[1] for maps in face_maps], axis=0),
+            eq_shape, face_size, fixed_point=self.fixed_point
+        )
+        return self._insert(plan_key, plan)
+    
+    def stats(self):
+        """Строка статистики для логов"""
+        return (f"карт в памяти: {len(self._entries)} ({self._size_bytes / (1024 * 1024):.0f} МБ), "
+                f"попаданий: {self.hits}, с диска: {self.disk_hits}, построено: {self.misses}")
+
+def equirectangular_to_cubemap_face_FIXED(equirect_image, face_name, face_size, fov=90, overlap=10, map_cache=None):
+    """
+    ПОЛНОСТЬЮ ИСПРАВЛЕННАЯ конвертация эквиректангулярной проекции в грань куба
+    
+    Args:
+        equirect_image: исходное сферическое изображение
+        face_name: имя грани ('front', 'back', 'left', 'right', 'top', 'down')
+        face_size: размер выходного изображения (квадратное)
+        fov: базовое поле зрения в градусах
+        overlap: дополнительное перекрытие в градусах
+        map_cache: FaceMapCache для повторного использования карт (None = строить заново)
+    
+    Returns:
+        perspective_image: результирующее изображение грани
+    """
+    
+    if equirect_image is None:
+        return None
+    
+    eq_shape = equirect_image.shape[:2]
+    
+    if map_cache is not None:
+        maps = map_cache.get(eq_shape, face_name, face_size, fov, overlap)
+    else:
+        maps = build_cubemap_face_maps_FIXED(eq_shape[0], eq_shape[1], [face_name], face_size, fov, overlap)[face_name]
+    
+    if maps is None:
+        return None
+    
+    map_x, map_y = maps
+    
     # Интерполируем цвета из исходного изображения
     perspective_image = cv2.remap(
         equirect_image,
-        eq_x.astype(np.float32),
-        eq_y.astype(np.float32),
+        map_x,
+        map_y,
         cv2.INTER_CUBIC,
         borderMode=cv2.BORDER_WRAP  # Циклическое повторение по X
     )
     
     return perspective_image
 
-# === ИСПРАВЛЕННОЕ ИЗВЛЕЧЕНИЕ ЦВЕТНОГО ОБЛАКА ===
-def extract_colored_point_cloud_FIXED(chunk, max_points=None):
+def equirectangular_to_cubemap_atlas_FIXED(equirect_image, face_names, face_size, map_cache, fov=90, overlap=10, out=None):
     """
-    ИСПРАВЛЕННОЕ извлечение цветного разреженного облака из Metashape
-    Правильно обрабатывает все возможные форматы цветов
-    """
-    print("=== 🎨 Извлечение цветного разреженного облака (ИСПРАВЛЕННАЯ версия) ===")
+    Конвертация всех выбранных граней за один вызов cv2.remap
     
-    if not chunk.tie_points:
-        print("❌ Разреженное облако отсутствует!")
-        return {}
+    Грани укладываются друг под другом в полосу (N * face_size) x face_size,
+    поэтому каждая грань - непрерывный срез буфера без копирования.
+    Исходное изображение обходится один раз вместо шести.
     
-    points3D = {}
-    total_points = len(chunk.tie_points.points)
-    valid_points = 0
-    colored_points = 0
+    Args:
+        equirect_image: исходное сферическое изображение
+        face_names: список граней в порядке укладки в атлас
+        face_size: размер грани
+        map_cache: FaceMapCache с картами атласа
+        fov: базовое поле зрения в градусах
+        overlap: дополнительное перекрытие в градусах
+        out: заранее выделенный буфер атласа (None = выделить новый)
     
-    print(f"📊 Всего точек в облаке: {total_points}")
+    Returns:
+        (atlas, {face_name: view}) или (None, {}) при ошибке
+    """
     
-    # Ограничение точек если нужно
-    if max_points and total_points > max_points:
-        step = max(1, total_points // max_points)
-        print(f"🔄 Используем каждую {step}-ю точку (ограничение: {max_points})")
-    else:
-        step = 1
+    if equirect_image is None or not face_names:
+        return None, {}
     
-    # Собираем информацию о структуре цветов для диагностики
-    color_formats_found = set()
+    maps = map_cache.get_atlas(equirect_image.shape[:2], face_names, face_size, fov, overlap)
+    if maps is None:
+        return None, {}
     
-    for point_idx, point in enumerate(chunk.tie_points.points):
-        if not point.valid:
-            continue
-        
-        # Применяем прореживание если нужно
-        if step > 1 and (point_idx % step != 0):
-            continue
-            
-        valid_points += 1
-        point3D_id = point_idx + 1  # COLMAP использует 1-based индексы
-        
-        # Координаты точки
-        coord = point.coord
-        xyz = [float(coord.x), float(coord.y), float(coord.z)]
-        
-        # === ПРАВИЛЬНОЕ ИЗВЛЕЧЕНИЕ ЦВЕТА ===
-        rgb = [128, 128, 128]  # Серый по умолчанию
-        color_found = False
-        
-        try:
-            # Метод 1: Прямой доступ к point.color
-            if hasattr(point, 'color') and point.color is not None:
-                color = point.color
-                color_formats_found.add(f"point.color: {type(color)}")
-                
-                # Обработка разных типов цветов
-                if isinstance(color, (list, tuple, np.ndarray)) and len(color) >= 3:
-                    # Список/массив цветов
-                    max_val = max(color[:3])
-                    if max_val <= 1.0:
-                        # Цвета в диапазоне [0, 1]
-                        rgb = [int(255 * c) for c in color[:3]]
-                    elif max_val <= 255.0:
-                        # Цвета в диапазоне [0, 255]
-                        rgb = [int(c) for c in color[:3]]
-                    else:
-                        # Неожиданный диапазон - нормализуем
-                        rgb = [int(255 * c / max_val) for c in color[:3]]
-                    color_found = True
-                    
-                elif hasattr(color, '__len__') and len(color) >= 3:
-                    # Объект с итерируемыми компонентами
-                    try:
-                        color_list = list(color[:3])
-                        max_val = max(color_list)
-                        if max_val <= 1.0:
-                            rgb = [int(255 * c) for c in color_list]
-                        else:
-                            rgb = [int(c) for c in color_list]
-                        color_found = True
-                    except:
-                        pass
-                
-                # Попытка доступа к компонентам цвета как атрибутам
-                if not color_found and hasattr(color, 'r') and hasattr(color, 'g') and hasattr(color, 'b'):
-                    try:
-                        r, g, b = color.r, color.g, color.b
-                        if max(r, g, b) <= 1.0:
-                            rgb = [int(255 * r), int(255 * g), int(255 * b)]
-                        else:
-                            rgb = [int(r), int(g), int(b)]
-                        color_found = True
-                        color_formats_found.add("point.color.rgb attributes")
-                    except:
-                        pass
-            
-            # Метод 2: Доступ через track (если point.color не работает)
-            if not color_found and hasattr(chunk.tie_points, 'tracks') and point_idx < len(chunk.tie_points.tracks):
-                try:
-                    track = chunk.tie_points.tracks[point_idx]
-                    if hasattr(track, 'color') and track.color is not None:
-                        track_color = track.color
-                        color_formats_found.add(f"track.color: {type(track_color)}")
-                        
-                        if isinstance(track_color, (list, tuple, np.ndarray)) and len(track_color) >= 3:
-                            max_val = max(track_color[:3])
-                            if max_val <= 1.0:
-                                rgb = [int(255 * c) for c in track_color[:3]]
-                            else:
-                                rgb = [int(c) for c in track_color[:3]]
-                            color_found = True
-                except:
-                    pass
-            
-            # Метод 3: Прямые атрибуты точки (red, green, blue)
-            if not color_found:
-                if (hasattr(point, 'red') and hasattr(point, 'green') and hasattr(point, 'blue')):
-                    try:
-                        r, g, b = point.red, point.green, point.blue
-                        rgb = [int(r), int(g), int(b)]
-                        color_found = True
-                        color_formats_found.add("point.red/green/blue")
-                    except:
-                        pass
-            
-            # Убеждаемся что значения в правильном диапазоне
-            rgb = [max(0, min(255, int(c))) for c in rgb]
-            
-            # Проверяем что цвет не является серым по умолчанию
-            if color_found and not (rgb[0] == rgb[1] == rgb[2] and 120 <= rgb[0] <= 135):
-                colored_points += 1
-            
-        except Exception as e:
-            if valid_points <= 5:  # Показываем ошибки только для первых точек
-                print(f"⚠️  Ошибка извлечения цвета для точки {point_idx}: {e}")
-        
-        # Ошибка реконструкции
-        error = 0.0
-        if hasattr(point, 'error'):
-            try:
-                error = float(point.error)
-            except:
-                error = 0.0
-        
-        points3D[point3D_id] = {
-            'xyz': xyz,
-            'rgb': rgb,
-            'error': error,
-            'image_ids': [],      # Пустой для 3DGS
-            'point2D_idxs': []    # Пустой для 3DGS
-        }
+    atlas_shape = (len(face_names) * face_size, face_size) + equirect_image.shape[2:]
+    if out is None or out.shape != atlas_shape or out.dtype != equirect_image.dtype:
+        out = np.empty(atlas_shape, dtype=equirect_image.dtype)
     
-    # Диагностическая информация
-    print(f"🔍 Найденные форматы цветов: {color_formats_found}")
-    print(f"✅ Извлечено точек: {len(points3D)}")
-    print(f"📊 Валидных точек: {valid_points}")
-    print(f"🎨 Цветных точек: {colored_points}")
-    print(f"⚪ Серых точек: {valid_points - colored_points}")
+    cv2.remap(
+        equirect_image,
+        maps[0],
+        maps[1],
+        cv2.INTER_CUBIC,
+        dst=out,
+        borderMode=cv2.BORDER_WRAP  # Циклическое повторение по X
+    )
     
-    color_ratio = colored_points / valid_points if valid_points > 0 else 0
-    print(f"📈 Процент цветных точек: {color_ratio:.1%}")
+    face_views = {
+        face_name: out[idx * face_size:(idx + 1) * face_size]
+        for idx, face_name in enumerate(face_names)
+    }
+    return out, face_views
+
+# === АНТИАЛИАСИНГ: REMAP ИЗ ПИРАМИДЫ ПАНОРАМЫ ===
+# Код уровня пирамиды: изотропный уровень * MIP_CODE_BASE + дополнительные уменьшения по X
+MIP_CODE_BASE = 64
+# Уровни не уменьшают панораму меньше этой высоты
+MIP_MIN_LEVEL_HEIGHT = 16
+# Ширина полосы карт плана (cv2.remap требует размеры меньше SHRT_MAX)
+MIP_STRIP_WIDTH = 16384
+# Ядро cv2.pyrDown (5 отсчетов)
+PYR_DOWN_KERNEL = np.array([1, 4, 6, 4, 1], dtype=np.float32) / 16
+
+def _map_footprint_FIXED(map_coord, eq_period=None):
+    """Шаг карты (в пикселях панорамы) на пиксель грани: длина градиента по двум осям грани"""
+    steps = []
+    for axis in (0, 1):
+        diff = np.diff(map_coord, axis=axis)
+        # Последняя строка/столбец повторяет соседний шаг
+        diff = np.concatenate([diff, np.take(diff, [-1], axis=axis)], axis=axis)
+        if eq_period is not None:
+            # Переход через шов долготы 0/2π - не реальный шаг
+            diff = (diff + eq_period / 2) % eq_period - eq_period / 2
+        steps.append(diff)
+    return np.hypot(steps[0], steps[1])
+
+def build_mip_plan_FIXED(map_x, map_y, eq_shape, face_size, fixed_point=True):
+    """
+    План remap атласа граней из пирамиды панорамы
     
-    if color_ratio < 0.3:
-        print("⚠️  ВНИМАНИЕ: Мало цветных точек!")
-        print("💡 Попробуйте выполнить: Tools -> Dense Cloud -> Calculate Point Colors")
-    elif color_ratio < 0.7:
-        print("⚠️  Цветность облака приемлемая, но можно улучшить")
-    else:
-        print("✅ Цветность облака отличная")
+    Для каждого пикселя грани по картам считается шаг выборки в панораме по X и Y.
+    Изотропный уровень пирамиды выбирается по меньшему шагу, а растяжение по X
+    у полюсов (1/cos широты) компенсируется дополнительными уменьшениями только
+    по горизонтали. Пиксели сортируются по уровню, координаты делятся на масштаб
+    уровня, и каждый уровень выбирается одним вызовом cv2.remap по своим строкам
+    полосы шириной MIP_STRIP_WIDTH (хвост строки дополняется нулевыми координатами).
+    
+    Args:
+        map_x, map_y: float32 карты атласа
+        eq_shape: (высота, ширина) панорамы
+        face_size: размер грани
+        fixed_point: перевести полосы карт в CV_16SC2
     
-    return points3D
+    Returns:
+        (order, bounds, row_bounds, codes, map_a, map_b): индексы пикселей атласа
+        в порядке уровней, границы уровней в order, границы уровней в строках полосы,
+        коды уровней и карты полосы (строки, MIP_STRIP_WIDTH)
+    """
+    eq_height, eq_width = int(eq_shape[0]), int(eq_shape[1])
+    
+    # Высоты изотропных уровней (размер cv2.pyrDown: (n + 1) // 2)
+    level_heights = [eq_height]
+    while (level_heights[-1] + 1) // 2 >= MIP_MIN_LEVEL_HEIGHT:
+        level_heights.append((level_heights[-1] + 1) // 2)
+    max_level = len(level_heights) - 1
+    
+    step_x = np.concatenate([_map_footprint_FIXED(map_x[i:i + face_size], eq_width)
+                             for i in range(0, map_x.shape[0], face_size)])
+    step_y = np.concatenate([_map_footprint_FIXED(map_y[i:i + face_size])
+                             for i in range(0, map_y.shape[0], face_size)])
+    
+    with np.errstate(divide='ignore'):
+        iso_level = np.floor(np.log2(np.minimum(step_x, step_y)) + 0.5)
+        iso_level = np.clip(iso_level, 0, max_level).astype(np.int32)
+        x_level = np.floor(np.log2(step_x / np.exp2(iso_level)) + 0.5)
+        x_level = np.clip(x_level, 0, max_level).astype(np.int32)
+    
+    codes_flat = (iso_level * MIP_CODE_BASE + x_level).ravel()
+    order = np.argsort(codes_flat, kind='stable').astype(np.int64)
+    codes, bounds = np.unique(codes_flat[order], return_index=True)
+    bounds = np.append(bounds, len(order)).astype(np.int64)
+    
+    iso_sorted = iso_level.ravel()[order]
+    x_sorted = x_level.ravel()[order]
+    strip_x = (map_x.ravel()[order] / np.exp2(iso_sorted + x_sorted)).astype(np.float32)
+    strip_y = map_y.ravel()[order] / np.exp2(iso_sorted)
+    strip_y = np.minimum(strip_y, np.asarray(level_heights)[iso_sorted] - 1).astype(np.float32)
+    
+    # Каждый уровень занимает целые строки полосы
+    segment_rows = -(-np.diff(bounds) // MIP_STRIP_WIDTH)
+    row_bounds = np.concatenate(([0], np.cumsum(segment_rows))).astype(np.int64)
+    map_a = np.zeros((row_bounds[-1], MIP_STRIP_WIDTH), dtype=np.float32)
+    map_b = np.zeros_like(map_a)
+    for start, end, row in zip(bounds[:-1], bounds[1:], row_bounds[:-1]):
+        offset = row * MIP_STRIP_WIDTH
+        map_a.reshape(-1)[offset:offset + end - start] = strip_x[start:end]
+        map_b.reshape(-1)[offset:offset + end - start] = strip_y[start:end]
+    
+    if fixed_point:
+        map_a, map_b = cv2.convertMaps(map_a, map_b, cv2.CV_16SC2)
+    return order, bounds, row_bounds, codes.astype(np.int64), map_a, map_b
 
-# === ЗАПИСЬ COLMAP ФАЙЛОВ ===
-def write_cameras_binary(cameras, path):
-    """Записывает cameras.bin в COLMAP формате"""
-    with open(path, "wb") as f:
-        f.write(struct.pack("Q", len(cameras)))
-        for camera_id, camera in cameras.items():
-            f.write(struct.pack("I", camera_id))
-            f.write(struct.pack("i", camera['model_id']))
-            f.write(struct.pack("Q", camera['width']))
-            f.write(struct.pack("Q", camera['height']))
-            for param in camera['params']:
-                f.write(struct.pack("d", param))
+def _pyr_down_wrap_FIXED(image):
+    """cv2.pyrDown с циклическим продолжением по долготе (без шва на 0/2π)"""
+    padded = cv2.copyMakeBorder(image, 0, 0, 2, 2, cv2.BORDER_WRAP)
+    return cv2.pyrDown(padded)[:, 1:-1]
 
-def write_images_binary(images, path):
-    """Записывает images.bin в COLMAP формате"""
-    with open(path, "wb") as f:
-        f.write(struct.pack("Q", len(images)))
-        for image_id, image in images.items():
-            f.write(struct.pack("I", image_id))
-            for val in image['qvec']:
-                f.write(struct.pack("d", val))
-            for val in image['tvec']:
-                f.write(struct.pack("d", val))
-            f.write(struct.pack("I", image['camera_id']))
-            name_bytes = image['name'].encode('utf-8') + b'\x00'
-            f.write(name_bytes)
-            f.write(struct.pack("Q", len(image['xys'])))
-            for xy, point3D_id in zip(image['xys'], image['point3D_ids']):
-                f.write(struct.pack("d", xy[0]))
-                f.write(struct.pack("d", xy[1]))
-                f.write(struct.pack("Q", point3D_id))
+def _pyr_down_horizontal_wrap_FIXED(image):
+    """Уменьшение вдвое только по горизонтали тем же ядром, что у cv2.pyrDown"""
+    padded = cv2.copyMakeBorder(image, 0, 0, 2, 2, cv2.BORDER_WRAP)
+    filtered = cv2.sepFilter2D(padded, -1, PYR_DOWN_KERNEL, np.ones(1, dtype=np.float32))
+    return np.ascontiguousarray(filtered[:, 2:-2:2])
 
-def write_points3D_binary(points3D, path):
-    """Записывает points3D.bin в COLMAP формате"""
-    with open(path, "wb") as f:
-        f.write(struct.pack("Q", len(points3D)))
-        for point3D_id, point in points3D.items():
-            f.write(struct.pack("Q", point3D_id))
-            for coord in point['xyz']:
-                f.write(struct.pack("d", coord))
-            for color in point['rgb']:
-                f.write(struct.pack("B", color))
-            f.write(struct.pack("d", point['error']))
-            f.write(struct.pack("Q", len(point['image_ids'])))
-            for image_id, point2D_idx in zip(point['image_ids'], point['point2D_idxs']):
-                f.write(struct.pack("I", image_id))
-                f.write(struct.pack("I", point2D_idx))
+def build_equirect_pyramid_FIXED(equirect_image, codes):
+    """
+    Строит только нужные уровни пирамиды панорамы
+    
+    Returns:
+        dict {код уровня: изображение}; уровень (l, h) - l раз cv2.pyrDown
+        и h раз уменьшение по горизонтали, координата пикселя i уровня = i * 2^k исходной
+    """
+    codes = [int(code) for code in codes]
+    max_iso = max(code // MIP_CODE_BASE for code in codes)
+    
+    pyramid = {}
+    level_image = equirect_image
+    for iso in range(max_iso + 1):
+        if iso > 0:
+            level_image = _pyr_down_wrap_FIXED(level_image)
+        x_levels = [code % MIP_CODE_BASE for code in codes if code // MIP_CODE_BASE == iso]
+        if not x_levels:
+            continue
+        stretched = level_image
+        for x_level in range(max(x_levels) + 1):
+            if x_level > 0:
+                stretched = _pyr_down_horizontal_wrap_FIXED(stretched)
+            if x_level in x_levels:
+                pyramid[iso * MIP_CODE_BASE + x_level] = stretched
+    return pyramid
 
-# === ПРОГРЕСС ТРЕКЕР ===
-class ProgressTracker:
-    """Простой трекер прогресса с временными оценками"""
+def equirectangular_to_cubemap_mip_atlas_FIXED(equirect_image, face_names, face_size, map_cache, fov=90, overlap=10, out=None):
+    """
+    Атлас граней с антиалиасингом: каждый пиксель берется из уровня пирамиды,
+    плотность которого соответствует шагу выборки грани
     
-    def __init__(self, title="Spherical to 3DGS FIXED"):
-        self.title = title
-        self.start_time = time.time()
-        self.stage_start = time.time()
+    Пирамида строится один раз на панораму и только из нужных уровней.
+    Аргументы и результат - как у equirectangular_to_cubemap_atlas_FIXED.
+    """
     
-    def update(self, current, total, message="", stage_change=False):
-        """Обновляет прогресс"""
-        if stage_change:
-            self.stage_start = time.time()
-        
-        percent = int((current / total) * 100) if total > 0 else 0
-        elapsed = time.time() - self.start_time
-        
-        # Оценка оставшегося времени
-        if current > 0:
-            estimated_total = elapsed * (total / current)
-            remaining = max(0, estimated_total - elapsed)
-            if remaining < 60:
-                time_str = f" | Осталось: {remaining:.0f}с"
-            elif remaining < 3600:
-                time_str = f" | Осталось: {remaining/60:.1f}мин"
-            else:
-                time_str = f" | Осталось: {remaining/3600:.1f}ч"
-        else:
-            time_str = ""
-        
-        status = f"📊 [{percent:3d}%] {message}{time_str}"
-        print(status)
-        
-        # Обновляем GUI Metashape если возможно
-        try:
-            if hasattr(Metashape.app, 'update'):
-                Metashape.app.update()
-        except:
-            pass
+    if equirect_image is None or not face_names:
+        return None, {}
+    
+    plan = map_cache.get_mip_atlas(equirect_image.shape[:2], face_names, face_size, fov, overlap)
+    if plan is None:
+        return None, {}
+    order, bounds, row_bounds, codes, map_a, map_b = plan
+    
+    atlas_shape = (len(face_names) * face_size, face_size) + equirect_image.shape[2:]
+    if out is None or out.shape != atlas_shape or out.dtype != equirect_image.dtype:
+        out = np.empty(atlas_shape, dtype=equirect_image.dtype)
+    
+    pyramid = build_equirect_pyramid_FIXED(equirect_image, codes)
+    strip = np.empty(map_a.shape[:2] + equirect_image.shape[2:], dtype=equirect_image.dtype)
+    for code, row_start, row_end in zip(codes, row_bounds[:-1], row_bounds[1:]):
+        cv2.remap(
+            pyramid[int(code)],
+            map_a[row_start:row_end],
+            map_b[row_start:row_end],
+            cv2.INTER_CUBIC,
+            dst=strip[row_start:row_end],
+            borderMode=cv2.BORDER_WRAP  # Циклическое повторение по X
+        )
+    del pyramid
+    
+    # Пиксели каждого уровня лежат в начале его строк полосы
+    out_pixels = out.reshape((-1,) + equirect_image.shape[2:])
+    strip_pixels = strip.reshape((-1,) + equirect_image.shape[2:])
+    for start, end, row_start in zip(bounds[:-1], bounds[1:], row_bounds[:-1]):
+        offset = row_start * MIP_STRIP_WIDTH
+        out_pixels[order[start:end]] = strip_pixels[offset:offset + end - start]
+    
+    face_views = {
+        face_name: out[idx * face_size:(idx + 1) * face_size]
+        for idx, face_name in enumerate(face_names)
+    }
+    return out, face_views
 
-# === ИСПРАВЛЕННАЯ ФУНКЦИЯ СОЗДАНИЯ КУБИЧЕСКИХ КАМЕР ===
-def create_cubemap_cameras_FIXED(chunk, spherical_camera, face_images_paths, face_size, overlap=10):
+def select_face_size_FIXED(eq_width, face_size=None):
+    """Возвращает заданный размер грани или автоматический (~1/4 ширины панорамы, степень двойки)"""
+    if face_size is not None:
+        return face_size
+    
+    # Автоматический расчет размера
+    actual_face_size = min(max(eq_width // 4, 512), 2048)
+    # Округляем до ближайшей степени двойки для оптимальности
+    return 2 ** int(np.log2(actual_face_size) + 0.5)
+
+def generate_cubemap_faces_FIXED(spherical_image, face_names, face_size, overlap, map_cache,
+                                 atlas_mode=True, atlas_out=None, mip_pyramid=False, face_executor=None):
     """
-    ИСПРАВЛЕННАЯ функция создания кубических камер в Metashape
-    Создает 6 камер с правильными позициями и ориентациями
+    Строит изображения граней одной панорамы
     
     Args:
-        chunk: Metashape.Chunk
-        spherical_camera: исходная сферическая камера
-        face_images_paths: словарь путей к изображениям граней
-        face_size: размер изображений граней
+        spherical_image: декодированная сферическая панорама
+        face_names: список граней
+        face_size: размер грани
         overlap: перекрытие в градусах
+        map_cache: FaceMapCache
+        atlas_mode: все грани одним вызовом cv2.remap
+        atlas_out: буфер атласа для повторного использования
+        mip_pyramid: антиалиасинг - remap из пирамиды панорамы (всегда атласом)
+        face_executor: пул потоков граней - в режиме по граням грани одной панорамы
+            строятся параллельно (панорама общая, не копируется)
+    
+    Returns:
+        (atlas, {face_name: image}) - atlas равен None в режиме по граням
+    """
+    if mip_pyramid:
+        return equirectangular_to_cubemap_mip_atlas_FIXED(
+            spherical_image,
+            face_names,
+            face_size,
+            map_cache,
+            fov=90,
+            overlap=overlap,
+            out=atlas_out
+        )
+    
+    if atlas_mode:
+        return equirectangular_to_cubemap_atlas_FIXED(
+            spherical_image,
+            face_names,
+            face_size,
+            map_cache,
+            fov=90,
+            overlap=overlap,
+            out=atlas_out
+        )
+    
+    def build_face(face_name):
+        # Создаем изображение грани с ПРАВИЛЬНОЙ геометрией
+        return equirectangular_to_cubemap_face_FIXED(
+            spherical_image, 
+            face_name, 
+            face_size, 
+            fov=90, 
+            overlap=overlap,
+            map_cache=map_cache
+        )
+    
+    if face_executor is not None:
+        pending = {face_name: face_executor.submit(build_face, face_name) for face_name in face_names}
+    else:
+        pending = {face_name: None for face_name in face_names}
+    
+    face_images = {}
+    for face_name, future in pending.items():
+        try:
+            perspective_image = future.result() if future is not None else build_face(face_name)
+            if perspective_image is not None:
+                face_images[face_name] = perspective_image
+        except Exception as e:
+            print(f"❌ Ошибка обработки грани {face_name}: {e}")
+    return None, face_images
+
+def plan_thread_budget_FIXED(camera_threads, face_threads, max_threads=None, reserved_threads=0):
+    """
+    Делит лимит потоков между камерами и пулом граней
+    
+    Потоки камер занимают лимит первыми, пул граней получает остаток, но не больше
+    camera_threads * face_threads. Когда камер много и они заполняют машину, пул
+    граней не создается; при нескольких огромных панорамах свободные ядра
+    достаются граням.
+    
+    Args:
+        camera_threads: потоки камер (remap)
+        face_threads: потоки граней на одну камеру (1 = без пула граней)
+        max_threads: общий лимит рабочих потоков (None = число ядер)
+        reserved_threads: потоки других стадий внутри лимита (чтение, запись конвейера)
+    
+    Returns:
+        tuple: (camera_threads, face_workers) - face_workers = 0 без пула граней
+    """
+    if max_threads is None:
+        max_threads = os.cpu_count() or 1
+    available = max(1, max_threads - reserved_threads)
+    camera_threads = max(1, min(camera_threads, available))
+    if face_threads <= 1:
+        return camera_threads, 0
+    return camera_threads, max(0, min(camera_threads * face_threads, available - camera_threads))
+
+# === АНАЛИЗ ТЕКСТУРЫ ГРАНЕЙ: ПРОПУСК НЕБА И НАДИРА ===
+# Сторона превью грани для анализа текстуры
+FACE_PREVIEW_SIZE = 64
+# Модуль градиента превью (яркость 0-255), с которого пиксель считается текстурированным
+FACE_TEXTURE_GRADIENT = 8.0
+# Доля текстурированных пикселей превью, ниже которой грань пропускается (если пропуск включен)
+DEFAULT_MIN_FACE_TEXTURE = 0.02
+
+def face_texture_score_FIXED(face_image, preview_size=FACE_PREVIEW_SIZE):
+    """
+    Доля текстурированных пикселей грани по превью preview_size×preview_size
+    
+    Грань уменьшается INTER_AREA (шум и сжатие JPEG усредняются), затем
+    считается модуль градиента Scharr по яркости. Ровное небо и однотонный
+    надир дают долю около нуля, любая сцена с деталями - десятки процентов.
+    
+    Returns:
+        float: доля пикселей превью с градиентом >= FACE_TEXTURE_GRADIENT (0..1)
+    """
+    # Панорамы читаются IMREAD_COLOR - грани всегда BGR uint8
+    preview = cv2.resize(face_image, (preview_size, preview_size), interpolation=cv2.INTER_AREA)
+    preview = cv2.cvtColor(preview, cv2.COLOR_BGR2GRAY).astype(np.float32)
+    
+    # Scharr дает ×16 к разности соседних пикселей
+    grad_x = cv2.Scharr(preview, cv2.CV_32F, 1, 0)
+    grad_y = cv2.Scharr(preview, cv2.CV_32F, 0, 1)
+    magnitude = cv2.magnitude(grad_x, grad_y) / 16.0
+    return float(np.count_nonzero(magnitude >= FACE_TEXTURE_GRADIENT)) / magnitude.size
+
+def select_textured_faces_FIXED(face_images, min_face_texture, label=""):
+    """
+    Отделяет малотекстурные грани (небо, надир со штативом), которые не нужны для 3DGS
+    
+    Args:
+        face_images: {face_name: image}
+        min_face_texture: минимальная доля текстурированных пикселей (face_texture_score_FIXED)
+        label: метка камеры для лога
+    
+    Returns:
+        tuple: (оставленные {face_name: image}, пропущенные {face_name: доля})
+    """
+    kept = {}
+    skipped = {}
+    for face_name, face_image in face_images.items():
+        score = face_texture_score_FIXED(face_image)
+        if score < min_face_texture:
+            skipped[face_name] = round(score, 4)
+        else:
+            kept[face_name] = face_image
+    
+    if skipped:
+        details = ", ".join(f"{face_name} ({score:.1%})" for face_name, score in skipped.items())
+        print(f"🌫️  {label}: пропущены малотекстурные грани {details}")
+    return kept, skipped
+
+# === ПУЛ ПРОЦЕССОВ ДЛЯ REMAP (ОБЩАЯ ПАМЯТЬ) ===
+# Кэш карт внутри каждого дочернего процесса пула
+_worker_map_cache = None
+
+def _init_remap_worker_FIXED(max_megabytes, disk_folder, fixed_point):
+    """Инициализатор процесса пула: свой кэш карт (общий дисковый кэш, если задан)"""
+    global _worker_map_cache
+    _worker_map_cache = FaceMapCache(max_megabytes=max_megabytes, disk_folder=disk_folder, fixed_point=fixed_point)
+
+def _remap_atlas_worker_FIXED(task):
+    """
+    Выполняется в дочернем процессе: читает панораму из общей памяти
+    и пишет атлас граней прямо в выходной блок общей памяти
+    """
+    in_name, in_shape, in_dtype, out_name, face_names, face_size, overlap, mip_pyramid = task
+    # Процессы пула делят resource_tracker с главным процессом,
+    # поэтому подключение не меняет владельца блоков - их удаляет главный процесс
+    shm_in = shared_memory.SharedMemory(name=in_name)
+    shm_out = shared_memory.SharedMemory(name=out_name)
+    try:
+        spherical_image = np.ndarray(in_shape, dtype=in_dtype, buffer=shm_in.buf)
+        atlas_shape = (len(face_names) * face_size, face_size) + tuple(in_shape[2:])
+        atlas = np.ndarray(atlas_shape, dtype=in_dtype, buffer=shm_out.buf)
+        result, _ = generate_cubemap_faces_FIXED(
+            spherical_image, face_names, face_size, overlap, _worker_map_cache,
+            atlas_out=atlas, mip_pyramid=mip_pyramid
+        )
+        # Атлас должен быть записан в общую память, а не в новый массив
+        ok = result is atlas
+        del spherical_image, atlas, result
+        return ok
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+def _ping_remap_worker_FIXED():
+    return os.getpid()
+
+def _configure_process_executable_FIXED():
+    """
+    Внутри Metashape sys.executable указывает на сам Metashape - дочерним процессам
+    нужен встроенный интерпретатор Python
+    """
+    exe_name = os.path.basename(sys.executable).lower()
+    if not exe_name.startswith("metashape"):
+        return
+    exe_dir = os.path.dirname(sys.executable)
+    for candidate in (os.path.join(exe_dir, "python", "python.exe"),
+                      os.path.join(exe_dir, "python", "bin", "python3"),
+                      os.path.join(exe_dir, "python3")):
+        if os.path.exists(candidate):
+            multiprocessing.set_executable(candidate)
+            return
+
+def create_remap_process_pool_FIXED(workers, max_megabytes=1024, disk_folder=None, fixed_point=True):
+    """
+    Создает пул процессов для стадии remap конвейера
+    
+    Returns:
+        ProcessPoolExecutor или None, если процессы запустить не удалось
+        (тогда используется remap в потоках)
+    """
+    try:
+        _configure_process_executable_FIXED()
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_remap_worker_FIXED,
+            initargs=(max_megabytes, disk_folder, fixed_point)
+        )
+        # Проверяем, что дочерние процессы действительно запускаются
+        pool.submit(_ping_remap_worker_FIXED).result(timeout=120)
+        return pool
+    except Exception as e:
+        print(f"⚠️  Пул процессов недоступен ({e}), remap будет выполняться в потоках")
+        return None
+
+def _remap_in_process_pool_FIXED(process_pool, spherical_image, face_names, face_size, overlap, mip_pyramid=False):
+    """
+    Отправляет панораму в пул процессов через общую память
+    
+    Returns:
+        (atlas, release): атлас граней поверх блока общей памяти и функция,
+        освобождающая блок после записи всех граней
+    """
+    shm_in = shared_memory.SharedMemory(create=True, size=spherical_image.nbytes)
+    try:
+        shared_image = np.ndarray(spherical_image.shape, dtype=spherical_image.dtype, buffer=shm_in.buf)
+        shared_image[...] = spherical_image
+        del shared_image
+        
+        atlas_shape = (len(face_names) * face_size, face_size) + spherical_image.shape[2:]
+        atlas_nbytes = int(np.prod(atlas_shape)) * spherical_image.dtype.itemsize
+        shm_out = shared_memory.SharedMemory(create=True, size=atlas_nbytes)
+        
+        task = (shm_in.name, spherical_image.shape, spherical_image.dtype.str, shm_out.name,
+                tuple(face_names), face_size, overlap, mip_pyramid)
+        try:
+            ok = process_pool.submit(_remap_atlas_worker_FIXED, task).result()
+        except Exception:
+            shm_out.close()
+            shm_out.unlink()
+            raise
+    finally:
+        shm_in.close()
+        shm_in.unlink()
+    
+    if not ok:
+        shm_out.close()
+        shm_out.unlink()
+        return None, None
+    
+    atlas = np.ndarray(atlas_shape, dtype=spherical_image.dtype, buffer=shm_out.buf)
+    
+    def release():
+        try:
+            shm_out.close()
+        except BufferError:
+            # Остались ссылки на грани - блок закроется сборщиком мусора
+            pass
+        shm_out.unlink()
+    
+    return atlas, release
+
+# === КОНВЕЙЕР: ЧТЕНИЕ → REMAP → ЗАПИСЬ ===
+def run_cubemap_pipeline_FIXED(jobs, face_names, face_size, overlap, map_cache, images_folder,
+                               file_ext, save_params, reader_threads=2, remap_threads=2,
+                               writer_threads=2, queue_size=4, atlas_mode=True, process_pool=None,
+                               reduced_decode=True, mip_pyramid=False, downscales=(), min_face_texture=0,
+                               face_executor=None):
+    """
+    Потоковая обработка панорам тремя независимыми стадиями
+    
+    Потоки чтения декодируют панорамы в ограниченную очередь, потоки remap строят
+    грани, отдельный пул кодирует и записывает их на диск. Очереди ограничены,
+    поэтому быстрая стадия ждет медленную и в памяти находится не больше
+    queue_size панорам и queue_size * 6 граней. Чтение с диска, декодирование,
+    remap и кодирование JPEG разных камер идут одновременно.
+    
+    Args:
+        jobs: список (camera, label, image_path)
+        face_names: список граней
+        face_size: размер грани (None = автоматически)
+        overlap: перекрытие в градусах
+        map_cache: FaceMapCache
+        images_folder: папка для граней
+        file_ext, save_params: формат и параметры сохранения
+        reader_threads, remap_threads, writer_threads: размеры стадий
+        queue_size: емкость очереди декодированных панорам
+        atlas_mode: все грани камеры одним вызовом cv2.remap
+        process_pool: пул create_remap_process_pool_FIXED - remap выполняется в процессах,
+            панорамы и грани передаются через общую память без pickle (всегда атласом,
+            atlas_mode не учитывается)
+        reduced_decode: декодировать JPEG в уменьшенном разрешении, если грани позволяют
+        mip_pyramid: антиалиасинг - remap из пирамиды панорамы
+        downscales: множители уменьшенных копий граней (images_2, images_4, ...)
+        min_face_texture: пропускать грани с долей текстуры ниже порога (0 = не анализировать)
+        face_executor: пул потоков граней для remap по граням (atlas_mode=False)
+    
+    Yields:
+        dict результата камеры (как у последовательной обработки) по мере готовности
+    """
+    job_queue = queue.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    
+    decoded_queue = queue.Queue(maxsize=queue_size)
+    face_queue = queue.Queue(maxsize=queue_size * len(face_names))
+    done_queue = queue.Queue()
+    
+    state_lock = threading.Lock()
+    active_workers = {'read': reader_threads, 'remap': remap_threads}
+    pending_faces = {}
+    release_callbacks = {}
+    
+    def finish_stage(stage, next_queue, next_workers):
+        # Последний поток стадии закрывает очередь следующей стадии
+        with state_lock:
+            active_workers[stage] -= 1
+            is_last = active_workers[stage] == 0
+        if is_last:
+            for _ in range(next_workers):
+                next_queue.put(None)
+    
+    def reader():
+        while True:
+            try:
+                camera, label, image_path = job_queue.get_nowait()
+            except queue.Empty:
+                break
+            result = {'camera': camera, 'face_images': {}, 'face_size_actual': None, 'error': None,
+                      'skipped_faces': {}}
+            try:
+                spherical_image, result['face_size_actual'] = read_spherical_image_FIXED(
+                    image_path, face_size, overlap, reduced_decode
+                )
+            except Exception as e:
+                spherical_image = None
+                print(f"❌ Ошибка чтения {label}: {e}")
+            if spherical_image is None:
+                result['error'] = "Не удалось загрузить изображение"
+                done_queue.put(result)
+                continue
+            # Блокируется, пока remap не освободит место - память ограничена
+            decoded_queue.put((result, label, spherical_image))
+        finish_stage('read', decoded_queue, remap_threads)
+    
+    def remapper():
+        while True:
+            item = decoded_queue.get()
+            if item is None:
+                break
+            result, label, spherical_image = item
+            face_images = {}
+            try:
+                actual_face_size = result['face_size_actual']
+                if process_pool is not None:
+                    # Поток только пересылает панораму процессу и ждет готовый атлас
+                    atlas, release = _remap_in_process_pool_FIXED(
+                        process_pool, spherical_image, face_names, actual_face_size, overlap, mip_pyramid
+                    )
+                    if atlas is not None:
+                        face_images = {
+                            face_name: atlas[idx * actual_face_size:(idx + 1) * actual_face_size]
+                            for idx, face_name in enumerate(face_names)
+                        }
+                        release_callbacks[id(result)] = release
+                    del atlas
+                else:
+                    # Буфер атласа выделяется на каждую камеру: его грани еще ждут записи
+                    _, face_images = generate_cubemap_faces_FIXED(
+                        spherical_image, face_names, actual_face_size, overlap, map_cache, atlas_mode,
+                        mip_pyramid=mip_pyramid, face_executor=face_executor
+                    )
+                if face_images and min_face_texture > 0:
+                    # Решение по превью до кодирования: пропущенные грани не пишутся вовсе
+                    face_images, result['skipped_faces'] = select_textured_faces_FIXED(
+                        face_images, min_face_texture, label
+                    )
+            except Exception as e:
+                result['error'] = str(e)
+            del spherical_image
+            
+            if not face_images:
+                release = release_callbacks.pop(id(result), None)
+                if release is not None:
+                    release()
+                done_queue.put(result)
+                continue
+            
+            with state_lock:
+                pending_faces[id(result)] = len(face_images)
+            for face_name, face_image in face_images.items():
+                face_queue.put((result, label, face_name, face_image))
+            del face_images
+        finish_stage('remap', face_queue, writer_threads)
+    
+    def writer():
+        while True:
+            item = face_queue.get()
+            if item is None:
+                break
+            result, label, face_name, face_image = item
+            del item
+            try:
+                output_path = save_face_image_FIXED(
+                    face_image, images_folder, f"{label}_{face_name}.{file_ext}", save_params, downscales
+                )
+                if output_path:
+                    result['face_images'][face_name] = output_path
+            except Exception as e:
+                print(f"❌ Ошибка записи грани {face_name} для {label}: {e}")
+            del face_image
+            
+            with state_lock:
+                pending_faces[id(result)] -= 1
+                camera_done = pending_faces[id(result)] == 0
+                if camera_done:
+                    del pending_faces[id(result)]
+            if camera_done:
+                release = release_callbacks.pop(id(result), None)
+                if release is not None:
+                    release()
+                # Порядок граней не зависит от порядка завершения записи
+                written = result['face_images']
+                result['face_images'] = {name: written[name] for name in face_names if name in written}
+                done_queue.put(result)
+    
+    workers = (
+        [threading.Thread(target=reader, name=f"cubemap-read-{i}", daemon=True) for i in range(reader_threads)] +
+        [threading.Thread(target=remapper, name=f"cubemap-remap-{i}", daemon=True) for i in range(remap_threads)] +
+        [threading.Thread(target=writer, name=f"cubemap-write-{i}", daemon=True) for i in range(writer_threads)]
+    )
+    for worker in workers:
+        worker.start()
+    
+    try:
+        for _ in range(len(jobs)):
+            yield done_queue.get()
+    finally:
+        # Потребитель мог прервать обработку: новые панорамы не читаются, начатые дописываются
+        while True:
+            try:
+                job_queue.get_nowait()
+            except queue.Empty:
+                break
+        for worker in workers:
+            worker.join()
+        # Блоки общей памяти камер, не дошедших до конца записи
+        for release in release_callbacks.values():
+            release()
+        release_callbacks.clear()
+
+# === ИСПРАВЛЕННОЕ ИЗВЛЕЧЕНИЕ ЦВЕТНОГО ОБЛАКА ===
+def empty_point_cloud_FIXED(count=0):
+    """
+    Облако точек в виде массивов
+    
+    Returns:
+        dict: 'ids' (N,) uint64 - 1-based COLMAP id, 'xyz' (N,3) float64,
+              'rgb' (N,3) uint8, 'error' (N,) float64
+    """
+    return {
+        'ids': np.zeros(count, dtype=np.uint64),
+        'xyz': np.zeros((count, 3), dtype=np.float64),
+        'rgb': np.full((count, 3), 128, dtype=np.uint8),
+        'error': np.zeros(count, dtype=np.float64)
+    }
+
+def _detect_tie_point_color_source_FIXED(tie_points, sample_point):
+    """Определяет источник цвета один раз на чанк: 'point', 'track', 'attrs' или None"""
+    color = getattr(sample_point, 'color', None)
+    if color is not None:
+        try:
+            if len(color) >= 3:
+                return 'point'
+        except TypeError:
+            if hasattr(color, 'r') and hasattr(color, 'g') and hasattr(color, 'b'):
+                return 'point_rgb'
+    
+    tracks = getattr(tie_points, 'tracks', None)
+    if tracks is not None and len(tracks) > 0:
+        track_color = getattr(tracks[0], 'color', None)
+        if track_color is not None and len(track_color) >= 3:
+            return 'track'
+    
+    if hasattr(sample_point, 'red') and hasattr(sample_point, 'green') and hasattr(sample_point, 'blue'):
+        return 'attrs'
+    
+    return None
+
+def _normalize_colors_FIXED(colors):
+    """Приводит цвета (N,3) к uint8: [0,1] → ×255, [0,255] как есть, иначе нормировка по максимуму"""
+    colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+    max_val = colors.max(axis=1, keepdims=True) if len(colors) else np.zeros((0, 1))
+    scale = np.where(max_val <= 1.0, 255.0, np.where(max_val <= 255.0, 1.0, 255.0 / np.maximum(max_val, 1e-12)))
+    return np.clip(np.trunc(colors * scale), 0, 255).astype(np.uint8)
+
+def count_colored_points_FIXED(rgb):
+    """Число цветных точек: серые оттенки 120-135 считаются цветом по умолчанию"""
+    gray = (rgb[:, 0] == rgb[:, 1]) & (rgb[:, 1] == rgb[:, 2]) & (rgb[:, 0] >= 120) & (rgb[:, 0] <= 135)
+    return int(np.count_nonzero(~gray))
+
+def _read_point_attributes_FIXED(tie_points, iterate_points, count, source_indices, color_source, track_colors=None):
+    """
+    Цвета и ошибки точек одним проходом на атрибут
+    
+    Args:
+        tie_points: chunk.tie_points
+        iterate_points: функция, возвращающая новый итератор по точкам (count штук)
+        count: количество точек
+        source_indices: исходные индексы точек (для треков без track_id)
+        color_source: результат _detect_tie_point_color_source_FIXED
+        track_colors: (T,3) цвета всех треков; None - цвет трека читается по track_id
+    
+    Returns:
+        tuple: (colors (N,3) float64 или None, errors (N,) float64 или None)
+    """
+    colors = None
+    try:
+        if color_source == 'point':
+            colors = np.fromiter(
+                itertools.chain.from_iterable(tuple(point.color)[:3] for point in iterate_points()),
+                dtype=np.float64, count=3 * count
+            )
+        elif color_source == 'point_rgb':
+            colors = np.fromiter(
+                itertools.chain.from_iterable((c.r, c.g, c.b) for c in (point.color for point in iterate_points())),
+                dtype=np.float64, count=3 * count
+            )
+        elif color_source == 'track':
+            tracks = tie_points.tracks
+            track_count = len(tracks) if track_colors is None else len(track_colors)
+            sample = next(iter(iterate_points()), None)
+            if sample is not None and hasattr(sample, 'track_id'):
+                track_ids = np.fromiter((point.track_id for point in iterate_points()), dtype=np.int64, count=count)
+            else:
+                track_ids = np.asarray(source_indices, dtype=np.int64)
+            in_range = track_ids < track_count
+            colors = np.full((count, 3), 128.0)
+            if track_colors is not None:
+                colors[in_range] = track_colors[track_ids[in_range]]
+            else:
+                # Потоковый режим: только цвета треков текущей порции
+                colors[in_range] = np.fromiter(
+                    itertools.chain.from_iterable(tuple(tracks[int(track_id)].color)[:3] for track_id in track_ids[in_range]),
+                    dtype=np.float64, count=3 * int(np.count_nonzero(in_range))
+                ).reshape(-1, 3)
+        elif color_source == 'attrs':
+            colors = np.fromiter(
+                itertools.chain.from_iterable((point.red, point.green, point.blue) for point in iterate_points()),
+                dtype=np.float64, count=3 * count
+            )
+    except Exception as e:
+        print(f"⚠️  Ошибка извлечения цветов ({color_source}): {e}")
+        colors = None
+    
+    errors = None
+    sample = next(iter(iterate_points()), None)
+    if sample is not None and hasattr(sample, 'error'):
+        try:
+            errors = np.fromiter((float(point.error) for point in iterate_points()), dtype=np.float64, count=count)
+        except Exception:
+            errors = None
+    
+    return colors, errors
+
+# Прореживание облака по вокселям: хэш-таблица в VOXEL_HASH_LOAD раз больше цели,
+# не больше VOXEL_SEARCH_ITERATIONS подборов размера вокселя
+VOXEL_HASH_LOAD = 8
+VOXEL_SEARCH_ITERATIONS = 12
+# Простые множители для хэша целочисленных координат вокселя
+VOXEL_HASH_PRIMES = (np.int64(73856093), np.int64(19349663), np.int64(83492791))
+
+def _voxel_representatives_FIXED(xyz, origin, voxel_size, table_size):
+    """
+    По одной точке на занятый воксель за O(N): ключ вокселя хэшируется в таблицу,
+    в каждую ячейку записывается индекс точки (последняя запись остается)
+    
+    Returns:
+        np.ndarray: индексы выбранных точек по возрастанию
+    """
+    cells = np.floor((xyz - origin) / voxel_size).astype(np.int64)
+    keys = (cells[:, 0] * VOXEL_HASH_PRIMES[0]) ^ (cells[:, 1] * VOXEL_HASH_PRIMES[1]) ^ (cells[:, 2] * VOXEL_HASH_PRIMES[2])
+    slots = keys & np.int64(table_size - 1)
+    table = np.full(table_size, -1, dtype=np.int64)
+    table[slots] = np.arange(len(xyz), dtype=np.int64)
+    representatives = table[table >= 0]
+    representatives.sort()
+    return representatives
+
+def voxel_downsample_FIXED(xyz, max_points):
+    """
+    Прореживание облака по воксельной сетке до ~max_points точек
+    
+    Размер вокселя подбирается по степенному закону числа занятых вокселей от
+    размера (для поверхностей показатель ~2, для объемов ~3), в каждом вокселе
+    остается одна точка. Плотные области прореживаются, редкие сохраняются.
+    
+    Args:
+        xyz: (N,3) координаты
+        max_points: целевое число точек
+    
+    Returns:
+        np.ndarray: индексы выбранных точек по возрастанию (не больше max_points)
+    """
+    point_count = len(xyz)
+    if point_count <= max_points:
+        return np.arange(point_count, dtype=np.int64)
+    
+    table_size = 1 << int(np.ceil(np.log2(max_points * VOXEL_HASH_LOAD)))
+    
+    # Начальный размер - по объему основной части облака (без дальних выбросов)
+    low, high = np.percentile(xyz, [1, 99], axis=0)
+    extent = np.maximum(high - low, 1e-9)
+    voxel_size = float(np.prod(extent) / max_points) ** (1 / 3)
+    origin = xyz.min(axis=0)
+    
+    best = None
+    previous = None
+    exponent = 2.0
+    for _ in range(VOXEL_SEARCH_ITERATIONS):
+        selected = _voxel_representatives_FIXED(xyz, origin, voxel_size, table_size)
+        count = len(selected)
+        if count <= max_points and (best is None or count > len(best)):
+            best, best_size = selected, voxel_size
+        if 0.9 * max_points <= count <= max_points:
+            break
+        
+        if previous is not None and previous[1] != count:
+            # Показатель степени по двум последним измерениям
+            exponent = np.log(previous[1] / count) / np.log(voxel_size / previous[0])
+            exponent = float(np.clip(exponent, 1.0, 3.0))
+        previous = (voxel_size, count)
+        voxel_size *= (count / (0.95 * max_points)) ** (1 / exponent)
+    
+    if best is None:
+        # Все подборы дали больше точек: равномерная выборка среди представителей
+        best, best_size = selected[np.linspace(0, count - 1, max_points).astype(np.int64)], voxel_size
+    print(f"🧊 Воксельное прореживание: {len(best)} из {point_count} точек (воксель {best_size:.4g})")
+    return best
+
+def extract_colored_point_cloud_FIXED(chunk, max_points=None):
+    """
+    ИСПРАВЛЕННОЕ извлечение цветного разреженного облака из Metashape
+    
+    Источник цвета определяется один раз на чанк, координаты, цвета и ошибки
+    копируются в заранее выделенные массивы. Прореживание до max_points -
+    по воксельной сетке (voxel_downsample_FIXED), равномерно по пространству.
+    
+    Returns:
+        dict: облако точек (см. empty_point_cloud_FIXED)
+    """
+    print("=== 🎨 Извлечение цветного разреженного облака (ИСПРАВЛЕННАЯ версия) ===")
+    
+    if not chunk.tie_points:
+        print("❌ Разреженное облако отсутствует!")
+        return empty_point_cloud_FIXED()
+    
+    tie_points = chunk.tie_points
+    points = tie_points.points
+    total_points = len(points)
+    
+    print(f"📊 Всего точек в облаке: {total_points}")
+    
+    # Маска валидных точек одним проходом
+    valid_mask = np.fromiter((point.valid for point in points), dtype=bool, count=total_points)
+    valid_indices = np.flatnonzero(valid_mask)
+    valid_points = len(valid_indices)
+    
+    if valid_points == 0:
+        print("❌ Нет валидных точек!")
+        return empty_point_cloud_FIXED()
+    
+    # Координаты всех валидных точек - нужны для прореживания по пространству
+    valid_xyz = np.fromiter(
+        itertools.chain.from_iterable((c.x, c.y, c.z) for c in (point.coord for point in itertools.compress(points, valid_mask))),
+        dtype=np.float64, count=3 * valid_points
+    ).reshape(valid_points, 3)
+    
+    # Ограничение точек: одна точка на воксель
+    if max_points and valid_points > max_points:
+        selected_rows = voxel_downsample_FIXED(valid_xyz, max_points)
+    else:
+        selected_rows = np.arange(valid_points, dtype=np.int64)
+    selected_indices = valid_indices[selected_rows]
+    
+    count = len(selected_indices)
+    cloud = empty_point_cloud_FIXED(count)
+    
+    # COLMAP использует 1-based индексы
+    cloud['ids'][:] = selected_indices + 1
+    cloud['xyz'][:] = valid_xyz[selected_rows]
+    del valid_xyz
+    
+    selected_mask = np.zeros(total_points, dtype=bool)
+    selected_mask[selected_indices] = True
+    
+    def selected_points():
+        return itertools.compress(points, selected_mask)
+    
+    # === ПРАВИЛЬНОЕ ИЗВЛЕЧЕНИЕ ЦВЕТА ===
+    color_source = _detect_tie_point_color_source_FIXED(tie_points, points[int(selected_indices[0])])
+    print(f"🔍 Источник цвета: {color_source or 'не найден'}")
+    
+    track_colors = None
+    if color_source == 'track':
+        # Цвета всех треков копируются один раз и индексируются track_id
+        tracks = tie_points.tracks
+        track_colors = np.fromiter(
+            itertools.chain.from_iterable(tuple(track.color)[:3] for track in tracks),
+            dtype=np.float64, count=3 * len(tracks)
+        ).reshape(-1, 3)
+    
+    colors, errors = _read_point_attributes_FIXED(tie_points, selected_points, count, selected_indices,
+                                                  color_source, track_colors=track_colors)
+    if colors is not None:
+        cloud['rgb'][:] = _normalize_colors_FIXED(colors)
+    
+    # Ошибка реконструкции
+    if errors is not None:
+        cloud['error'][:] = errors
+    
+    # Цветные точки - не серые по умолчанию
+    colored_points = count_colored_points_FIXED(cloud['rgb']) if colors is not None else 0
+    
+    # Диагностическая информация
+    print(f"✅ Извлечено точек: {count}")
+    print(f"📊 Валидных точек: {valid_points}")
+    print(f"🎨 Цветных точек: {colored_points}")
+    print(f"⚪ Серых точек: {count - colored_points}")
+    
+    color_ratio = colored_points / count if count > 0 else 0
+    print(f"📈 Процент цветных точек: {color_ratio:.1%}")
+    
+    if color_ratio < 0.3:
+        print("⚠️  ВНИМАНИЕ: Мало цветных точек!")
+        print("💡 Попробуйте выполнить: Tools -> Dense Cloud -> Calculate Point Colors")
+    elif color_ratio < 0.7:
+        print("⚠️  Цветность облака приемлемая, но можно улучшить")
+    else:
+        print("✅ Цветность облака отличная")
+    
+    return cloud
+
+# Исходных точек Metashape на одну порцию потокового экспорта
+POINT_STREAM_CHUNK_SIZE = 250_000
+
+def iter_colored_point_cloud_chunks_FIXED(chunk, chunk_size=POINT_STREAM_CHUNK_SIZE, track_ids=False):
+    """
+    Потоковое извлечение цветного облака порциями без прореживания
+    
+    Точки читаются окнами по chunk_size исходных точек, из каждого окна
+    выдается облако валидных точек (см. empty_point_cloud_FIXED). Память
+    пропорциональна размеру порции, а не облака.
+    
+    Args:
+        chunk: Metashape.Chunk
+        chunk_size: исходных точек в порции
+        track_ids: добавить в облако порции 'track_ids' (N,) - track_id точек
+    
+    Yields:
+        dict: облако точек порции, id возрастают от порции к порции
+    """
+    if not chunk.tie_points:
+        print("❌ Разреженное облако отсутствует!")
+        return
+    
+    tie_points = chunk.tie_points
+    points = tie_points.points
+    total_points = len(points)
+    if total_points == 0:
+        return
+    
+    color_source = _detect_tie_point_color_source_FIXED(tie_points, points[0])
+    print(f"🌊 Потоковое извлечение облака: {total_points} точек порциями по {chunk_size}, источник цвета: {color_source or 'не найден'}")
+    
+    point_iter = iter(points)
+    for start in range(0, total_points, chunk_size):
+        window = list(itertools.islice(point_iter, chunk_size))
+        valid_mask = np.fromiter((point.valid for point in window), dtype=bool, count=len(window))
+        valid_window = list(itertools.compress(window, valid_mask))
+        del window
+        
+        count = len(valid_window)
+        if count == 0:
+            continue
+        
+        cloud = empty_point_cloud_FIXED(count)
+        source_indices = start + np.flatnonzero(valid_mask)
+        cloud['ids'][:] = source_indices + 1
+        cloud['xyz'][:] = np.fromiter(
+            itertools.chain.from_iterable((c.x, c.y, c.z) for c in (point.coord for point in valid_window)),
+            dtype=np.float64, count=3 * count
+        ).reshape(count, 3)
+        
+        colors, errors = _read_point_attributes_FIXED(tie_points, lambda: iter(valid_window), count,
+                                                      source_indices, color_source)
+        if colors is not None:
+            cloud['rgb'][:] = _normalize_colors_FIXED(colors)
+        if errors is not None:
+            cloud['error'][:] = errors
+        if track_ids:
+            cloud['track_ids'] = _point_track_ids_FIXED(valid_window, source_indices)
+        yield cloud
+
+class TiePointCloudStream:
+    """
+    Облако связующих точек чанка, читаемое порциями при экспорте
+    
+    Передается в export_cubemap_3dgs_FIXED вместо облака-словаря: points3D.bin
+    пишется порция за порцией, треки считаются для каждой порции отдельно.
+    Наблюдения порции собираются из проекций камер, отфильтрованных по track_id
+    ее точек: проекции перечитываются для каждой порции, зато в памяти только
+    порция и проекции одной камеры.
+    """
+    
+    def __init__(self, chunk, spherical_cameras, point_tracks=True, chunk_size=POINT_STREAM_CHUNK_SIZE):
+        self.chunk = chunk
+        self.spherical_cameras = spherical_cameras
+        self.point_tracks = point_tracks
+        self.chunk_size = chunk_size
+    
+    def __iter__(self):
+        use_projections = self.point_tracks
+        for cloud in iter_colored_point_cloud_chunks_FIXED(self.chunk, self.chunk_size, track_ids=self.point_tracks):
+            track_ids = cloud.pop('track_ids', None)
+            if use_projections:
+                try:
+                    observations = _projection_observations_FIXED(
+                        self.chunk.tie_points.projections, self.spherical_cameras,
+                        track_ids, np.arange(len(track_ids), dtype=np.int64)
+                    )
+                except Exception as e:
+                    print(f"⚠️  Проекции связующих точек недоступны: {e}")
+                    observations = None
+                if observations is None:
+                    # Без проекций все порции используют геометрическую видимость
+                    use_projections = False
+                else:
+                    cloud['observation_cameras'], cloud['observation_points'] = observations
+            yield cloud
+
+# === ЗАПИСЬ COLMAP ФАЙЛОВ ===
+# Упакованные (без выравнивания) записи COLMAP, little-endian
+COLMAP_CAMERA_HEADER_DTYPE = np.dtype([('camera_id', '<u4'), ('model_id', '<i4'), ('width', '<u8'), ('height', '<u8')])
+COLMAP_IMAGE_HEADER_DTYPE = np.dtype([('image_id', '<u4'), ('qvec', '<f8', (4,)), ('tvec', '<f8', (3,)), ('camera_id', '<u4')])
+COLMAP_POINT2D_DTYPE = np.dtype([('xy', '<f8', (2,)), ('point3D_id', '<u8')])
+COLMAP_POINT3D_HEADER_DTYPE = np.dtype([('point3D_id', '<u8'), ('xyz', '<f8', (3,)), ('rgb', 'u1', (3,)),
+                                        ('error', '<f8'), ('track_length', '<u8')])
+COLMAP_TRACK_ELEMENT_DTYPE = np.dtype([('image_id', '<u4'), ('point2D_idx', '<u4')])
+COLMAP_COUNT_DTYPE = np.dtype('<u8')
+
+# Максимальный размер буфера одной записи блока
+COLMAP_WRITE_BLOCK_BYTES = 16 * 1024 * 1024
+
+def _as_bytes_FIXED(array):
+    """Байтовое представление массива (uint8, 1D)"""
+    return np.ascontiguousarray(array).view(np.uint8).reshape(-1)
+
+def _write_interleaved_records_FIXED(f, segments, block_bytes=COLMAP_WRITE_BLOCK_BYTES):
+    """
+    Записывает записи переменной длины блоками
+    
+    Каждая запись состоит из сегментов в заданном порядке. Для каждого сегмента
+    передаются байты всех записей подряд и длины по записям (массив смещений).
+    Байты сегментов раскладываются в буфер блока по метке сегмента каждого байта.
+    
+    Args:
+        f: открытый бинарный файл
+        segments: список (байты uint8, длины (N,)) для каждого сегмента записи
+        block_bytes: ориентировочный размер буфера одной записи
+    """
+    lengths = np.stack([np.asarray(seg_lengths, dtype=np.int64) for _, seg_lengths in segments], axis=1)
+    count, segment_count = lengths.shape
+    if count == 0:
+        return
+    
+    record_ends = np.cumsum(lengths.sum(axis=1))
+    segment_offsets = np.zeros((count + 1, segment_count), dtype=np.int64)
+    np.cumsum(lengths, axis=0, out=segment_offsets[1:])
+    segment_tags = np.arange(segment_count, dtype=np.int8)
+    
+    start = 0
+    while start < count:
+        written = record_ends[start - 1] if start > 0 else 0
+        stop = max(start + 1, int(np.searchsorted(record_ends, written + block_bytes, side='right')))
+        stop = min(stop, count)
+        
+        tags = np.repeat(np.tile(segment_tags, stop - start), lengths[start:stop].reshape(-1))
+        buffer = np.empty(len(tags), dtype=np.uint8)
+        for segment_idx, (data, _) in enumerate(segments):
+            lo, hi = segment_offsets[start, segment_idx], segment_offsets[stop, segment_idx]
+            if hi > lo:
+                buffer[tags == segment_idx] = data[lo:hi]
+        buffer.tofile(f)
+        start = stop
+
+def write_cameras_binary(cameras, path):
+    """Записывает cameras.bin в COLMAP формате"""
+    headers = np.zeros(len(cameras), dtype=COLMAP_CAMERA_HEADER_DTYPE)
+    params = []
+    for idx, (camera_id, camera) in enumerate(cameras.items()):
+        headers[idx] = (camera_id, camera['model_id'], camera['width'], camera['height'])
+        params.append(np.asarray(camera['params'], dtype='<f8').reshape(-1))
+    
+    param_counts = np.array([len(p) for p in params], dtype=np.int64)
+    param_bytes = _as_bytes_FIXED(np.concatenate(params)) if params else np.zeros(0, dtype=np.uint8)
+    
+    with open(path, "wb") as f:
+        np.array([len(cameras)], dtype=COLMAP_COUNT_DTYPE).tofile(f)
+        _write_interleaved_records_FIXED(f, [
+            (_as_bytes_FIXED(headers), np.full(len(cameras), COLMAP_CAMERA_HEADER_DTYPE.itemsize)),
+            (param_bytes, param_counts * 8)
+        ])
+
+def write_images_binary(images, path):
+    """Записывает images.bin в COLMAP формате"""
+    count = len(images)
+    headers = np.zeros(count, dtype=COLMAP_IMAGE_HEADER_DTYPE)
+    names = []
+    points2D = []
+    for idx, (image_id, image) in enumerate(images.items()):
+        headers[idx] = (image_id, image['qvec'], image['tvec'], image['camera_id'])
+        names.append(image['name'].encode('utf-8') + b'\x00')
+        xys = np.asarray(image['xys'], dtype=np.float64).reshape(-1, 2)
+        image_points = np.zeros(len(xys), dtype=COLMAP_POINT2D_DTYPE)
+        image_points['xy'] = xys
+        image_points['point3D_id'] = np.asarray(image['point3D_ids'], dtype=np.uint64).reshape(-1)
+        points2D.append(image_points)
+    
+    points2D_counts = np.array([len(p) for p in points2D], dtype=COLMAP_COUNT_DTYPE)
+    all_points2D = np.concatenate(points2D) if points2D else np.zeros(0, dtype=COLMAP_POINT2D_DTYPE)
+    
+    with open(path, "wb") as f:
+        np.array([count], dtype=COLMAP_COUNT_DTYPE).tofile(f)
+        _write_interleaved_records_FIXED(f, [
+            (_as_bytes_FIXED(headers), np.full(count, COLMAP_IMAGE_HEADER_DTYPE.itemsize)),
+            (np.frombuffer(b''.join(names), dtype=np.uint8), np.array([len(n) for n in names], dtype=np.int64)),
+            (_as_bytes_FIXED(points2D_counts), np.full(count, COLMAP_COUNT_DTYPE.itemsize)),
+            (_as_bytes_FIXED(all_points2D), points2D_counts.astype(np.int64) * COLMAP_POINT2D_DTYPE.itemsize)
+        ])
+
+class PointsBinaryWriter:
+    """
+    Потоковая запись points3D.bin: облако дописывается порциями
+    
+    В начале файла пишется нулевое количество точек, при закрытии оно
+    перезаписывается итоговым. Треки порции берутся из 'track_offsets' (N+1),
+    'track_image_ids' и 'track_point2D_idxs', если они есть, иначе треки пустые.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path, "wb")
+        np.zeros(1, dtype=COLMAP_COUNT_DTYPE).tofile(self._file)
+    
+    def write(self, points3D):
+        """Дописывает порцию облака (см. empty_point_cloud_FIXED)"""
+        count = len(points3D['ids'])
+        if count == 0:
+            return
+        headers = np.zeros(count, dtype=COLMAP_POINT3D_HEADER_DTYPE)
+        headers['point3D_id'] = points3D['ids']
+        headers['xyz'] = points3D['xyz']
+        headers['rgb'] = points3D['rgb']
+        headers['error'] = points3D['error']
+        self.count += count
+        
+        track_offsets = points3D.get('track_offsets')
+        if track_offsets is None or track_offsets[-1] == 0:
+            # Без треков все записи одной длины - одна запись массива
+            headers.tofile(self._file)
+            return
+        
+        track_lengths = np.diff(np.asarray(track_offsets, dtype=np.int64))
+        headers['track_length'] = track_lengths
+        tracks = np.zeros(int(track_offsets[-1]), dtype=COLMAP_TRACK_ELEMENT_DTYPE)
+        tracks['image_id'] = points3D['track_image_ids']
+        tracks['point2D_idx'] = points3D['track_point2D_idxs']
+        _write_interleaved_records_FIXED(self._file, [
+            (_as_bytes_FIXED(headers), np.full(count, COLMAP_POINT3D_HEADER_DTYPE.itemsize)),
+            (_as_bytes_FIXED(tracks), track_lengths * COLMAP_TRACK_ELEMENT_DTYPE.itemsize)
+        ])
+    
+    def close(self):
+        """Записывает итоговое количество точек в заголовок и закрывает файл"""
+        if self._file.closed:
+            return
+        self._file.seek(0)
+        np.array([self.count], dtype=COLMAP_COUNT_DTYPE).tofile(self._file)
+        self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+def write_points3D_binary(points3D, path):
+    """Записывает points3D.bin в COLMAP формате (облако точек в виде массивов)"""
+    with PointsBinaryWriter(path) as writer:
+        writer.write(points3D)
+
+# === HEADLESS: МАНИФЕСТ КАМЕР ===
+CUBE_FACE_SUFFIXES = ["_front", "_right", "_left", "_top", "_down", "_back"]
+
+class ManifestCamera:
+    """
+    Сферическая камера из манифеста (без Metashape)
+    
+    Args:
+        label: метка камеры
+        image_path: путь к эквиректангулярной панораме
+        transform: матрица 4x4 camera-to-chunk (как camera.transform в Metashape)
+    """
+    
+    def __init__(self, label, image_path, transform):
+        self.label = label
+        self.image_path = image_path
+        self.transform = np.asarray(transform, dtype=np.float64).reshape(4, 4)
+
+def find_spherical_cameras_FIXED(chunk):
+    """Возвращает (сферические камеры, существующие кубические камеры) чанка"""
+    spherical_cameras = []
+    existing_cube_cameras = []
+    
+    for cam in chunk.cameras:
+        if cam.transform and cam.photo and cam.enabled:
+            is_cube_face = any(cam.label.endswith(suffix) for suffix in CUBE_FACE_SUFFIXES)
+            if is_cube_face:
+                existing_cube_cameras.append(cam)
+            else:
+                spherical_cameras.append(cam)
+    
+    return spherical_cameras, existing_cube_cameras
+
+def spherical_camera_image_path_FIXED(camera):
+    """Путь к панораме для камеры Metashape или ManifestCamera"""
+    if isinstance(camera, ManifestCamera):
+        return camera.image_path
+    return camera.photo.path
+
+# === ПРЕДВАРИТЕЛЬНАЯ ПРОВЕРКА ПАНОРАМ ПО ЗАГОЛОВКАМ ===
+# Грубые оценки для плана: байт на пиксель закодированной грани и
+# мегапикселей в секунду на поток (декодирование панорамы, remap и кодирование граней)
+ESTIMATED_FACE_BYTES_PER_PIXEL = {'jpg': 0.6, 'png': 2.0}
+ESTIMATED_DECODE_MEGAPIXELS_PER_SECOND = 80
+ESTIMATED_FACE_MEGAPIXELS_PER_SECOND = 30
+
+def preflight_spherical_cameras_FIXED(cameras, face_size=None, face_count=6, file_ext="jpg", downscales=(),
+                                      overlap=10, reduced_decode=True, probe_threads=16):
+    """
+    Проверяет панорамы до тяжелой работы: только заголовки файлов, параллельно
+    
+    Находит отсутствующие файлы, определяет размер граней каждой камеры,
+    группирует камеры по разрешению (подряд идущие камеры одной группы
+    используют одни карты проекции из кэша) и оценивает объем граней и время.
+    
+    Args:
+        cameras: камеры Metashape или ManifestCamera
+        face_size: размер грани (None = автоматически по ширине панорамы)
+        face_count: число граней на камеру
+        file_ext: формат граней ("jpg" или "png") для оценки объема
+        downscales: множители уменьшенных копий граней
+        overlap: перекрытие граней в градусах (уровень уменьшенного декодирования JPEG)
+        reduced_decode: учитывать декодирование JPEG в уменьшенном разрешении
+        probe_threads: потоки чтения заголовков
+    
+    Returns:
+        dict: 'missing' - метки камер без файла панорамы,
+              'groups' - {(ширина, высота) или None: [камеры]}, None - заголовок не распознан,
+              'face_sizes' - {метка камеры: размер грани},
+              'output_bytes' - оценка объема граней,
+              'cpu_seconds' - оценка времени обработки в одном потоке
+    """
+    def probe(camera):
+        path = spherical_camera_image_path_FIXED(camera)
+        if not path or not os.path.isfile(path):
+            return camera, False, None
+        return camera, True, probe_image_header_FIXED(path)
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, probe_threads)) as executor:
+        probes = list(executor.map(probe, cameras))
+    
+    scale_factor = 1 + sum(1 / factor ** 2 for factor in downscales)
+    bytes_per_pixel = ESTIMATED_FACE_BYTES_PER_PIXEL.get(file_ext, ESTIMATED_FACE_BYTES_PER_PIXEL['jpg'])
+    missing = []
+    groups = {}
+    face_sizes = {}
+    output_bytes = 0
+    cpu_seconds = 0.0
+    for camera, exists, header in probes:
+        if not exists:
+            missing.append(camera.label)
+            continue
+        if header is None:
+            groups.setdefault(None, []).append(camera)
+            continue
+        image_format, width, height, _ = header
+        groups.setdefault((width, height), []).append(camera)
+        
+        actual_face_size = select_face_size_FIXED(width, face_size)
+        face_sizes[camera.label] = actual_face_size
+        reduction = (select_decode_reduction_FIXED(width, actual_face_size, overlap=overlap)
+                     if reduced_decode and image_format == 'jpeg' else 1)
+        face_pixels = face_count * actual_face_size ** 2 * scale_factor
+        output_bytes += int(face_pixels * bytes_per_pixel)
+        cpu_seconds += (width * height / reduction ** 2 / 1e6 / ESTIMATED_DECODE_MEGAPIXELS_PER_SECOND
+                        + face_pixels / 1e6 / ESTIMATED_FACE_MEGAPIXELS_PER_SECOND)
+    
+    return {
+        'missing': missing,
+        'groups': groups,
+        'face_sizes': face_sizes,
+        'output_bytes': output_bytes,
+        'cpu_seconds': cpu_seconds
+    }
+
+def spherical_camera_pose_FIXED(camera):
+    """
+    Возвращает (центр, матрица поворота 3x3) сферической камеры в numpy
+    
+    Для ManifestCamera поворот берется из матрицы 4x4 с нормировкой столбцов
+    (аналог transform.rotation() в Metashape)
+    """
+    if isinstance(camera, ManifestCamera):
+        rotation = camera.transform[:3, :3]
+        rotation = rotation / np.linalg.norm(rotation, axis=0)
+        return camera.transform[:3, 3].copy(), rotation
+    
+    center = camera.center
+    base_rotation = camera.transform.rotation()
+    rotation = np.array([[base_rotation[i, j] for j in range(3)] for i in range(3)])
+    return np.array([center.x, center.y, center.z]), rotation
+
+POINT_OBSERVATION_KEYS = ('observation_cameras', 'observation_points')
+
+def save_points_npz_FIXED(points3D, path):
+    """Сохраняет облако точек в .npz (ids, xyz, rgb, error и наблюдения камерами, если есть)"""
+    arrays = {key: points3D[key] for key in ('ids', 'xyz', 'rgb', 'error')}
+    arrays.update({key: points3D[key] for key in POINT_OBSERVATION_KEYS if key in points3D})
+    np.savez_compressed(path, **arrays)
+
+def load_points_npz_FIXED(path):
+    """Загружает облако точек, сохраненное save_points_npz_FIXED"""
+    with np.load(path) as data:
+        cloud = empty_point_cloud_FIXED(len(data['ids']))
+        for key in cloud:
+            cloud[key][:] = data[key]
+        for key in POINT_OBSERVATION_KEYS:
+            if key in data:
+                cloud[key] = data[key]
+    return cloud
+
+def export_camera_manifest_FIXED(chunk, manifest_path, points_path=None, max_points=None):
+    """
+    Экспортирует манифест сферических камер для запуска без Metashape
+    
+    Args:
+        chunk: Metashape.Chunk
+        manifest_path: путь к манифесту (.json или .csv)
+        points_path: путь к облаку точек .npz (None = не сохранять)
+        max_points: ограничение количества точек облака
+    
+    Returns:
+        int: количество камер в манифесте
+    """
+    spherical_cameras, _ = find_spherical_cameras_FIXED(chunk)
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    os.makedirs(manifest_dir, exist_ok=True)
+    
+    entries = []
+    for cam in spherical_cameras:
+        transform = [float(cam.transform[i, j]) for i in range(4) for j in range(4)]
+        entries.append({'label': cam.label, 'image': cam.photo.path, 'transform': transform})
+    
+    if manifest_path.lower().endswith(".csv"):
+        with open(manifest_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(["label", "image"] + [f"t{i}{j}" for i in range(4) for j in range(4)])
+            for entry in entries:
+                writer.writerow([entry['label'], entry['image']] + [repr(v) for v in entry['transform']])
+    else:
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump({'cameras': entries}, f, ensure_ascii=False, indent=2)
+    
+    print(f"📝 Манифест камер: {manifest_path} ({len(entries)} камер)")
+    
+    if points_path:
+        points3D = extract_colored_point_cloud_FIXED(chunk, max_points=max_points)
+        points3D.update(extract_point_observations_FIXED(chunk, points3D, spherical_cameras))
+        save_points_npz_FIXED(points3D, points_path)
+        print(f"💾 Облако точек: {points_path} ({len(points3D['ids'])} точек)")
+    
+    return len(entries)
+
+def load_camera_manifest_FIXED(manifest_path):
+    """
+    Загружает манифест камер (.json или .csv)
+    
+    Относительные пути панорам считаются от папки манифеста.
+    
+    Returns:
+        list: список ManifestCamera
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    
+    if manifest_path.lower().endswith(".csv"):
+        with open(manifest_path, newline="", encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        entries = [
+            {
+                'label': row['label'],
+                'image': row['image'],
+                'transform': [float(row[f"t{i}{j}"]) for i in range(4) for j in range(4)]
+            }
+            for row in rows
+        ]
+    else:
+        with open(manifest_path, encoding="utf-8") as f:
+            data = json.load(f)
+        entries = data['cameras'] if isinstance(data, dict) else data
+    
+    cameras = []
+    for entry in entries:
+        image_path = entry['image']
+        if not os.path.isabs(image_path):
+            image_path = os.path.join(manifest_dir, image_path)
+        cameras.append(ManifestCamera(entry['label'], image_path, entry['transform']))
+    
+    return cameras
+
+# === ПРОГРЕСС ТРЕКЕР ===
+class ProgressTracker:
+    """Простой трекер прогресса с временными оценками"""
+    
+    def __init__(self, title="Spherical to 3DGS FIXED"):
+        self.title = title
+        self.start_time = time.time()
+        self.stage_start = time.time()
+    
+    def update(self, current, total, message="", stage_change=False):
+        """Обновляет прогресс"""
+        if stage_change:
+            self.stage_start = time.time()
+        
+        percent = int((current / total) * 100) if total > 0 else 0
+        elapsed = time.time() - self.start_time
+        
+        # Оценка оставшегося времени
+        if current > 0:
+            estimated_total = elapsed * (total / current)
+            remaining = max(0, estimated_total - elapsed)
+            if remaining < 60:
+                time_str = f" | Осталось: {remaining:.0f}с"
+            elif remaining < 3600:
+                time_str = f" | Осталось: {remaining/60:.1f}мин"
+            else:
+                time_str = f" | Осталось: {remaining/3600:.1f}ч"
+        else:
+            time_str = ""
+        
+        status = f"📊 [{percent:3d}%] {message}{time_str}"
+        print(status)
+        
+        # Обновляем GUI Metashape если возможно
+        try:
+            if hasattr(Metashape.app, 'update'):
+                Metashape.app.update()
+        except:
+            pass
+
+# === ИСПРАВЛЕННАЯ ФУНКЦИЯ СОЗДАНИЯ КУБИЧЕСКИХ КАМЕР ===
+# Каждые N созданных камер печатается одна строка лога
+CAMERA_CREATION_LOG_EVERY = 500
+
+def build_cubemap_sensor_index_FIXED(chunk):
+    """Индекс Frame-сенсоров чанка по (ширина, высота, округленное фокусное расстояние)"""
+    sensor_index = {}
+    for sensor in chunk.sensors:
+        if sensor.type == Metashape.Sensor.Type.Frame:
+            key = (sensor.width, sensor.height, int(round(sensor.calibration.f)))
+            sensor_index.setdefault(key, []).append(sensor)
+    return sensor_index
+
+def get_cubemap_sensor_FIXED(chunk, sensor_index, face_size, overlap=10):
+    """Находит в индексе сенсор граней (|Δf| < 1px) или создает новый"""
+    effective_fov = 90 + overlap
+    focal_length = face_size / (2 * np.tan(np.radians(effective_fov / 2)))
+    
+    rounded_focal = int(round(focal_length))
+    for focal_key in (rounded_focal, rounded_focal - 1, rounded_focal + 1):
+        for existing_sensor in sensor_index.get((face_size, face_size, focal_key), []):
+            if abs(existing_sensor.calibration.f - focal_length) < 1.0:
+                return existing_sensor
+    
+    sensor = chunk.addSensor()
+    sensor.label = f"Cubemap_{face_size}px_fov{effective_fov:.0f}"
+    sensor.type = Metashape.Sensor.Type.Frame
+    sensor.width = face_size
+    sensor.height = face_size
+    
+    # Настройки калибровки
+    calibration = sensor.calibration
+    calibration.f = focal_length
+    calibration.cx = 0.0  # Центр изображения
+    calibration.cy = 0.0
+    calibration.k1 = 0.0  # Без дисторсии
+    calibration.k2 = 0.0
+    calibration.k3 = 0.0
+    calibration.p1 = 0.0
+    calibration.p2 = 0.0
+    
+    sensor_index.setdefault((face_size, face_size, rounded_focal), []).append(sensor)
+    print(f"📷 Создан сенсор {sensor.label}")
+    return sensor
+
+def create_cubemap_cameras_batch_FIXED(chunk, results, overlap=10, sensor_index=None, progress_callback=None):
+    """
+    Создает кубические камеры в Metashape для всех результатов конвертации
+    
+    Сенсоры ищутся по индексу, ориентации всех граней считаются заранее одним
+    пакетом, камеры создаются в коротком цикле с редким логом.
+    
+    Args:
+        chunk: Metashape.Chunk
+        results: результаты конвертации ({'camera', 'face_images', 'face_size_actual'})
+        overlap: перекрытие в градусах
+        sensor_index: индекс сенсоров (None = построить по чанку)
+        progress_callback: callback(done, total, label) после каждой сферической камеры
+    
+    Returns:
+        list: список созданных камер
+    """
+    if sensor_index is None:
+        sensor_index = build_cubemap_sensor_index_FIXED(chunk)
+    
+    results = [result for result in results if result['face_images']]
+    if not results:
+        return []
+    
+    # Позиции и ориентации граней всех камер (строки - оси грани в мировых координатах)
+    poses = [spherical_camera_pose_FIXED(result['camera']) for result in results]
+    face_rotations = compute_face_rotations_FIXED([pose[1] for pose in poses])
+    face_index = {name: idx for idx, name in enumerate(COLMAP_FACE_NAMES)}
+    
+    created_cameras = []
+    failed_faces = 0
+    for result_idx, result in enumerate(results):
+        spherical_label = result['camera'].label
+        sensor = get_cubemap_sensor_FIXED(chunk, sensor_index, result['face_size_actual'], overlap)
+        translation = Metashape.Matrix.Translation(Metashape.Vector(poses[result_idx][0].tolist()))
+        
+        for face_name, image_path in result['face_images'].items():
+            if face_name not in face_index:
+                print(f"⚠️  Пропускаем неизвестную грань: {face_name}")
+                continue
+            
+            try:
+                camera = chunk.addCamera()
+                camera.label = f"{spherical_label}_{face_name}"
+                camera.sensor = sensor
+                camera.photo = Metashape.Photo()
+                camera.photo.path = image_path
+                
+                # В Metashape: строки матрицы = оси камеры в мировых координатах
+                rotation_matrix = Metashape.Matrix(face_rotations[result_idx, face_index[face_name]].tolist())
+                camera.transform = translation * Metashape.Matrix.Rotation(rotation_matrix)
+                created_cameras.append(camera)
+            except Exception as e:
+                failed_faces += 1
+                print(f"  ❌ Ошибка создания камеры {spherical_label}_{face_name}: {e}")
+                continue
+            
+            if len(created_cameras) % CAMERA_CREATION_LOG_EVERY == 0:
+                print(f"  ✅ Создано камер: {len(created_cameras)} (последняя: {camera.label})")
+        
+        if progress_callback:
+            progress_callback(result_idx + 1, len(results), spherical_label)
+    
+    print(f"🎯 Создано {len(created_cameras)} кубических камер для {len(results)} сферических"
+          + (f", ошибок: {failed_faces}" if failed_faces else ""))
+    return created_cameras
+
+def create_cubemap_cameras_FIXED(chunk, spherical_camera, face_images_paths, face_size, overlap=10, sensor_index=None):
+    """
+    ИСПРАВЛЕННАЯ функция создания кубических камер в Metashape
+    Создает 6 камер с правильными позициями и ориентациями
+    
+    Args:
+        chunk: Metashape.Chunk
+        spherical_camera: исходная сферическая камера
+        face_images_paths: словарь путей к изображениям граней
+        face_size: размер изображений граней
+        overlap: перекрытие в градусах
+        sensor_index: индекс сенсоров (None = построить по чанку)
+    
+    Returns:
+        list: список созданных камер
+    """
+    result = {'camera': spherical_camera, 'face_images': face_images_paths, 'face_size_actual': face_size}
+    return create_cubemap_cameras_batch_FIXED(chunk, [result], overlap, sensor_index=sensor_index)
+
+def split_existing_cube_cameras_FIXED(existing_cube_cameras, reused_results):
+    """
+    Делит существующие кубические камеры чанка на актуальные и устаревшие
+    
+    Камера актуальна, если ее панорама взята из журнала без конвертации, а фото,
+    размер сенсора и поза совпадают с камерой, которую создал бы
+    create_cubemap_cameras_batch_FIXED (например, после нового выравнивания поза другая).
+    
+    Args:
+        existing_cube_cameras: кубические камеры чанка (find_spherical_cameras_FIXED)
+        reused_results: результаты камер, взятые из журнала (ConversionManifest.lookup)
+    
+    Returns:
+        tuple: (метки актуальных камер (set), список устаревших камер)
+    """
+    expected = {}
+    if reused_results:
+        poses = [spherical_camera_pose_FIXED(result['camera']) for result in reused_results]
+        face_rotations = compute_face_rotations_FIXED([pose[1] for pose in poses])
+        face_index = {name: idx for idx, name in enumerate(COLMAP_FACE_NAMES)}
+        for result_idx, result in enumerate(reused_results):
+            for face_name, image_path in result['face_images'].items():
+                if face_name in face_index:
+                    expected[f"{result['camera'].label}_{face_name}"] = (
+                        os.path.normcase(os.path.abspath(image_path)), result['face_size_actual'],
+                        poses[result_idx][0], face_rotations[result_idx, face_index[face_name]]
+                    )
+    
+    current_labels = set()
+    stale_cameras = []
+    for camera in existing_cube_cameras:
+        match = expected.get(camera.label)
+        if match is not None and camera.label not in current_labels:
+            image_path, face_size, center, rotation = match
+            try:
+                camera_center, camera_rotation = spherical_camera_pose_FIXED(camera)
+                is_current = (os.path.normcase(os.path.abspath(camera.photo.path)) == image_path
+                              and camera.sensor.width == face_size
+                              and np.allclose(camera_center, center)
+                              and np.allclose(camera_rotation, rotation, atol=1e-6))
+            except Exception:
+                is_current = False
+            if is_current:
+                current_labels.add(camera.label)
+                continue
+        stale_cameras.append(camera)
+    return current_labels, stale_cameras
+
+# === COLMAP СТРУКТУРЫ ДЛЯ КУБИЧЕСКИХ ГРАНЕЙ ===
+# ИСПРАВЛЕННЫЕ направления граней для COLMAP
+COLMAP_FACE_DIRECTIONS = {
+    'front': {'forward': np.array([0, 0, 1]), 'up': np.array([0, 1, 0]), 'right': np.array([1, 0, 0])},
+    'back': {'forward': np.array([0, 0, -1]), 'up': np.array([0, 1, 0]), 'right': np.array([-1, 0, 0])},
+    'right': {'forward': np.array([1, 0, 0]), 'up': np.array([0, 1, 0]), 'right': np.array([0, 0, -1])},
+    'left': {'forward': np.array([-1, 0, 0]), 'up': np.array([0, 1, 0]), 'right': np.array([0, 0, 1])},
+    'top': {'forward': np.array([0, 1, 0]), 'up': np.array([0, 0, -1]), 'right': np.array([1, 0, 0])},
+    'down': {'forward': np.array([0, -1, 0]), 'up': np.array([0, 0, 1]), 'right': np.array([1, 0, 0])}
+}
+COLMAP_FACE_NAMES = list(COLMAP_FACE_DIRECTIONS)
+# Матрицы граней (6,3,3): строки - right, up, forward в системе сферической камеры
+COLMAP_FACE_AXES = np.stack([
+    np.stack([COLMAP_FACE_DIRECTIONS[name]['right'], COLMAP_FACE_DIRECTIONS[name]['up'],
+              COLMAP_FACE_DIRECTIONS[name]['forward']])
+    for name in COLMAP_FACE_NAMES
+]).astype(np.float64)
+
+def compute_face_rotations_FIXED(rotations):
+    """
+    Повороты граней всех камер: R_грани = F_грани @ B^T (строки - оси грани в мировых координатах)
+    
+    Args:
+        rotations: (N,3,3) повороты сферических камер (camera-to-world)
+    
+    Returns:
+        np.ndarray: (N,6,3,3) в порядке COLMAP_FACE_NAMES
+    """
+    rotations = np.asarray(rotations, dtype=np.float64).reshape(-1, 3, 3)
+    return np.einsum('fij,nkj->nfik', COLMAP_FACE_AXES, rotations)
+
+def compute_face_poses_FIXED(rotations, centers):
+    """
+    Пакетный расчет COLMAP поз всех граней всех камер
+    
+    R_грани = F_грани @ B^T (строки F - right, up, forward), t = -R @ C
+    
+    Args:
+        rotations: (N,3,3) повороты сферических камер (camera-to-world)
+        centers: (N,3) центры сферических камер
+    
+    Returns:
+        tuple: (qvecs (6N,4), tvecs (6N,3)) - грани камеры подряд в порядке COLMAP_FACE_NAMES
+    """
+    centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+    
+    face_rotations = compute_face_rotations_FIXED(rotations)
+    tvecs = -np.einsum('nfik,nk->nfi', face_rotations, centers)
+    qvecs = rotation_matrices_to_quaternions(face_rotations.reshape(-1, 3, 3))
+    return qvecs, tvecs.reshape(-1, 3)
+
+def build_colmap_model_FIXED(successful_results, overlap=10):
+    """
+    Создает COLMAP структуры cameras/images для сгенерированных граней
+    
+    Args:
+        successful_results: результаты конвертации ({'camera', 'face_images', 'face_size_actual'})
+        overlap: перекрытие граней в градусах
+    
+    Returns:
+        tuple: (cameras_colmap, images_colmap, face_image_ids) - face_image_ids[i]
+               сопоставляет грани i-го результата с image_id
+    """
+    cameras_colmap = {}
+    images_colmap = {}
+    face_image_ids = []
+    camera_params_to_id = {}
+    next_camera_id = 1
+    next_image_id = 1
+    
+    # Позы всех граней всех камер одним пакетом
+    face_index = {name: idx for idx, name in enumerate(COLMAP_FACE_NAMES)}
+    poses = [spherical_camera_pose_FIXED(result['camera']) for result in successful_results]
+    if poses:
+        qvecs, tvecs = compute_face_poses_FIXED([pose[1] for pose in poses], [pose[0] for pose in poses])
+        qvecs = qvecs.reshape(len(poses), len(COLMAP_FACE_NAMES), 4)
+        tvecs = tvecs.reshape(len(poses), len(COLMAP_FACE_NAMES), 3)
+    
+    for result_idx, result in enumerate(successful_results):
+        result_image_ids = {}
+        face_image_ids.append(result_image_ids)
+        if not result['face_images']:
+            continue
+        
+        # Параметры камеры с учетом перекрытия
+        face_size_actual = result['face_size_actual']
+        effective_fov = 90 + overlap
+        focal_length = face_size_actual / (2 * np.tan(np.radians(effective_fov / 2)))
+        cx = cy = face_size_actual / 2.0
+        
+        # Группируем одинаковые камеры
+        camera_key = (face_size_actual, face_size_actual, focal_length, cx, cy)
+        
+        if camera_key not in camera_params_to_id:
+            camera_params_to_id[camera_key] = next_camera_id
+            cameras_colmap[next_camera_id] = {
+                'model': 'PINHOLE',
+                'model_id': CAMERA_MODEL_IDS['PINHOLE'],
+                'width': face_size_actual,
+                'height': face_size_actual,
+                'params': [focal_length, focal_length, cx, cy]
+            }
+            camera_id = next_camera_id
+            next_camera_id += 1
+        else:
+            camera_id = camera_params_to_id[camera_key]
+        
+        # Создаем изображения для каждой грани
+        for face_name, image_path in result['face_images'].items():
+            if face_name not in face_index:
+                continue
+            
+            # Добавляем изображение в COLMAP структуру
+            filename = os.path.basename(image_path)
+            images_colmap[next_image_id] = {
+                'qvec': qvecs[result_idx, face_index[face_name]],
+                'tvec': tvecs[result_idx, face_index[face_name]],
+                'camera_id': camera_id,
+                'name': filename,
+                'xys': [],           # Пустой для 3DGS
+                'point3D_ids': []    # Заполняется attach_point_tracks_FIXED
+            }
+            result_image_ids[face_name] = next_image_id
+            next_image_id += 1
+    
+    return cameras_colmap, images_colmap, face_image_ids
+
+# === ТРЕКИ COLMAP: ПРОЕКЦИЯ ТОЧЕК В ГРАНИ ===
+# Лимит пар (точка, камера) для геометрической видимости без проекций Metashape
+MAX_GEOMETRIC_VISIBILITY_PAIRS = 200_000_000
+# Байт промежуточных массивов на пару (точка, камера) при проекции в 6 граней
+VISIBILITY_BYTES_PER_PAIR = 512
+
+def _point_track_ids_FIXED(points, source_indices):
+    """track_id точек (N,) int64; без атрибута track_id - исходные индексы точек"""
+    if len(points) and hasattr(points[0], 'track_id'):
+        return np.fromiter((point.track_id for point in points), dtype=np.int64, count=len(points))
+    return np.asarray(source_indices, dtype=np.int64)
+
+def _projection_observations_FIXED(projections, spherical_cameras, track_ids, point_rows):
+    """
+    Пары (сферическая камера, строка точки) из проекций для точек с заданными track_id
+    
+    Проекции читаются по одной камере и сопоставляются с track_ids поиском
+    в отсортированном массиве: проекции других точек отбрасываются сразу.
+    
+    Args:
+        projections: chunk.tie_points.projections
+        spherical_cameras: список сферических камер (индексы пар - позиции в нем)
+        track_ids: (N,) track_id точек
+        point_rows: (N,) значение, возвращаемое в парах для каждой точки
+    
+    Returns:
+        tuple: (камеры (K,) int32, строки точек (K,) int64) или None, если ни у одной камеры нет проекций
+    """
+    order = np.argsort(track_ids, kind='stable')
+    sorted_tracks = track_ids[order]
+    sorted_rows = np.asarray(point_rows, dtype=np.int64)[order]
+    del order
+    
+    observation_cameras = []
+    observation_points = []
+    for camera_idx, camera in enumerate(spherical_cameras):
+        camera_projections = projections[camera]
+        if not camera_projections:
+            continue
+        projection_tracks = np.fromiter((proj.track_id for proj in camera_projections), dtype=np.int64)
+        if len(sorted_tracks):
+            positions = np.minimum(np.searchsorted(sorted_tracks, projection_tracks), len(sorted_tracks) - 1)
+            rows = sorted_rows[positions[sorted_tracks[positions] == projection_tracks]]
+        else:
+            rows = np.zeros(0, dtype=np.int64)
+        observation_cameras.append(np.full(len(rows), camera_idx, dtype=np.int32))
+        observation_points.append(rows)
+    
+    if not observation_cameras:
+        return None
+    return np.concatenate(observation_cameras), np.concatenate(observation_points)
+
+def _tie_point_observation_indices_FIXED(chunk, spherical_cameras):
+    """
+    Пары (сферическая камера, исходный индекс точки) из проекций связующих точек Metashape
+    
+    Returns:
+        tuple: (камеры (K,) int32, индексы точек (K,) int64) или None, если проекции недоступны
+    """
+    try:
+        tie_points = chunk.tie_points
+        points = tie_points.points
+        total_points = len(points)
+        source_indices = np.arange(total_points, dtype=np.int64)
+        observations = _projection_observations_FIXED(
+            tie_points.projections, spherical_cameras, _point_track_ids_FIXED(points, source_indices), source_indices
+        )
+    except Exception as e:
+        print(f"⚠️  Проекции связующих точек недоступны: {e}")
+        return None
+    
+    if observations is None:
+        return None
+    print(f"👁️  Наблюдений точек сферическими камерами: {len(observations[1])}")
+    return observations
+
+def extract_point_observations_FIXED(chunk, points3D, spherical_cameras):
+    """
+    Пары (сферическая камера, точка облака) из проекций связующих точек Metashape
+    
+    Args:
+        chunk: Metashape.Chunk
+        points3D: облако точек (см. extract_colored_point_cloud_FIXED)
+        spherical_cameras: список сферических камер (индексы пар - позиции в нем)
+    
+    Returns:
+        dict: 'observation_cameras' (K,) int32, 'observation_points' (K,) int64 - строки облака;
+              пустой dict, если проекции недоступны
+    """
+    observations = _tie_point_observation_indices_FIXED(chunk, spherical_cameras)
+    if observations is None:
+        return {}
+    observation_cameras, point_indices = observations
+    
+    # Строка облака для каждого исходного индекса точки (-1 = точка не экспортируется)
+    row_of_point = np.full(len(chunk.tie_points.points), -1, dtype=np.int64)
+    row_of_point[points3D['ids'].astype(np.int64) - 1] = np.arange(len(points3D['ids']))
+    rows = row_of_point[point_indices]
+    exported = rows >= 0
+    
+    return {
+        'observation_cameras': observation_cameras[exported],
+        'observation_points': rows[exported]
+    }
+
+def project_observations_to_faces_FIXED(points_xyz, camera_centers, camera_rotations, camera_face_image_ids,
+                                         camera_face_sizes, overlap, observation_cameras, observation_points,
+                                         memory_megabytes=256):
+    """
+    Проецирует пары (камера, точка) в 6 граней куба пакетами и оставляет попавшие в кадр
+    
+    Для каждой пары точка переводится в систему сферической камеры, затем одним
+    einsum умножается на 6 матриц граней и проецируется пинхол-моделью грани.
+    Пары обрабатываются порциями, промежуточные массивы ограничены memory_megabytes.
+    
+    Args:
+        points_xyz: (N,3) координаты точек
+        camera_centers: (C,3) центры сферических камер
+        camera_rotations: (C,3,3) повороты сферических камер (camera-to-world)
+        camera_face_image_ids: (C,6) image_id граней в порядке COLMAP_FACE_NAMES, 0 = грани нет
+        camera_face_sizes: (C,) размер граней камеры в пикселях
+        overlap: перекрытие граней в градусах
+        observation_cameras, observation_points: пары (индекс камеры, строка точки);
+            None - все пары (генерируются порциями)
+    
+    Returns:
+        tuple: (image_ids (K,), point_rows (K,), xys (K,2)) наблюдений точек в гранях
+    """
+    half_tan = np.tan(np.radians((90 + overlap) / 2))
+    camera_focals = camera_face_sizes / (2 * half_tan)
+    
+    pairs_per_batch = max(1024, int(memory_megabytes * 1024 * 1024 // VISIBILITY_BYTES_PER_PAIR))
+    
+    point_count = len(points_xyz)
+    pair_count = point_count * len(camera_centers) if observation_points is None else len(observation_points)
+    
+    image_ids_out = []
+    point_rows_out = []
+    xys_out = []
+    for start in range(0, pair_count, pairs_per_batch):
+        if observation_points is None:
+            cams, rows = np.divmod(np.arange(start, min(start + pairs_per_batch, pair_count)), point_count)
+        else:
+            cams = observation_cameras[start:start + pairs_per_batch]
+            rows = observation_points[start:start + pairs_per_batch]
+        
+        # Направление на точку в системе сферической камеры: B^T (X - C)
+        local = np.einsum('pji,pj->pi', camera_rotations[cams], points_xyz[rows] - camera_centers[cams])
+        # Координаты в системах всех 6 граней: (пары, грани, 3)
+        face_coords = np.einsum('fij,pj->pfi', COLMAP_FACE_AXES, local)
+        
+        depth = face_coords[..., 2]
+        visible = (depth > 0) & (camera_face_image_ids[cams] > 0)
+        safe_depth = np.where(visible, depth, 1.0)
+        focal = camera_focals[cams][:, None]
+        size = camera_face_sizes[cams][:, None].astype(np.float64)
+        u = focal * face_coords[..., 0] / safe_depth + size / 2.0
+        v = focal * face_coords[..., 1] / safe_depth + size / 2.0
+        visible &= (u >= 0) & (u < size) & (v >= 0) & (v < size)
+        
+        pair_idx, face_idx = np.nonzero(visible)
+        image_ids_out.append(camera_face_image_ids[cams[pair_idx], face_idx])
+        point_rows_out.append(rows[pair_idx])
+        xys_out.append(np.stack([u[pair_idx, face_idx], v[pair_idx, face_idx]], axis=1))
+    
+    if not image_ids_out:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros((0, 2))
+    return np.concatenate(image_ids_out), np.concatenate(point_rows_out), np.concatenate(xys_out)
+
+def attach_point_tracks_FIXED(points3D, images_colmap, successful_results, face_image_ids,
+                              spherical_cameras, overlap=10, memory_megabytes=256, verbose=True):
+    """
+    Заполняет xys/point3D_ids изображений и треки точек облака
+    
+    Пары (камера, точка) берутся из 'observation_cameras'/'observation_points' облака;
+    без них используется геометрическая видимость всех точек всеми камерами
+    (до MAX_GEOMETRIC_VISIBILITY_PAIRS пар).
+    
+    Returns:
+        int: количество наблюдений
+    """
+    point_count = len(points3D['ids'])
+    
+    # Индексы камер - позиции в spherical_cameras (объекты камер одни и те же на всем экспорте)
+    camera_index = {id(cam): idx for idx, cam in enumerate(spherical_cameras)}
+    camera_count = len(spherical_cameras)
+    camera_centers = np.zeros((camera_count, 3))
+    camera_rotations = np.tile(np.eye(3), (camera_count, 1, 1))
+    camera_face_image_ids = np.zeros((camera_count, len(COLMAP_FACE_NAMES)), dtype=np.int64)
+    camera_face_sizes = np.ones(camera_count, dtype=np.int64)
+    
+    for result, result_image_ids in zip(successful_results, face_image_ids):
+        idx = camera_index.get(id(result['camera']))
+        if idx is None or not result_image_ids:
+            continue
+        camera_centers[idx], camera_rotations[idx] = spherical_camera_pose_FIXED(result['camera'])
+        camera_face_sizes[idx] = result['face_size_actual']
+        for face_idx, face_name in enumerate(COLMAP_FACE_NAMES):
+            camera_face_image_ids[idx, face_idx] = result_image_ids.get(face_name, 0)
+    
+    if 'observation_points' in points3D:
+        observation_cameras = np.asarray(points3D['observation_cameras'], dtype=np.int64)
+        observation_points = np.asarray(points3D['observation_points'], dtype=np.int64)
+        in_range = (observation_cameras < camera_count) & (observation_points < point_count)
+        observation_cameras = observation_cameras[in_range]
+        observation_points = observation_points[in_range]
+    else:
+        pair_count = point_count * camera_count
+        if pair_count > MAX_GEOMETRIC_VISIBILITY_PAIRS:
+            print(f"⚠️  Нет проекций точек, {pair_count} пар для геометрической видимости - треки не создаются")
+            return 0
+        if verbose:
+            print(f"👁️  Нет проекций точек: геометрическая видимость ({pair_count} пар)")
+        observation_cameras = observation_points = None
+    
+    image_ids, point_rows, xys = project_observations_to_faces_FIXED(
+        points3D['xyz'], camera_centers, camera_rotations, camera_face_image_ids, camera_face_sizes,
+        overlap, observation_cameras, observation_points, memory_megabytes=memory_megabytes
+    )
+    
+    # 2D точки изображений: по image_id, внутри - по строке точки; point2D_idx - позиция в изображении
+    image_order = np.lexsort((point_rows, image_ids))
+    image_ids_sorted = image_ids[image_order]
+    image_starts = np.searchsorted(image_ids_sorted, image_ids_sorted, side='left')
+    point2D_idxs = np.empty(len(image_ids), dtype=np.int64)
+    point2D_idxs[image_order] = np.arange(len(image_ids)) - image_starts
+    
+    bounds = np.searchsorted(image_ids_sorted, np.array(list(images_colmap.keys()), dtype=np.int64))
+    bounds_end = np.searchsorted(image_ids_sorted, np.array(list(images_colmap.keys()), dtype=np.int64), side='right')
+    for (image_id, image), lo, hi in zip(images_colmap.items(), bounds, bounds_end):
+        selected = image_order[lo:hi]
+        image['xys'] = xys[selected]
+        image['point3D_ids'] = points3D['ids'][point_rows[selected]]
+    
+    # Треки точек: по строке точки, внутри - по image_id
+    track_order = np.lexsort((image_ids, point_rows))
+    points3D['track_offsets'] = np.concatenate(([0], np.cumsum(np.bincount(point_rows, minlength=point_count))))
+    points3D['track_image_ids'] = image_ids[track_order].astype(np.uint32)
+    points3D['track_point2D_idxs'] = point2D_idxs[track_order].astype(np.uint32)
+    
+    if verbose:
+        print(f"👁️  Наблюдений точек в гранях: {len(image_ids)} "
+              f"(точек с треками: {int(np.count_nonzero(np.diff(points3D['track_offsets'])))} из {point_count})")
+    return len(image_ids)
+
+def write_points3D_stream_FIXED(point_stream, path, images_colmap, successful_results, face_image_ids,
+                                spherical_cameras, overlap=10, point_tracks=True, memory_megabytes=256):
+    """
+    Пишет points3D.bin из потока порций облака и заполняет 2D точки изображений
+    
+    Треки считаются attach_point_tracks_FIXED для каждой порции; порции идут по
+    возрастанию строк облака, поэтому дописывание 2D точек в конец изображения
+    дает тот же порядок, что и расчет по всему облаку сразу.
     
     Returns:
-        list: список созданных камер
+        tuple: (количество точек, количество цветных точек)
     """
-    print(f"🎯 Создание кубических камер для {spherical_camera.label}...")
+    image_ids = np.array(list(images_colmap.keys()), dtype=np.int64)
+    image_point_counts = np.zeros(int(image_ids.max()) + 1 if len(image_ids) else 0, dtype=np.int64)
+    image_xys = {image_id: [] for image_id in images_colmap}
+    image_point3D_ids = {image_id: [] for image_id in images_colmap}
     
-    # Получаем позицию исходной сферической камеры
-    camera_center = spherical_camera.center
-    camera_transform = spherical_camera.transform
+    colored_points = 0
+    observation_count = 0
+    with PointsBinaryWriter(path) as writer:
+        for cloud in point_stream:
+            if point_tracks and len(cloud['ids']):
+                chunk_images = {image_id: {} for image_id in images_colmap}
+                observation_count += attach_point_tracks_FIXED(
+                    cloud, chunk_images, successful_results, face_image_ids, spherical_cameras,
+                    overlap, memory_megabytes=memory_megabytes, verbose=False
+                )
+                if 'track_image_ids' in cloud:
+                    # Индексы 2D точек продолжают нумерацию предыдущих порций
+                    cloud['track_point2D_idxs'] += image_point_counts[cloud['track_image_ids']].astype(np.uint32)
+                    for image_id, image in chunk_images.items():
+                        if len(image['xys']):
+                            image_xys[image_id].append(image['xys'])
+                            image_point3D_ids[image_id].append(image['point3D_ids'])
+                            image_point_counts[image_id] += len(image['xys'])
+            
+            writer.write(cloud)
+            colored_points += count_colored_points_FIXED(cloud['rgb'])
     
-    # Базовая ориентация сферической камеры
-    base_rotation = camera_transform.rotation()
+    for image_id, image in images_colmap.items():
+        if image_xys[image_id]:
+            image['xys'] = np.concatenate(image_xys[image_id])
+            image['point3D_ids'] = np.concatenate(image_point3D_ids[image_id])
     
-    # Вычисляем параметры камеры с учетом перекрытия
-    effective_fov = 90 + overlap
-    focal_length = face_size / (2 * np.tan(np.radians(effective_fov / 2)))
+    if point_tracks:
+        print(f"👁️  Наблюдений точек в гранях: {observation_count}")
+    return writer.count, colored_points
+
+# === ЖУРНАЛ КОНВЕРТАЦИИ: ВОЗОБНОВЛЕНИЕ И ИНКРЕМЕНТАЛЬНЫЕ ЗАПУСКИ ===
+CONVERSION_MANIFEST_NAME = "cubemap_manifest.jsonl"
+
+class ConversionManifest:
+    """
+    Журнал конвертации в папке экспорта: одна строка JSON на панораму
     
-    # Создаем или находим подходящий сенсор
-    sensor = None
-    for existing_sensor in chunk.sensors:
-        if (existing_sensor.type == Metashape.Sensor.Type.Frame and
-            existing_sensor.width == face_size and
-            existing_sensor.height == face_size and
-            abs(existing_sensor.calibration.f - focal_length) < 1.0):
-            sensor = existing_sensor
-            break
+    Запись хранит размер и mtime исходного файла, параметры конвертации,
+    имена файлов граней и пропущенные малотекстурные грани с их долей текстуры. Строка дописывается сразу после конвертации камеры,
+    поэтому после падения готовые панорамы повторно не конвертируются.
+    При чтении действует последняя строка для метки камеры, close()
+    переписывает журнал без устаревших строк.
+    """
     
-    if sensor is None:
-        sensor = chunk.addSensor()
-        sensor.label = f"Cubemap_{face_size}px_fov{effective_fov:.0f}"
-        sensor.type = Metashape.Sensor.Type.Frame
-        sensor.width = face_size
-        sensor.height = face_size
-        
-        # Настройки калибровки
-        calibration = sensor.calibration
-        calibration.f = focal_length
-        calibration.cx = 0.0  # Центр изображения
-        calibration.cy = 0.0
-        calibration.k1 = 0.0  # Без дисторсии
-        calibration.k2 = 0.0
-        calibration.k3 = 0.0
-        calibration.p1 = 0.0
-        calibration.p2 = 0.0
-    
-    # ПРАВИЛЬНЫЕ направления граней в системе координат Metashape (Y вверх, Z вперед)
-    face_directions = {
-        'front': {
-            'forward': Metashape.Vector([0, 0, 1]),    # Вперед по Z
-            'up': Metashape.Vector([0, 1, 0]),         # Вверх по Y
-            'right': Metashape.Vector([1, 0, 0])       # Вправо по X
-        },
-        'back': {
-            'forward': Metashape.Vector([0, 0, -1]),   # Назад по -Z
-            'up': Metashape.Vector([0, 1, 0]),         # Вверх по Y
-            'right': Metashape.Vector([-1, 0, 0])      # Вправо по -X (инвертировано!)
-        },
-        'right': {
-            'forward': Metashape.Vector([1, 0, 0]),    # Вправо по X
-            'up': Metashape.Vector([0, 1, 0]),         # Вверх по Y
-            'right': Metashape.Vector([0, 0, -1])      # Вправо по -Z
-        },
-        'left': {
-            'forward': Metashape.Vector([-1, 0, 0]),   # Влево по -X
-            'up': Metashape.Vector([0, 1, 0]),         # Вверх по Y
-            'right': Metashape.Vector([0, 0, 1])       # Вправо по Z
-        },
-        'top': {
-            'forward': Metashape.Vector([0, 1, 0]),    # Вверх по Y
-            'up': Metashape.Vector([0, 0, -1]),        # "Вверх" по -Z (от камеры)
-            'right': Metashape.Vector([1, 0, 0])       # Вправо по X
-        },
-        'down': {
-            'forward': Metashape.Vector([0, -1, 0]),   # Вниз по -Y
-            'up': Metashape.Vector([0, 0, 1]),         # "Вверх" по Z (от камеры)
-            'right': Metashape.Vector([1, 0, 0])       # Вправо по X
-        }
-    }
+    def __init__(self, output_folder, images_folder, params, extra_folders=()):
+        self.path = os.path.join(output_folder, CONVERSION_MANIFEST_NAME)
+        self.images_folder = images_folder
+        # Папки, где у каждой грани тоже должен быть файл (images_2, images_4, ...)
+        self.extra_folders = list(extra_folders)
+        self.params = params
+        self._entries = {}
+        self._file = None
+        
+        if os.path.exists(self.path):
+            self._load()
+    
+    def _load(self):
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Оборванная последняя строка после аварийного завершения
+                    continue
+                self._entries[entry['label']] = entry
     
-    created_cameras = []
+    @staticmethod
+    def source_fingerprint(path):
+        """Отпечаток исходной панорамы: путь, размер и время изменения"""
+        stat = os.stat(path)
+        return {'source': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
     
-    for face_name, image_path in face_images_paths.items():
-        if face_name not in face_directions:
-            print(f"⚠️  Пропускаем неизвестную грань: {face_name}")
-            continue
+    def lookup(self, camera, face_names):
+        """
+        Возвращает готовый результат камеры, если панорама, параметры и файлы граней не изменились
+        
+        Returns:
+            dict результата (как у конвертации) или None
+        """
+        entry = self._entries.get(camera.label)
+        if entry is None or entry.get('params') != self.params:
+            return None
         
         try:
-            # Создаем новую камеру
-            camera = chunk.addCamera()
-            camera.label = f"{spherical_camera.label}_{face_name}"
-            camera.sensor = sensor
-            
-            # Создаем объект фото
-            camera.photo = Metashape.Photo()
-            camera.photo.path = image_path
-            
-            # Получаем направления для данной грани
-            directions = face_directions[face_name]
-            
-            # Применяем базовую ориентацию сферической камеры к направлениям грани
-            world_forward = base_rotation * directions['forward']
-            world_up = base_rotation * directions['up']
-            world_right = base_rotation * directions['right']
-            
-            # Создаем матрицу ориентации камеры
-            # В Metashape: строки матрицы = оси камеры в мировых координатах
-            rotation_matrix = Metashape.Matrix([
-                [world_right.x, world_right.y, world_right.z],   # X-ось камеры
-                [world_up.x, world_up.y, world_up.z],            # Y-ось камеры
-                [world_forward.x, world_forward.y, world_forward.z] # Z-ось камеры (вперед)
-            ])
-            
-            # ИСПРАВЛЕННАЯ установка трансформации:
-            # Сначала устанавливаем позицию (перенос), затем ориентацию
-            camera.transform = Metashape.Matrix.Translation(camera_center) * Metashape.Matrix.Rotation(rotation_matrix)
-            
-            created_cameras.append(camera)
-            print(f"  ✅ Создана камера: {camera.label}")
-            
-        except Exception as e:
-            print(f"  ❌ Ошибка создания камеры {face_name}: {e}")
-            continue
+            fingerprint = self.source_fingerprint(spherical_camera_image_path_FIXED(camera))
+        except OSError:
+            return None
+        if any(entry.get(key) != value for key, value in fingerprint.items()):
+            return None
+        
+        face_images = {face_name: os.path.join(self.images_folder, filename)
+                       for face_name, filename in entry.get('faces', {}).items()}
+        skipped_faces = entry.get('skipped', {})
+        if set(face_images) | set(skipped_faces) != set(face_names):
+            return None
+        if not all(os.path.exists(path) for path in face_images.values()):
+            return None
+        for folder in self.extra_folders:
+            if not all(os.path.exists(os.path.join(folder, os.path.basename(path))) for path in face_images.values()):
+                return None
+        
+        return {
+            'camera': camera,
+            'face_images': face_images,
+            'face_size_actual': entry['face_size'],
+            'error': None,
+            'skipped_faces': skipped_faces
+        }
     
-    print(f"🎯 Создано {len(created_cameras)} кубических камер")
-    return created_cameras
+    def record(self, result):
+        """Дописывает в журнал успешный результат конвертации камеры"""
+        if result['error'] or not (result['face_images'] or result.get('skipped_faces')):
+            return
+        
+        camera = result['camera']
+        try:
+            fingerprint = self.source_fingerprint(spherical_camera_image_path_FIXED(camera))
+        except OSError:
+            return
+        
+        entry = {
+            'label': camera.label,
+            **fingerprint,
+            'params': self.params,
+            'face_size': int(result['face_size_actual']),
+            'faces': {face_name: os.path.basename(path) for face_name, path in result['face_images'].items()},
+            'skipped': result.get('skipped_faces', {})
+        }
+        self._entries[camera.label] = entry
+        
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+    
+    def close(self):
+        """Закрывает журнал и переписывает его по одной строке на камеру"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for entry in self._entries.values():
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"⚠️  Не удалось переписать журнал конвертации {self.path}: {e}")
 
 # === ГЛАВНАЯ ФУНКЦИЯ: ИСПРАВЛЕННАЯ ОБРАБОТКА ===
+def make_progress_updater_FIXED(progress_tracker=None):
+    """Возвращает функцию update_progress(current, total, message, stage_change)"""
+    def update_progress(current, total, message="", stage_change=False):
+        if progress_tracker:
+            progress_tracker.update(current, total, message, stage_change)
+        else:
+            percent = int((current / total) * 100) if total > 0 else 0
+            print(f"📊 [{percent:3d}%] {message}")
+    return update_progress
+
 def process_spherical_to_cubemap_3dgs_FIXED(chunk, output_folder, face_size=None, overlap=10, 
                                            file_format="jpg", quality=95, max_points=50000,
-                                           face_threads=6, camera_threads=None, progress_tracker=None):
+                                           face_threads=6, camera_threads=None, progress_tracker=None,
+                                           map_cache_megabytes=1024, disk_map_cache=False,
+                                           fixed_point_maps=True, atlas_mode=True, backend="pipeline",
+                                           reader_threads=2, writer_threads=None, pipeline_queue_size=4,
+                                           process_workers=None, point_tracks=True, resume=True,
+                                           reduced_decode=True, mip_pyramid=False,
+                                           downscales=DEFAULT_DOWNSCALE_FACTORS, min_face_texture=0,
+                                           max_threads=None):
     """
     ИСПРАВЛЕННАЯ основная функция: создает кубические грани из сферических камер
     с ПРАВИЛЬНОЙ геометрией и экспортирует в COLMAP для 3DGS
@@ -643,74 +3019,163 @@ def process_spherical_to_cubemap_3dgs_FIXED(chunk, output_folder, face_size=None
         overlap: перекрытие граней в градусах
         file_format: формат файлов изображений
         quality: качество сжатия (для JPEG)
-        max_points: максимальное количество точек облака
+        max_points: максимальное количество точек облака (None = все точки, потоковая запись)
         face_threads: потоки для обработки граней одной камеры
         camera_threads: потоки для обработки разных камер
         progress_tracker: объект для отслеживания прогресса
+        max_threads: общий лимит потоков камер и граней (None = число ядер)
+        остальные параметры: см. export_cubemap_3dgs_FIXED
     
     Returns:
         bool: успех операции
     """
-    
-    def update_progress(current, total, message="", stage_change=False):
-        if progress_tracker:
-            progress_tracker.update(current, total, message, stage_change)
-        else:
-            percent = int((current / total) * 100) if total > 0 else 0
-            print(f"📊 [{percent:3d}%] {message}")
-    
-    print("=== 🎯 ИСПРАВЛЕННОЕ создание кубических граней ===")
-    print(f"🔄 Перекрытие: {overlap}°")
-    print(f"📐 Размер граней: {'Автоматически' if face_size is None else f'{face_size}px'}")
-    
-    # Создаем структуру папок
-    os.makedirs(output_folder, exist_ok=True)
-    images_folder = os.path.join(output_folder, "images")
-    os.makedirs(images_folder, exist_ok=True)
-    sparse_folder = os.path.join(output_folder, "sparse", "0")
-    os.makedirs(sparse_folder, exist_ok=True)
+    update_progress = make_progress_updater_FIXED(progress_tracker)
     
     # Этап 1: Анализ исходных камер (5%)
     update_progress(5, 100, "Анализ сферических камер...", stage_change=True)
     
     # Находим сферические камеры (исключаем уже созданные кубические)
-    cube_faces_suffixes = ["_front", "_right", "_left", "_top", "_down", "_back"]
-    spherical_cameras = []
-    existing_cube_cameras = []
-    
-    for cam in chunk.cameras:
-        if cam.transform and cam.photo and cam.enabled:
-            is_cube_face = any(cam.label.endswith(suffix) for suffix in cube_faces_suffixes)
-            if is_cube_face:
-                existing_cube_cameras.append(cam)
-            else:
-                spherical_cameras.append(cam)
+    spherical_cameras, existing_cube_cameras = find_spherical_cameras_FIXED(chunk)
     
     print(f"📊 Найдено камер:")
     print(f"   🔴 Сферических: {len(spherical_cameras)} (будут обработаны)")
-    print(f"   🟦 Существующих кубических: {len(existing_cube_cameras)} (будут удалены)")
+    print(f"   🟦 Существующих кубических: {len(existing_cube_cameras)} (устаревшие будут пересозданы)")
     
     if not spherical_cameras:
         print("❌ Ошибка: не найдено сферических камер для обработки!")
         return False
     
-    # Удаляем существующие кубические камеры (если есть)
-    if existing_cube_cameras:
-        print(f"🗑️  Удаляем {len(existing_cube_cameras)} существующих кубических камер...")
-        for cam in existing_cube_cameras:
-            chunk.remove(cam)
-    
     # Этап 2: Извлечение цветного облака (15%)
     update_progress(15, 100, "Извлечение цветного разреженного облака...", stage_change=True)
-    points3D = extract_colored_point_cloud_FIXED(chunk, max_points=max_points)
+    if max_points:
+        points3D = extract_colored_point_cloud_FIXED(chunk, max_points=max_points)
+        if point_tracks:
+            points3D.update(extract_point_observations_FIXED(chunk, points3D, spherical_cameras))
+    else:
+        # Полное облако не собирается в памяти: читается порциями при записи points3D.bin
+        points3D = TiePointCloudStream(chunk, spherical_cameras, point_tracks=point_tracks)
+    
+    return export_cubemap_3dgs_FIXED(
+        spherical_cameras, output_folder, points3D, chunk=chunk, existing_cube_cameras=existing_cube_cameras,
+        face_size=face_size, overlap=overlap, file_format=file_format, quality=quality,
+        face_threads=face_threads, camera_threads=camera_threads, progress_tracker=progress_tracker,
+        map_cache_megabytes=map_cache_megabytes, disk_map_cache=disk_map_cache,
+        fixed_point_maps=fixed_point_maps, atlas_mode=atlas_mode, backend=backend,
+        reader_threads=reader_threads, writer_threads=writer_threads,
+        pipeline_queue_size=pipeline_queue_size, process_workers=process_workers,
+        point_tracks=point_tracks, resume=resume, reduced_decode=reduced_decode,
+        mip_pyramid=mip_pyramid, downscales=downscales, min_face_texture=min_face_texture,
+        max_threads=max_threads
+    )
+
+def process_manifest_to_cubemap_3dgs_FIXED(manifest_path, output_folder, points_path=None, progress_tracker=None, **options):
+    """
+    Headless-обработка: те же грани и COLMAP экспорт по манифесту, без Metashape
+    
+    Args:
+        manifest_path: манифест камер (export_camera_manifest_FIXED)
+        output_folder: папка для сохранения результатов
+        points_path: облако точек .npz (None = points3D.bin без точек)
+        progress_tracker: объект для отслеживания прогресса
+        options: параметры export_cubemap_3dgs_FIXED
+    
+    Returns:
+        bool: успех операции
+    """
+    update_progress = make_progress_updater_FIXED(progress_tracker)
+    
+    update_progress(5, 100, "Чтение манифеста камер...", stage_change=True)
+    spherical_cameras = load_camera_manifest_FIXED(manifest_path)
+    print(f"📊 Камер в манифесте: {len(spherical_cameras)}")
+    
+    if not spherical_cameras:
+        print("❌ Ошибка: манифест не содержит камер!")
+        return False
+    
+    update_progress(15, 100, "Загрузка облака точек...", stage_change=True)
+    points3D = load_points_npz_FIXED(points_path) if points_path else empty_point_cloud_FIXED()
+    print(f"🎨 Точек облака: {len(points3D['ids'])}")
+    
+    return export_cubemap_3dgs_FIXED(spherical_cameras, output_folder, points3D, chunk=None,
+                                     progress_tracker=progress_tracker, **options)
+
+def export_cubemap_3dgs_FIXED(spherical_cameras, output_folder, points3D, chunk=None, face_size=None, overlap=10,
+                              file_format="jpg", quality=95, face_threads=6, camera_threads=None,
+                              progress_tracker=None, map_cache_megabytes=1024, disk_map_cache=False,
+                              fixed_point_maps=True, atlas_mode=True, backend="pipeline",
+                              reader_threads=2, writer_threads=None, pipeline_queue_size=4,
+                              process_workers=None, point_tracks=True, visibility_memory_megabytes=256,
+                              resume=True, reduced_decode=True, mip_pyramid=False,
+                              downscales=DEFAULT_DOWNSCALE_FACTORS, min_face_texture=0, max_threads=None,
+                              existing_cube_cameras=()):
+    """
+    Создает кубические грани и COLMAP экспорт для списка сферических камер
+    
+    Args:
+        spherical_cameras: камеры Metashape или ManifestCamera
+        output_folder: папка для сохранения результатов
+        points3D: облако точек для points3D.bin (словарь или TiePointCloudStream для потоковой записи)
+        chunk: Metashape.Chunk для создания кубических камер (None = только файлы)
+        existing_cube_cameras: кубические камеры чанка - камеры панорам без изменений
+            сохраняются, остальные удаляются одним вызовом chunk.remove
+        face_size: размер грани в пикселях (None = автоматически)
+        overlap: перекрытие граней в градусах
+        file_format: формат файлов изображений
+        quality: качество сжатия (для JPEG)
+        face_threads: потоки граней одной камеры: remap по граням и запись граней (backend="threads"),
+            remap по граням (конвейер с atlas_mode=False); пул граней общий для всех камер
+        camera_threads: потоки для обработки разных камер
+        progress_tracker: объект для отслеживания прогресса
+        max_threads: общий лимит потоков камер и граней (None = число ядер, plan_thread_budget_FIXED)
+        map_cache_megabytes: лимит памяти кэша карт проекции
+        fixed_point_maps: хранить карты в формате CV_16SC2 (быстрее remap, на четверть меньше памяти)
+        atlas_mode: строить все грани камеры одним вызовом cv2.remap в общий буфер
+        backend: "pipeline" (чтение → remap → запись независимыми стадиями), "processes"
+            (конвейер с remap в пуле процессов через общую память) или "threads" (пул камер)
+        process_workers: процессы remap для backend="processes" (None = все ядра)
+        reader_threads: потоки чтения панорам (конвейер)
+        writer_threads: потоки кодирования и записи граней (конвейер, None = половина CPU)
+        pipeline_queue_size: сколько декодированных панорам может ждать remap (конвейер)
+        disk_map_cache: сохранять карты проекции в output_folder/map_cache для повторных запусков
+        point_tracks: заполнять треки точек и 2D наблюдения в гранях (attach_point_tracks_FIXED)
+        visibility_memory_megabytes: лимит промежуточных массивов проекции точек в грани
+        resume: не конвертировать панорамы, не изменившиеся с прошлого запуска (ConversionManifest)
+        reduced_decode: декодировать JPEG в 1/2-1/8 разрешения, если грани намного меньше панорамы
+        mip_pyramid: антиалиасинг мелких граней - remap из пирамиды cv2.pyrDown панорамы
+        downscales: множители уменьшенных копий граней в images_2, images_4, ... (() = не создавать)
+        min_face_texture: пропускать грани (небо, надир) с долей текстурированных пикселей превью
+            ниже порога, пропуски пишутся в журнал (0 = все грани, DEFAULT_MIN_FACE_TEXTURE)
+    
+    Returns:
+        bool: успех операции
+    """
+    update_progress = make_progress_updater_FIXED(progress_tracker)
+    
+    print("=== 🎯 ИСПРАВЛЕННОЕ создание кубических граней ===")
+    print(f"🔄 Перекрытие: {overlap}°")
+    print(f"📐 Размер граней: {'Автоматически' if face_size is None else f'{face_size}px'}")
+    
+    # Создаем структуру папок
+    os.makedirs(output_folder, exist_ok=True)
+    images_folder = os.path.join(output_folder, "images")
+    os.makedirs(images_folder, exist_ok=True)
+    downscales = tuple(sorted(set(int(factor) for factor in downscales or ())))
+    downscaled_folders = [downscaled_images_folder_FIXED(images_folder, factor) for factor in downscales]
+    for folder in downscaled_folders:
+        os.makedirs(folder, exist_ok=True)
+    sparse_folder = os.path.join(output_folder, "sparse", "0")
+    os.makedirs(sparse_folder, exist_ok=True)
+    
+    # Кэш карт проекции: одна карта на грань для всех камер с одинаковым разрешением
+    map_cache = FaceMapCache(
+        max_megabytes=map_cache_megabytes,
+        disk_folder=os.path.join(output_folder, "map_cache") if disk_map_cache else None,
+        fixed_point=fixed_point_maps
+    )
     
     # Этап 3: Подготовка к обработке (20%)
     update_progress(20, 100, "Подготовка параметров...", stage_change=True)
     
-    # Определяем количество потоков
-    if camera_threads is None:
-        camera_threads = min(len(spherical_cameras), os.cpu_count() or 1)
-    
     face_names = ["front", "right", "left", "top", "down", "back"]
     
     # Настройки сохранения изображений
@@ -725,15 +3190,105 @@ def process_spherical_to_cubemap_3dgs_FIXED(chunk, output_folder, face_size=None
         save_params = [cv2.IMWRITE_JPEG_QUALITY, quality]
         file_ext = "jpg"
     
-    # Структуры для COLMAP
-    cameras_colmap = {}
-    images_colmap = {}
-    camera_params_to_id = {}
-    next_camera_id = 1
-    next_image_id = 1
+    # Журнал конвертации: панорамы без изменений с прошлого запуска не конвертируются
+    manifest = ConversionManifest(output_folder, images_folder, {
+        'face_size': face_size,
+        'overlap': overlap,
+        'file_ext': file_ext,
+        'quality': quality,
+        'fixed_point_maps': fixed_point_maps,
+        'reduced_decode': reduced_decode,
+        'mip_pyramid': mip_pyramid,
+        'min_face_texture': min_face_texture,
+        'faces': face_names
+    }, extra_folders=downscaled_folders)
+    all_camera_results = []
+    reused_results = []
+    cameras_to_convert = []
+    for spherical_camera in spherical_cameras:
+        reused = manifest.lookup(spherical_camera, face_names) if resume else None
+        if reused is not None:
+            all_camera_results.append(reused)
+            reused_results.append(reused)
+        else:
+            cameras_to_convert.append(spherical_camera)
+    
+    if all_camera_results:
+        print(f"♻️  Без изменений с прошлого запуска: {len(all_camera_results)} камер, "
+              f"к конвертации: {len(cameras_to_convert)}")
+    
+    # Определяем количество потоков
+    if camera_threads is None:
+        camera_threads = min(len(cameras_to_convert), os.cpu_count() or 1)
+    camera_threads = max(1, camera_threads)
+    
+    # Предварительная проверка по заголовкам: до декодирования панорам и remap
+    preflight = preflight_spherical_cameras_FIXED(
+        cameras_to_convert, face_size, len(face_names), file_ext, downscales, overlap, reduced_decode
+    )
+    if preflight['missing']:
+        print(f"❌ Не найдены файлы панорам: {len(preflight['missing'])} камер")
+        for label in preflight['missing'][:10]:
+            print(f"   {label}")
+        if len(preflight['missing']) > 10:
+            print(f"   ... и еще {len(preflight['missing']) - 10}")
+        manifest.close()
+        return False
+    
+    # Камеры одного разрешения подряд: карты проекции берутся из кэша, а не строятся заново
+    cameras_to_convert = [camera for group in preflight['groups'].values() for camera in group]
+    if cameras_to_convert:
+        resolutions = [f"{size[0]}x{size[1]}: {len(group)}" for size, group in preflight['groups'].items() if size]
+        unknown = len(preflight['groups'].get(None, ()))
+        print(f"🔎 Разрешения панорам: {', '.join(resolutions) or '-'}"
+              + (f", без заголовка: {unknown}" if unknown else ""))
+        planned_sizes = sorted(set(preflight['face_sizes'].values()))
+        if planned_sizes:
+            print(f"📐 Размеры граней: {', '.join(f'{size}px' for size in planned_sizes)}")
+        estimated_seconds = preflight['cpu_seconds'] / min(camera_threads, os.cpu_count() or 1)
+        print(f"💾 Оценка: граней ~{preflight['output_bytes'] / 1024 ** 2:.0f} МБ, "
+              f"обработка ~{estimated_seconds / 60:.1f} мин")
+        try:
+            free_bytes = shutil.disk_usage(output_folder).free
+            if preflight['output_bytes'] > free_bytes:
+                print(f"⚠️  Свободно на диске {free_bytes / 1024 ** 3:.2f} ГБ - меньше оценки объема граней")
+        except OSError:
+            pass
     
     # Этап 4: Обработка сферических камер (20-60%)
-    update_progress(20, 100, f"Создание кубических граней для {len(spherical_cameras)} камер...", stage_change=True)
+    update_progress(20, 100, f"Создание кубических граней для {len(cameras_to_convert)} камер...", stage_change=True)
+    
+    # Буферы атласа, переиспользуемые каждым рабочим потоком
+    thread_buffers = threading.local()
+    # Общий пул граней: грани одной панорамы строятся и записываются параллельно
+    face_executor = None
+    
+    def save_camera_faces(label, face_images, results):
+        """Кодирует и записывает грани камеры (в пуле граней, если он есть)"""
+        if face_executor is not None:
+            pending = {
+                face_name: face_executor.submit(save_face_image_FIXED, perspective_image, images_folder,
+                                                f"{label}_{face_name}.{file_ext}", save_params, downscales)
+                for face_name, perspective_image in face_images.items()
+            }
+        else:
+            pending = dict.fromkeys(face_images)
+        
+        for face_name, future in pending.items():
+            try:
+                if future is not None:
+                    output_path = future.result()
+                else:
+                    output_path = save_face_image_FIXED(
+                        face_images[face_name], images_folder, f"{label}_{face_name}.{file_ext}", save_params, downscales
+                    )
+                
+                if output_path:
+                    results['face_images'][face_name] = output_path
+                
+            except Exception as e:
+                print(f"❌ Ошибка обработки грани {face_name} для {label}: {e}")
+                continue
     
     def process_single_spherical_camera_FIXED(cam_data):
         """ИСПРАВЛЕННАЯ обработка одной сферической камеры"""
@@ -742,57 +3297,46 @@ def process_spherical_to_cubemap_3dgs_FIXED(chunk, output_folder, face_size=None
             'camera': spherical_camera,
             'face_images': {},
             'face_size_actual': None,
-            'error': None
+            'error': None,
+            'skipped_faces': {}
         }
         
         try:
             # Загружаем сферическое изображение
-            spherical_image = read_image_safe(spherical_camera.photo.path)
+            # и определяем размер граней (по полной ширине панорамы)
+            spherical_image, actual_face_size = read_spherical_image_FIXED(
+                spherical_camera_image_path_FIXED(spherical_camera), face_size, overlap, reduced_decode
+            )
             if spherical_image is None:
                 results['error'] = "Не удалось загрузить изображение"
                 return results
             
-            eq_height, eq_width = spherical_image.shape[:2]
+            results['face_size_actual'] = actual_face_size
             
-            # Определяем размер граней
-            if face_size is None:
-                # Автоматический расчет размера
-                actual_face_size = min(max(eq_width // 4, 512), 2048)
-                # Округляем до ближайшей степени двойки для оптимальности
-                actual_face_size = 2 ** int(np.log2(actual_face_size) + 0.5)
-            else:
-                actual_face_size = face_size
+            # Атлас строится в буфер потока (переиспользуется между камерами)
+            atlas, face_images = generate_cubemap_faces_FIXED(
+                spherical_image,
+                face_names,
+                actual_face_size,
+                overlap,
+                map_cache,
+                atlas_mode=atlas_mode,
+                atlas_out=getattr(thread_buffers, 'atlas', None),
+                mip_pyramid=mip_pyramid,
+                face_executor=face_executor
+            )
+            if atlas is not None:
+                thread_buffers.atlas = atlas
             
-            results['face_size_actual'] = actual_face_size
+            if min_face_texture > 0:
+                face_images, results['skipped_faces'] = select_textured_faces_FIXED(
+                    face_images, min_face_texture, spherical_camera.label
+                )
             
-            # ИСПРАВЛЕННАЯ обработка каждой грани
-            for face_name in face_names:
-                try:
-                    # Создаем изображение грани с ПРАВИЛЬНОЙ геометрией
-                    perspective_image = equirectangular_to_cubemap_face_FIXED(
-                        spherical_image, 
-                        face_name, 
-                        actual_face_size, 
-                        fov=90, 
-                        overlap=overlap
-                    )
-                    
-                    if perspective_image is None:
-                        continue
-                    
-                    # Сохраняем изображение
-                    output_filename = f"{spherical_camera.label}_{face_name}.{file_ext}"
-                    output_path = os.path.join(images_folder, output_filename)
-                    
-                    if save_image_safe(perspective_image, output_path, save_params):
-                        results['face_images'][face_name] = output_path
-                    
-                    # Очистка памяти
-                    del perspective_image
-                    
-                except Exception as e:
-                    print(f"❌ Ошибка обработки грани {face_name} для {spherical_camera.label}: {e}")
-                    continue
+            # Сохраняем изображения граней (атлас потока занят, пока все грани не записаны)
+            save_camera_faces(spherical_camera.label, face_images, results)
+            
+            del face_images
             
             # Очистка памяти
             del spherical_image
@@ -805,159 +3349,184 @@ def process_spherical_to_cubemap_3dgs_FIXED(chunk, output_folder, face_size=None
             return results
     
     # Параллельная обработка сферических камер
-    all_camera_results = []
+    def add_camera_result(results):
+        all_camera_results.append(results)
+        manifest.record(results)
     
-    if camera_threads == 1:
-        # Последовательная обработка
-        for cam_idx, spherical_camera in enumerate(spherical_cameras):
-            progress = 20 + int((cam_idx / len(spherical_cameras)) * 40)
-            update_progress(progress, 100, f"Создание граней для {spherical_camera.label} ({cam_idx+1}/{len(spherical_cameras)})")
+    try:
+        if not cameras_to_convert:
+            print("♻️  Все панорамы без изменений - конвертация не требуется")
+        elif backend in ("pipeline", "processes"):
+            # Конвейер: чтение, remap и запись разных камер перекрываются во времени
+            if writer_threads is None:
+                writer_threads = max(2, (os.cpu_count() or 2) // 2)
             
-            results = process_single_spherical_camera_FIXED((cam_idx, spherical_camera))
-            all_camera_results.append(results)
-    else:
-        # Параллельная обработка
-        with concurrent.futures.ThreadPoolExecutor(max_workers=camera_threads) as executor:
-            # Создаем задачи
-            camera_data = [(idx, cam) for idx, cam in enumerate(spherical_cameras)]
-            future_to_camera = {
-                executor.submit(process_single_spherical_camera_FIXED, data): data[1] 
-                for data in camera_data
-            }
+            process_pool = None
+            remap_workers = camera_threads
+            if backend == "pipeline" and not atlas_mode and not mip_pyramid:
+                # Запись граней - отдельная стадия, пулу граней достается только remap по граням
+                remap_workers, face_workers = plan_thread_budget_FIXED(
+                    camera_threads, face_threads, max_threads, reserved_threads=reader_threads + writer_threads
+                )
+                if face_workers:
+                    face_executor = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=face_workers, thread_name_prefix="cubemap-face")
+                    print(f"🧵 Пул граней: {face_workers} потоков")
+            if backend == "processes":
+                # Камеры Metashape по-прежнему создаются только в главном потоке
+                if process_workers is None:
+                    process_workers = os.cpu_count() or 1
+                process_pool = create_remap_process_pool_FIXED(
+                    process_workers,
+                    max_megabytes=map_cache_megabytes,
+                    disk_folder=map_cache.disk_folder,
+                    fixed_point=fixed_point_maps
+                )
+                if process_pool is not None:
+                    remap_workers = process_workers
+                    if not atlas_mode:
+                        print("⚠️  Процессы remap строят грани атласом: atlas_mode=False не учитывается")
             
-            # Собираем результаты
-            completed = 0
-            for future in concurrent.futures.as_completed(future_to_camera):
-                camera = future_to_camera[future]
-                completed += 1
-                progress = 20 + int((completed / len(spherical_cameras)) * 40)
-                update_progress(progress, 100, f"Создание граней завершено: {camera.label} ({completed}/{len(spherical_cameras)})")
-                
-                try:
-                    results = future.result()
-                    all_camera_results.append(results)
-                except Exception as e:
-                    print(f"❌ Ошибка в потоке для {camera.label}: {e}")
-                    all_camera_results.append({
-                        'camera': camera,
-                        'face_images': {},
-                        'face_size_actual': None,
-                        'error': str(e)
-                    })
+            print(f"🧵 Конвейер: чтение {reader_threads} / remap {remap_workers} "
+                  f"{'процессов' if process_pool is not None else 'потоков'} / запись {writer_threads} потоков, "
+                  f"очередь {pipeline_queue_size} панорам")
+            
+            jobs = [(cam, cam.label, spherical_camera_image_path_FIXED(cam)) for cam in cameras_to_convert]
+            try:
+                pipeline = run_cubemap_pipeline_FIXED(
+                    jobs, face_names, face_size, overlap, map_cache, images_folder, file_ext, save_params,
+                    reader_threads=reader_threads,
+                    remap_threads=remap_workers,
+                    writer_threads=writer_threads,
+                    queue_size=pipeline_queue_size,
+                    atlas_mode=atlas_mode,
+                    process_pool=process_pool,
+                    reduced_decode=reduced_decode,
+                    mip_pyramid=mip_pyramid,
+                    downscales=downscales,
+                    min_face_texture=min_face_texture,
+                    face_executor=face_executor
+                )
+                for completed, results in enumerate(pipeline, 1):
+                    add_camera_result(results)
+                    progress = 20 + int((completed / len(cameras_to_convert)) * 40)
+                    update_progress(progress, 100, f"Создание граней завершено: {results['camera'].label} ({completed}/{len(cameras_to_convert)})")
+            finally:
+                if process_pool is not None:
+                    process_pool.shutdown()
+        else:
+            camera_threads, face_workers = plan_thread_budget_FIXED(camera_threads, face_threads, max_threads)
+            if face_workers:
+                face_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=face_workers, thread_name_prefix="cubemap-face")
+            print(f"🧵 Потоков: {camera_threads} камер / пул граней {face_workers}")
+            
+            if camera_threads == 1:
+                # Последовательная обработка
+                for cam_idx, spherical_camera in enumerate(cameras_to_convert):
+                    progress = 20 + int((cam_idx / len(cameras_to_convert)) * 40)
+                    update_progress(progress, 100, f"Создание граней для {spherical_camera.label} ({cam_idx+1}/{len(cameras_to_convert)})")
+                    
+                    results = process_single_spherical_camera_FIXED((cam_idx, spherical_camera))
+                    add_camera_result(results)
+            else:
+                # Параллельная обработка
+                with concurrent.futures.ThreadPoolExecutor(max_workers=camera_threads) as executor:
+                    # Создаем задачи
+                    camera_data = [(idx, cam) for idx, cam in enumerate(cameras_to_convert)]
+                    future_to_camera = {
+                        executor.submit(process_single_spherical_camera_FIXED, data): data[1] 
+                        for data in camera_data
+                    }
+                    
+                    # Собираем результаты
+                    completed = 0
+                    for future in concurrent.futures.as_completed(future_to_camera):
+                        camera = future_to_camera[future]
+                        completed += 1
+                        progress = 20 + int((completed / len(cameras_to_convert)) * 40)
+                        update_progress(progress, 100, f"Создание граней завершено: {camera.label} ({completed}/{len(cameras_to_convert)})")
+                        
+                        try:
+                            results = future.result()
+                            add_camera_result(results)
+                        except Exception as e:
+                            print(f"❌ Ошибка в потоке для {camera.label}: {e}")
+                            add_camera_result({
+                                'camera': camera,
+                                'face_images': {},
+                                'face_size_actual': None,
+                                'error': str(e)
+                            })
+
+    finally:
+        if face_executor is not None:
+            face_executor.shutdown()
+        manifest.close()
+    
+    # Порядок результатов - как у исходных камер (не зависит от порядка завершения)
+    camera_order = {id(cam): idx for idx, cam in enumerate(spherical_cameras)}
+    all_camera_results.sort(key=lambda r: camera_order[id(r['camera'])])
     
     # Подсчитываем успешные результаты
     successful_results = [r for r in all_camera_results if not r['error'] and r['face_images']]
     total_faces_created = sum(len(r['face_images']) for r in successful_results)
     
+    total_faces_skipped = sum(len(r.get('skipped_faces', {})) for r in all_camera_results)
+    
     print(f"✅ Создано {total_faces_created} граней из {len(spherical_cameras)} камер")
+    if total_faces_skipped:
+        print(f"🌫️  Пропущено малотекстурных граней: {total_faces_skipped}")
+    print(f"🗺️  Кэш карт проекции: {map_cache.stats()}")
     
     # Этап 5: Создание камер в Metashape (60-75%)
-    update_progress(60, 100, "Создание кубических камер в Metashape...", stage_change=True)
-    
     all_new_cameras = []
-    for idx, result in enumerate(successful_results):
-        progress = 60 + int((idx / len(successful_results)) * 15)
-        update_progress(progress, 100, f"Создание камер для {result['camera'].label}")
+    if chunk is not None:
+        update_progress(60, 100, "Создание кубических камер в Metashape...", stage_change=True)
+        
+        # Камеры панорам из журнала остаются в чанке, устаревшие удаляются одним вызовом
+        current_labels, stale_cameras = split_existing_cube_cameras_FIXED(existing_cube_cameras, reused_results)
+        if current_labels:
+            print(f"♻️  Сохранено {len(current_labels)} актуальных кубических камер")
+        if stale_cameras:
+            print(f"🗑️  Удаляем {len(stale_cameras)} устаревших кубических камер...")
+            chunk.remove(stale_cameras)
+        results_to_create = [
+            dict(result, face_images={face_name: path for face_name, path in result['face_images'].items()
+                                      if f"{result['camera'].label}_{face_name}" not in current_labels})
+            for result in successful_results
+        ]
         
         try:
-            new_cameras = create_cubemap_cameras_FIXED(
-                chunk, 
-                result['camera'], 
-                result['face_images'], 
-                result['face_size_actual'], 
-                overlap
+            all_new_cameras = create_cubemap_cameras_batch_FIXED(
+                chunk, results_to_create, overlap,
+                progress_callback=lambda done, total, label: update_progress(
+                    60 + int((done / total) * 15), 100, f"Создание камер для {label}")
             )
-            all_new_cameras.extend(new_cameras)
         except Exception as e:
-            print(f"❌ Ошибка создания камер для {result['camera'].label}: {e}")
-    
-    print(f"✅ Создано {len(all_new_cameras)} кубических камер в Metashape")
+            print(f"❌ Ошибка создания камер: {e}")
+        
+        print(f"✅ Создано {len(all_new_cameras)} кубических камер в Metashape")
     
     # Этап 6: Создание COLMAP структур (75-90%)
     update_progress(75, 100, "Создание COLMAP структур...", stage_change=True)
-    
-    for result in successful_results:
-        if not result['face_images']:
-            continue
-            
-        camera_center = result['camera'].center
-        camera_center_np = np.array([camera_center.x, camera_center.y, camera_center.z])
-        camera_transform = result['camera'].transform
-        base_rotation = camera_transform.rotation()
-        
-        # Параметры камеры с учетом перекрытия
-        face_size_actual = result['face_size_actual']
-        effective_fov = 90 + overlap
-        focal_length = face_size_actual / (2 * np.tan(np.radians(effective_fov / 2)))
-        cx = cy = face_size_actual / 2.0
-        
-        # Группируем одинаковые камеры
-        camera_key = (face_size_actual, face_size_actual, focal_length, cx, cy)
-        
-        if camera_key not in camera_params_to_id:
-            camera_params_to_id[camera_key] = next_camera_id
-            cameras_colmap[next_camera_id] = {
-                'model': 'PINHOLE',
-                'model_id': CAMERA_MODEL_IDS['PINHOLE'],
-                'width': face_size_actual,
-                'height': face_size_actual,
-                'params': [focal_length, focal_length, cx, cy]
-            }
-            camera_id = next_camera_id
-            next_camera_id += 1
-        else:
-            camera_id = camera_params_to_id[camera_key]
-        
-        # ИСПРАВЛЕННЫЕ направления граней для COLMAP
-        face_directions_colmap = {
-            'front': {'forward': np.array([0, 0, 1]), 'up': np.array([0, 1, 0]), 'right': np.array([1, 0, 0])},
-            'back': {'forward': np.array([0, 0, -1]), 'up': np.array([0, 1, 0]), 'right': np.array([-1, 0, 0])},
-            'right': {'forward': np.array([1, 0, 0]), 'up': np.array([0, 1, 0]), 'right': np.array([0, 0, -1])},
-            'left': {'forward': np.array([-1, 0, 0]), 'up': np.array([0, 1, 0]), 'right': np.array([0, 0, 1])},
-            'top': {'forward': np.array([0, 1, 0]), 'up': np.array([0, 0, -1]), 'right': np.array([1, 0, 0])},
-            'down': {'forward': np.array([0, -1, 0]), 'up': np.array([0, 0, 1]), 'right': np.array([1, 0, 0])}
-        }
-        
-        # Создаем изображения для каждой грани
-        for face_name, image_path in result['face_images'].items():
-            if face_name not in face_directions_colmap:
-                continue
-                
-            directions = face_directions_colmap[face_name]
-            
-            # Применяем базовую ориентацию сферической камеры
-            base_rot_matrix = np.array([
-                [base_rotation[0, 0], base_rotation[0, 1], base_rotation[0, 2]],
-                [base_rotation[1, 0], base_rotation[1, 1], base_rotation[1, 2]],
-                [base_rotation[2, 0], base_rotation[2, 1], base_rotation[2, 2]]
-            ])
-            
-            world_forward = base_rot_matrix @ directions['forward']
-            world_up = base_rot_matrix @ directions['up']
-            world_right = base_rot_matrix @ directions['right']
-            
-            # Создаем матрицу поворота для COLMAP (camera-to-world)
-            R_c2w = np.array([
-                world_right,   # X-ось камеры
-                world_up,      # Y-ось камеры  
-                world_forward  # Z-ось камеры
-            ])
-            
-            # Позиция камеры для COLMAP
-            tvec = -R_c2w @ camera_center_np
-            qvec = rotation_matrix_to_quaternion(R_c2w)
-            
-            # Добавляем изображение в COLMAP структуру
-            filename = os.path.basename(image_path)
-            images_colmap[next_image_id] = {
-                'qvec': qvec,
-                'tvec': tvec.tolist(),
-                'camera_id': camera_id,
-                'name': filename,
-                'xys': [],           # Пустой для 3DGS
-                'point3D_ids': []    # Пустой для 3DGS
-            }
-            next_image_id += 1
+    cameras_colmap, images_colmap, face_image_ids = build_colmap_model_FIXED(successful_results, overlap)
+    
+    streamed_points = isinstance(points3D, TiePointCloudStream)
+    if streamed_points:
+        # Потоковое облако: points3D.bin пишется порциями вместе с треками,
+        # 2D точки изображений известны только после последней порции
+        update_progress(82, 100, "Потоковая запись points3D.bin (треки COLMAP)...")
+        point_count, colored_points = write_points3D_stream_FIXED(
+            points3D, os.path.join(sparse_folder, "points3D.bin"), images_colmap, successful_results,
+            face_image_ids, spherical_cameras, overlap, point_tracks=point_tracks,
+            memory_megabytes=visibility_memory_megabytes
+        )
+        print(f"💾 Сохранено points3D.bin: {point_count} точек")
+    elif point_tracks and len(points3D['ids']):
+        update_progress(82, 100, "Проекция точек облака в грани (треки COLMAP)...")
+        attach_point_tracks_FIXED(points3D, images_colmap, successful_results, face_image_ids,
+                                  spherical_cameras, overlap, memory_megabytes=visibility_memory_megabytes)
     
     # Этап 7: Сохранение COLMAP файлов (90-98%)
     update_progress(90, 100, "Сохранение COLMAP файлов...", stage_change=True)
@@ -969,9 +3538,12 @@ def process_spherical_to_cubemap_3dgs_FIXED(chunk, output_folder, face_size=None
     write_images_binary(images_colmap, os.path.join(sparse_folder, "images.bin"))
     print(f"💾 Сохранено images.bin: {len(images_colmap)} изображений")
     
-    update_progress(96, 100, "Сохранение points3D.bin...")
-    write_points3D_binary(points3D, os.path.join(sparse_folder, "points3D.bin"))
-    print(f"💾 Сохранено points3D.bin: {len(points3D)} точек")
+    if not streamed_points:
+        update_progress(96, 100, "Сохранение points3D.bin...")
+        write_points3D_binary(points3D, os.path.join(sparse_folder, "points3D.bin"))
+        point_count = len(points3D['ids'])
+        colored_points = count_colored_points_FIXED(points3D['rgb'])
+        print(f"💾 Сохранено points3D.bin: {point_count} точек")
     
     # Этап 8: Создание документации (98-100%)
     update_progress(98, 100, "Создание документации...")
@@ -987,8 +3559,7 @@ def process_spherical_to_cubemap_3dgs_FIXED(chunk, output_folder, face_size=None
         effective_fov = 90 + overlap
         focal_length_actual = "неизвестно"
     
-    colored_points = sum(1 for p in points3D.values() if p['rgb'] != [128, 128, 128])
-    color_ratio = colored_points / len(points3D) if points3D else 0
+    color_ratio = colored_points / point_count if point_count else 0
     
     with open(os.path.join(output_folder, "README_FIXED.txt"), "w", encoding='utf-8') as f:
         f.write("=== ИСПРАВЛЕННЫЙ ЭКСПОРТ ДЛЯ 3D GAUSSIAN SPLATTING ===\n\n")
@@ -1002,6 +3573,8 @@ def process_spherical_to_cubemap_3dgs_FIXED(chunk, output_folder, face_size=None
         
         f.write("СТРУКТУРА:\n")
         f.write("├── images/           # Кубические грани (ИСПРАВЛЕННАЯ геометрия!)\n")
+        for factor in downscales:
+            f.write(f"├── {f'images_{factor}/':<18}# Грани 1/{factor} размера (3DGS -r {factor})\n")
         f.write("├── sparse/0/         # COLMAP данные\n")
         f.write("│   ├── cameras.bin   # Параметры камер граней\n")
         f.write("│   ├── images.bin    # ПРАВИЛЬНЫЕ позиции и ориентации\n")
@@ -1011,10 +3584,12 @@ def process_spherical_to_cubemap_3dgs_FIXED(chunk, output_folder, face_size=None
         f.write("СТАТИСТИКА:\n")
         f.write(f"- Исходных сферических камер: {len(spherical_cameras)}\n")
         f.write(f"- Создано кубических граней: {total_faces_created}\n")
+        if total_faces_skipped:
+            f.write(f"- Пропущено малотекстурных граней: {total_faces_skipped} (см. {CONVERSION_MANIFEST_NAME})\n")
         f.write(f"- Создано камер в Metashape: {len(all_new_cameras)}\n")
         f.write(f"- Типов камер в COLMAP: {len(cameras_colmap)}\n")
         f.write(f"- Изображений в COLMAP: {len(images_colmap)}\n")
-        f.write(f"- 3D точек в облаке: {len(points3D)}\n")
+        f.write(f"- 3D точек в облаке: {point_count}\n")
         f.write(f"- Цветных точек: {colored_points} ({color_ratio:.1%})\n\n")
         
         f.write("ПАРАМЕТРЫ:\n")
@@ -1047,7 +3622,7 @@ def process_spherical_to_cubemap_3dgs_FIXED(chunk, output_folder, face_size=None
     print(f"📁 Результаты: {output_folder}")
     print(f"🎯 Создано граней: {total_faces_created}")
     print(f"📷 Создано камер в Metashape: {len(all_new_cameras)}")
-    print(f"🎨 Точек облака: {len(points3D)} ({color_ratio:.1%} цветных)")
+    print(f"🎨 Точек облака: {point_count} ({color_ratio:.1%} цветных)")
     print(f"✅ ВСЕ ПРОБЛЕМЫ ИСПРАВЛЕНЫ - готово для 3D Gaussian Splatting!")
     
     return True
@@ -1063,17 +3638,7 @@ def main():
         return
     
     # Анализ камер
-    cube_faces_suffixes = ["_front", "_right", "_left", "_top", "_down", "_back"]
-    spherical_cameras = []
-    existing_cube_cameras = []
-    
-    for cam in chunk.cameras:
-        if cam.transform and cam.photo and cam.enabled:
-            is_cube_face = any(cam.label.endswith(suffix) for suffix in cube_faces_suffixes)
-            if is_cube_face:
-                existing_cube_cameras.append(cam)
-            else:
-                spherical_cameras.append(cam)
+    spherical_cameras, existing_cube_cameras = find_spherical_cameras_FIXED(chunk)
     
     if not spherical_cameras:
         Metashape.app.messageBox(
@@ -1093,7 +3658,7 @@ def main():
     info_msg += f"🔴 Сферических: {len(spherical_cameras)} (будут обработаны)\n"
     
     if existing_cube_cameras:
-        info_msg += f"🟦 Существующих кубических: {len(existing_cube_cameras)} (будут удалены и пересозданы)\n"
+        info_msg += f"🟦 Существующих кубических: {len(existing_cube_cameras)} (устаревшие будут пересозданы)\n"
     
     info_msg += f"\nПродолжить?"
     
@@ -1127,6 +3692,18 @@ def main():
     elif size_choice == 4:
         face_size = 4096
     
+    # Антиалиасинг нужен, когда грани намного меньше панорамы
+    mip_msg = "🔍 Включить антиалиасинг граней (remap из пирамиды панорамы)?\n\n"
+    mip_msg += "Рекомендуется, если грани меньше 1/4 ширины панорамы:\n"
+    mip_msg += "мелкие грани получаются без муара и ступенек"
+    mip_pyramid = bool(Metashape.app.getBool(mip_msg))
+    
+    # Пустое небо и надир со штативом не нужны для 3DGS
+    skip_msg = "🌫️ Пропускать малотекстурные грани (ровное небо, надир со штативом)?\n\n"
+    skip_msg += "Решение принимается по превью каждой грани, пропуски записываются\n"
+    skip_msg += f"в журнал {CONVERSION_MANIFEST_NAME}"
+    min_face_texture = DEFAULT_MIN_FACE_TEXTURE if Metashape.app.getBool(skip_msg) else 0
+    
     # Ограничение точек облака
     max_points = 50000
     if chunk.tie_points and len(chunk.tie_points.points) > max_points:
@@ -1140,6 +3717,23 @@ def main():
     else:
         max_points = None
     
+    # Только манифест: конвертация выполняется на машинах без Metashape (main_cli_FIXED)
+    manifest_msg = "📝 Только экспортировать манифест камер и облако точек\n"
+    manifest_msg += "для headless-конвертации без Metashape?\n\n"
+    manifest_msg += "Нет - выполнить полную обработку здесь"
+    if Metashape.app.getBool(manifest_msg):
+        manifest_path = os.path.join(output_folder, "cameras_manifest.json")
+        points_path = os.path.join(output_folder, "points3D.npz")
+        count = export_camera_manifest_FIXED(chunk, manifest_path, points_path=points_path, max_points=max_points)
+        
+        done_msg = f"✅ Манифест экспортирован: {count} камер\n\n"
+        done_msg += f"📁 {manifest_path}\n"
+        done_msg += f"🎨 {points_path}\n\n"
+        done_msg += f"🚀 Запуск без Metashape:\n"
+        done_msg += f"python unified_fixed_v002.py \"{manifest_path}\" <папка_экспорта> --points \"{points_path}\""
+        Metashape.app.messageBox(done_msg)
+        return
+    
     # Многопоточность
     cpu_count = os.cpu_count() or 1
     camera_threads = min(len(spherical_cameras), max(1, cpu_count // 2))
@@ -1152,9 +3746,11 @@ def main():
     final_msg += f"🎯 Ожидается граней: {len(spherical_cameras) * 6}\n"
     final_msg += f"📐 Размер граней: {'Автоматически' if face_size is None else f'{face_size}px'}\n"
     final_msg += f"🔄 Перекрытие: {overlap}°\n"
+    final_msg += f"🔍 Антиалиасинг: {'да' if mip_pyramid else 'нет'}\n"
+    final_msg += f"🌫️ Пропуск малотекстурных граней: {'да' if min_face_texture else 'нет'}\n"
     final_msg += f"🎨 Точек облака: {len(chunk.tie_points.points) if chunk.tie_points else 0}"
     if max_points:
-        final_msg += f" (ограничено до {max_points})"
+        final_msg += f" (прореживание по вокселям до {max_points})"
     final_msg += f"\n🧵 Потоков: {camera_threads} камер / {face_threads} граней\n"
     final_msg += f"💾 Формат: JPEG 95%\n\n"
     final_msg += f"🔧 ИСПРАВЛЕНИЯ:\n"
@@ -1181,7 +3777,9 @@ def main():
             max_points=max_points,
             face_threads=face_threads,
             camera_threads=camera_threads,
-            progress_tracker=progress
+            progress_tracker=progress,
+            mip_pyramid=mip_pyramid,
+            min_face_texture=min_face_texture
         )
         
         if success:
@@ -1209,5 +3807,86 @@ def main():
         print(traceback.format_exc())
         Metashape.app.messageBox(error_msg)
 
+# === HEADLESS CLI (БЕЗ METASHAPE) ===
+def main_cli_FIXED(argv=None):
+    """Командная строка: конвертация по манифесту камер без Metashape"""
+    parser = argparse.ArgumentParser(
+        description="Сферические панорамы → кубические грани + COLMAP по манифесту камер (без Metashape)"
+    )
+    parser.add_argument("manifest", help="манифест камер (.json или .csv), см. export_camera_manifest_FIXED")
+    parser.add_argument("output", help="папка экспорта")
+    parser.add_argument("--points", default=None, help="облако точек .npz (points3D.bin пустой, если не указано)")
+    parser.add_argument("--face-size", type=int, default=None, help="размер грани в пикселях (по умолчанию автоматически)")
+    parser.add_argument("--overlap", type=float, default=10.0, help="перекрытие граней в градусах")
+    parser.add_argument("--format", dest="file_format", default="jpg", choices=["jpg", "png"], help="формат граней")
+    parser.add_argument("--quality", type=int, default=95, help="качество JPEG")
+    parser.add_argument("--backend", default="pipeline", choices=["pipeline", "processes", "threads"],
+                        help="схема параллельной обработки")
+    parser.add_argument("--camera-threads", type=int, default=None, help="потоки remap (None = все ядра)")
+    parser.add_argument("--face-threads", type=int, default=6,
+                        help="потоки граней одной панорамы (1 = без пула граней; atlas - только запись для threads)")
+    parser.add_argument("--max-threads", type=int, default=None,
+                        help="общий лимит потоков камер и граней (None = число ядер)")
+    parser.add_argument("--process-workers", type=int, default=None, help="процессы remap для --backend processes")
+    parser.add_argument("--reader-threads", type=int, default=2, help="потоки чтения панорам")
+    parser.add_argument("--writer-threads", type=int, default=None, help="потоки записи граней")
+    parser.add_argument("--queue-size", type=int, default=4, help="очередь декодированных панорам")
+    parser.add_argument("--map-cache-mb", type=int, default=1024, help="лимит памяти кэша карт проекции")
+    parser.add_argument("--disk-map-cache", action="store_true", help="сохранять карты проекции на диск")
+    parser.add_argument("--float-maps", action="store_true", help="карты float32 вместо CV_16SC2")
+    parser.add_argument("--no-atlas", action="store_true", help="remap каждой грани отдельно")
+    parser.add_argument("--no-tracks", action="store_true", help="не заполнять треки точек и 2D наблюдения")
+    parser.add_argument("--visibility-mb", type=int, default=256, help="лимит памяти проекции точек в грани")
+    parser.add_argument("--downscales", default=",".join(str(f) for f in DEFAULT_DOWNSCALE_FACTORS),
+                        help="множители уменьшенных копий граней через запятую (images_2, ...); пусто = не создавать")
+    parser.add_argument("--mip", action="store_true",
+                        help="антиалиасинг мелких граней: remap из пирамиды панорамы")
+    parser.add_argument("--skip-textureless", nargs="?", type=float, const=DEFAULT_MIN_FACE_TEXTURE, default=0,
+                        metavar="ДОЛЯ", help="пропускать малотекстурные грани (небо, надир); "
+                        f"порог доли текстуры, по умолчанию {DEFAULT_MIN_FACE_TEXTURE}")
+    parser.add_argument("--full-decode", action="store_true",
+                        help="всегда декодировать JPEG в полном разрешении (без IMREAD_REDUCED)")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="конвертировать все панорамы заново, игнорируя журнал " + CONVERSION_MANIFEST_NAME)
+    args = parser.parse_args(argv)
+    if args.backend == "processes" and args.no_atlas:
+        parser.error("--no-atlas не поддерживается с --backend processes: процессы строят грани атласом")
+    
+    progress = ProgressTracker("FIXED Spherical to 3DGS (headless)")
+    success = process_manifest_to_cubemap_3dgs_FIXED(
+        args.manifest,
+        args.output,
+        points_path=args.points,
+        progress_tracker=progress,
+        face_size=args.face_size,
+        overlap=args.overlap,
+        file_format=args.file_format,
+        quality=args.quality,
+        camera_threads=args.camera_threads,
+        face_threads=args.face_threads,
+        max_threads=args.max_threads,
+        map_cache_megabytes=args.map_cache_mb,
+        disk_map_cache=args.disk_map_cache,
+        fixed_point_maps=not args.float_maps,
+        atlas_mode=not args.no_atlas,
+        backend=args.backend,
+        reader_threads=args.reader_threads,
+        writer_threads=args.writer_threads,
+        pipeline_queue_size=args.queue_size,
+        process_workers=args.process_workers,
+        point_tracks=not args.no_tracks,
+        visibility_memory_megabytes=args.visibility_mb,
+        resume=not args.no_resume,
+        reduced_decode=not args.full_decode,
+        mip_pyramid=args.mip,
+        downscales=[int(factor) for factor in args.downscales.split(",") if factor.strip()],
+        min_face_texture=args.skip_textureless
+    )
+    
+    print(f"⏱️ Время: {(time.time() - progress.start_time) / 60:.1f} мин")
+    return 0 if success else 1
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if Metashape is None:
+        sys.exit(main_cli_FIXED())
+    main()